@@ -0,0 +1,228 @@
+import argparse
+import json
+import multiprocessing
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from benchmarks.pipeline import run_pipeline
+from benchmarks.stages import ROOT, STAGES, run_stage
+
+
+def parse_size(value):
+    width, height = (int(v) for v in value.lower().split("x"))
+    return width, height
+
+
+def summarize(name, case, timings, wall, boxes, peak_rss_mb, extra=None):
+    timings = np.asarray(timings) * 1000
+    return {
+        "name": name,
+        "case": case,
+        "samples": len(timings),
+        "boxes": boxes,
+        "p50_ms": float(np.percentile(timings, 50)),
+        "p95_ms": float(np.percentile(timings, 95)),
+        "mean_ms": float(timings.mean()),
+        "throughput_per_s": len(timings) / wall,
+        "peak_rss_mb": peak_rss_mb,
+        "extra": extra or {},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    if args.deployment == "monolith" and args.detector != "model":
+        raise SystemExit("--deployment monolith needs --detector model")
+    cases = [
+        {"width": w, "height": h, "products": args.products, "density": density}
+        for w, h in map(parse_size, args.sizes)
+        for density in args.densities
+    ]
+    seeds = list(range(args.seed, args.seed + args.images))
+    results = []
+
+    if args.suite in ("stages", "all"):
+        # A fresh process per stage keeps services' `src` packages apart and
+        # makes each peak RSS figure belong to that stage alone.
+        spawn = multiprocessing.get_context("spawn")
+        for name in args.stages:
+            for case in cases:
+                with spawn.Pool(1) as pool:
+                    result = pool.apply(run_stage, (name, case, seeds, args.repeats))
+                entry = summarize(
+                    name,
+                    case,
+                    result["timings"],
+                    sum(result["timings"]),
+                    result["boxes"],
+                    result["peak_rss_mb"],
+                    result["extra"],
+                )
+                results.append(entry)
+                print(format_entry(entry), file=sys.stderr)
+
+    if args.suite in ("pipeline", "all"):
+        for case in cases:
+            result = run_pipeline(
+                case,
+                seeds,
+                args.repeats,
+                args.concurrency,
+                args.port,
+                args.detector_latency_ms,
+                args.deployment,
+                args.detector,
+            )
+            entry = summarize(
+                "pipeline",
+                {
+                    **case,
+                    "concurrency": args.concurrency,
+                    "detector_latency_ms": args.detector_latency_ms,
+                },
+                result["timings"],
+                result["wall"],
+                result["boxes"],
+                result["peak_rss_mb"],
+            )
+            results.append(entry)
+            print(format_entry(entry), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "images": args.images,
+            "repeats": args.repeats,
+            "deployment": args.deployment,
+            "detector": args.detector,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+def format_entry(entry):
+    case = entry["case"]
+    rss = entry["peak_rss_mb"]
+    if isinstance(rss, dict):
+        rss = max((v for v in rss.values() if v is not None), default=0)
+    return (
+        f"{entry['name']:>16} {case['width']}x{case['height']} d={case['density']}"
+        f" boxes={entry['boxes']:.0f} p50={entry['p50_ms']:.1f}ms"
+        f" p95={entry['p95_ms']:.1f}ms {entry['throughput_per_s']:.2f}/s"
+        f" rss={rss:.0f}MB"
+    )
+
+
+def compare(args):
+    # Percentage change of each metric from `baseline` to `candidate` for
+    # every benchmark present in both reports.
+    def load(path):
+        with open(path, "r", encoding="utf-8") as f:
+            report = json.load(f)
+        return report["meta"], {
+            (r["name"], json.dumps(r["case"], sort_keys=True)): r
+            for r in report["results"]
+        }
+
+    base_meta, baseline = load(args.baseline)
+    cand_meta, candidate = load(args.candidate)
+    print(
+        f"baseline {base_meta.get('commit')} ({base_meta.get('deployment')})"
+        f" -> candidate {cand_meta.get('commit')} ({cand_meta.get('deployment')})"
+    )
+    print(
+        f"{'benchmark':>16} {'case':>24} {'p50':>9} {'p95':>9}"
+        f" {'throughput':>11} {'ari':>8}"
+    )
+
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    for key in sorted(baseline.keys() & candidate.keys()):
+        old, new = baseline[key], candidate[key]
+        case = f"{old['case']['width']}x{old['case']['height']}"
+        case += f" d={old['case']['density']}"
+        ari = ""
+        if "ari" in old["extra"] and "ari" in new["extra"]:
+            ari = f"{new['extra']['ari'] - old['extra']['ari']:+.3f}"
+        print(
+            f"{key[0]:>16} {case:>24}"
+            f" {change(old['p50_ms'], new['p50_ms']):>9}"
+            f" {change(old['p95_ms'], new['p95_ms']):>9}"
+            f" {change(old['throughput_per_s'], new['throughput_per_s']):>11}"
+            f" {ari:>8}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run benchmarks")
+    run_parser.add_argument(
+        "--suite", choices=["stages", "pipeline", "all"], default="all"
+    )
+    run_parser.add_argument(
+        "--stages", nargs="+", choices=list(STAGES), default=list(STAGES)
+    )
+    run_parser.add_argument(
+        "--sizes", nargs="+", default=["1280x960", "2000x1500", "4000x3000"]
+    )
+    run_parser.add_argument("--densities", type=float, nargs="+", default=[0.85])
+    run_parser.add_argument("--products", type=int, default=12)
+    run_parser.add_argument("--images", type=int, default=3, help="seeds per case")
+    run_parser.add_argument("--repeats", type=int, default=3, help="runs per image")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--concurrency", type=int, default=2)
+    run_parser.add_argument("--detector-latency-ms", type=float, default=0.0)
+    run_parser.add_argument(
+        "--deployment",
+        choices=["services", "monolith"],
+        default="services",
+        help="separate services, or one in-process server (needs --detector model)",
+    )
+    run_parser.add_argument(
+        "--detector",
+        choices=["stub", "model"],
+        default="stub",
+        help="stub replaying the synthetic boxes, or the real DETR model",
+    )
+    run_parser.add_argument("--port", type=int, default=5800)
+    run_parser.add_argument("--output", help="write the JSON report here")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser("compare", help="Compare two reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from PIL import Image
+from benchmarks.stages import ROOT
+from benchmarks.synthetic import detections_for, generate_shelf
+
+
+def _peak_rss_mb(pid):
+    # High-water mark of a service process, from /proc (Linux only).
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _wait_ready(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Service for {url} exited with {process.returncode}")
+        try:
+            if requests.get(url, timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+
+class Services:
+    # The pipeline's services on localhost, each in its own process, using
+    # the Flask development server from each main.py. The detector is a stub
+    # replaying the manifest, or the real model with detector="model". The
+    # "monolith" deployment is a single server process that runs the real
+    # detector and the grouper in-process.
+
+    def __init__(
+        self,
+        manifest_path,
+        base_port,
+        detector_latency_ms,
+        env=None,
+        deployment="services",
+        detector="stub",
+    ):
+        if deployment == "monolith" and detector != "model":
+            raise ValueError("The monolith deployment needs the model detector")
+        self.ports = {
+            "detector": base_port,
+            "grouper": base_port + 1,
+            "server": base_port + 2,
+        }
+        self.manifest_path = manifest_path
+        self.detector_latency_ms = detector_latency_ms
+        self.env = env or {}
+        self.deployment = deployment
+        self.detector = detector
+        self.processes = {}
+
+    def _start(self, name, args, cwd, env):
+        self.processes[name] = subprocess.Popen(
+            args,
+            cwd=cwd,
+            env={**os.environ, **env, **self.env},
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def _start_detector(self):
+        port = self.ports["detector"]
+        if self.detector == "model":
+            self._start(
+                "detector",
+                [sys.executable, "main.py"],
+                os.path.join(ROOT, "detector", "app"),
+                {
+                    "DETECTOR_HOST": "127.0.0.1",
+                    "DETECTOR_PORT": str(port),
+                    "DETECTOR_LOG_LEVEL": "WARNING",
+                },
+            )
+            return
+        self._start(
+            "detector",
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.stub_detector",
+                "--manifest",
+                self.manifest_path,
+                "--port",
+                str(port),
+                "--latency-ms",
+                str(self.detector_latency_ms),
+            ],
+            ROOT,
+            {},
+        )
+
+    def __enter__(self):
+        detector, grouper, server = (
+            self.ports["detector"],
+            self.ports["grouper"],
+            self.ports["server"],
+        )
+        server_env = {
+            "SERVER_HOST": "127.0.0.1",
+            "SERVER_PORT": str(server),
+            "SERVER_LOG_LEVEL": "WARNING",
+            "SERVER_CACHE_ENABLED": "false",
+        }
+        if self.deployment == "monolith":
+            server_env.update(
+                SERVER_PIPELINE_MODE="monolith",
+                DETECTOR_LOG_LEVEL="WARNING",
+                GROUPER_LOG_LEVEL="WARNING",
+            )
+            waits = [("server", server, "readyz", 600)]
+        else:
+            self._start_detector()
+            self._start(
+                "grouper",
+                [sys.executable, "main.py"],
+                os.path.join(ROOT, "grouper", "app"),
+                {
+                    "GROUPER_HOST": "127.0.0.1",
+                    "GROUPER_PORT": str(grouper),
+                    "GROUPER_LOG_LEVEL": "WARNING",
+                },
+            )
+            server_env.update(
+                SERVER_DETECTOR_URL=f"http://127.0.0.1:{detector}/detect",
+                SERVER_GROUPER_URL=f"http://127.0.0.1:{grouper}/group",
+                SERVER_DETECTOR_CONFIG_URL=f"http://127.0.0.1:{detector}/config",
+                SERVER_GROUPER_CONFIG_URL=f"http://127.0.0.1:{grouper}/config",
+            )
+            waits = [
+                ("detector", detector, "config", 600),
+                ("grouper", grouper, "config", 60),
+                ("server", server, "metrics", 60),
+            ]
+        self._start(
+            "server",
+            [sys.executable, "main.py"],
+            os.path.join(ROOT, "server", "app"),
+            server_env,
+        )
+        try:
+            for name, port, path, timeout in waits:
+                _wait_ready(
+                    f"http://127.0.0.1:{port}/{path}", self.processes[name], timeout
+                )
+        except Exception:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def peak_rss_mb(self):
+        return {name: _peak_rss_mb(p.pid) for name, p in self.processes.items()}
+
+    def __exit__(self, *exc):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def encode_images(case, seeds):
+    # JPEG bytes for each seed and the stub detector's manifest for them.
+    images, manifest = [], {}
+    for seed in seeds:
+        shelf = generate_shelf(seed=seed, **case)
+        buffer = io.BytesIO()
+        Image.fromarray(shelf.image).save(buffer, format="JPEG", quality=90)
+        data = buffer.getvalue()
+        detections, _ = detections_for(shelf, seed=seed)
+        manifest[hashlib.sha256(data).hexdigest()] = detections
+        images.append(data)
+    return images, manifest
+
+
+def run_pipeline(
+    case,
+    seeds,
+    requests_per_image,
+    concurrency,
+    base_port,
+    latency_ms,
+    deployment="services",
+    detector="stub",
+):
+    images, manifest = encode_images(case, seeds)
+    with tempfile.TemporaryDirectory() as tmp:
+        manifest_path = os.path.join(tmp, "manifest.json")
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+        with Services(
+            manifest_path,
+            base_port,
+            latency_ms,
+            deployment=deployment,
+            detector=detector,
+        ) as services:
+            url = f"http://127.0.0.1:{services.ports['server']}/process"
+            warmup = requests.post(url, files={"image": ("warmup.jpg", images[0])})
+            warmup.raise_for_status()
+
+            def call(data):
+                started = time.perf_counter()
+                response = requests.post(url, files={"image": ("shelf.jpg", data)})
+                response.raise_for_status()
+                elapsed = time.perf_counter() - started
+                counts = response.json()["metadata"]["cluster_counts"]
+                return elapsed, sum(counts.values())
+
+            work = [data for data in images for _ in range(requests_per_image)]
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                results = list(pool.map(call, work))
+            wall = time.perf_counter() - started
+            rss = services.peak_rss_mb()
+
+    # Boxes are counted from the responses, since the model detector finds
+    # its own rather than the synthetic ones.
+    return {
+        "timings": [elapsed for elapsed, _ in results],
+        "wall": wall,
+        "peak_rss_mb": rss,
+        "boxes": sum(boxes for _, boxes in results) / len(results),
+    }
@@ -0,0 +1,203 @@
+import os
+import resource
+import sys
+import time
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_service(service):
+    # Each service is a separate app with its own top-level `src` package, so
+    # a stage runs in a fresh process with only that service on the path.
+    os.environ.setdefault(f"{service.upper()}_LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.join(ROOT, service, "app"))
+
+
+def _grouper_cluster(shelf):
+    from PIL import Image
+    from sklearn.metrics import adjusted_rand_score
+    from src.blueprints.grouper import (
+        cluster_features,
+        extract_crop_features,
+        extract_crop_features_pil,
+        reduce_features,
+        settings,
+    )
+
+    def run():
+        if len(shelf.boxes) >= settings.vectorized_min_boxes:
+            X, _ = extract_crop_features(
+                shelf.image, shelf.boxes, settings.downsample_resolution
+            )
+        else:
+            X, _ = extract_crop_features_pil(
+                Image.fromarray(shelf.image),
+                shelf.boxes,
+                settings.downsample_resolution,
+            )
+        X = reduce_features(X, settings.feature_reduction, settings.reduced_dim)
+        return cluster_features(X, settings.clustering_backend)
+
+    def extra(labels):
+        return {"ari": float(adjusted_rand_score(shelf.labels, labels))}
+
+    return run, extra
+
+
+def _luminance_exact(shelf):
+    from PIL import Image
+    from src.blueprints.grouper import normalize_luminance, settings
+
+    image = Image.fromarray(shelf.image)
+    return lambda: normalize_luminance(image, settings.apply_clahe), None
+
+
+def _luminance_fast(shelf):
+    from src.blueprints.grouper import normalize_luminance_fast, settings
+
+    def run():
+        return normalize_luminance_fast(
+            shelf.image, settings.apply_clahe, settings.luminance_downscale
+        )
+
+    return run, None
+
+
+def _merge(shelf):
+    from benchmarks.synthetic import detections_for
+    from src.blueprints.server import merge_grouped_boxes, settings
+
+    detections, products = detections_for(shelf)
+    for d, product in zip(detections, products):
+        d["label"] = f"cluster_{product}"
+
+    def run():
+        return merge_grouped_boxes(detections, settings.merge_iou_threshold)
+
+    def extra(merged):
+        return {"detections": len(detections), "merged": len(merged)}
+
+    return run, extra
+
+
+def _wire(packed, embedding_dim=0):
+    # Serialization of one image's detections over the three hops: detector
+    # response, grouper request and grouper response, each encoded by the
+    # sender and decoded by the receiver.
+    def build(shelf):
+        import json
+        from src.util.wire import decode_array, encode_array, pack, unpack
+
+        rng = np.random.default_rng(0)
+        count = len(shelf.boxes)
+        boxes = np.asarray(shelf.boxes, np.float32)
+        scores = rng.uniform(0.8, 1.0, count).astype(np.float32)
+        clusters = np.asarray(shelf.labels, np.int64)
+        embeddings = None
+        if embedding_dim:
+            embeddings = rng.standard_normal((count, embedding_dim))
+            embeddings = embeddings.astype(np.float16)
+
+        def run_packed():
+            arrays = {
+                "scores": scores,
+                "labels": np.zeros(count, np.int32),
+                "boxes": boxes,
+            }
+            if embeddings is not None:
+                arrays["embeddings"] = embeddings
+            detected = pack(arrays, {"label_names": ["object", "empty"]})
+            received, _ = unpack(detected)
+            request = {"boxes": received["boxes"]}
+            if embeddings is not None:
+                request["embeddings"] = received["embeddings"]
+            request = pack(request)
+            unpack(request)
+            response = pack({"clusters": clusters})
+            labels = unpack(response)[0]["clusters"].tolist()
+            return labels, len(detected) + len(request) + len(response)
+
+        def run_json():
+            bboxes = np.round(boxes.astype(np.float64), 2).tolist()
+            body = {
+                "detections": [
+                    {"label": "object", "score": score, "bbox": box}
+                    for score, box in zip(np.round(scores, 3).tolist(), bboxes)
+                ]
+            }
+            if embeddings is not None:
+                body["embeddings"] = encode_array(embeddings)
+            detected = json.dumps(body)
+            received = json.loads(detected)
+            received_boxes = np.array(
+                [d["bbox"] for d in received["detections"]], np.float32
+            )
+            request = {"detections": json.dumps([{"bbox": box} for box in bboxes])}
+            if embeddings is not None:
+                request["embeddings"] = json.dumps(
+                    encode_array(decode_array(received["embeddings"]))
+                )
+            grouped = json.loads(request["detections"])
+            if embeddings is not None:
+                decode_array(json.loads(request["embeddings"]))
+            for d, cid in zip(grouped, clusters.tolist()):
+                d["label"] = f"cluster_{cid}" if cid != -1 else "noise"
+            response = json.dumps({"detections": grouped})
+            labels = [d["label"] for d in json.loads(response)["detections"]]
+            size = len(detected) + sum(map(len, request.values())) + len(response)
+            assert len(received_boxes) == len(labels)
+            return labels, size
+
+        def extra(result):
+            return {"payload_kb": result[1] / 1024}
+
+        return (run_packed if packed else run_json), extra
+
+    return build
+
+
+STAGES = {
+    "grouper_cluster": ("grouper", _grouper_cluster),
+    "luminance_exact": ("grouper", _luminance_exact),
+    "luminance_fast": ("grouper", _luminance_fast),
+    "merge": ("server", _merge),
+    "wire_json": ("server", _wire(False)),
+    "wire_packed": ("server", _wire(True)),
+    "wire_json_embeddings": ("server", _wire(False, 256)),
+    "wire_packed_embeddings": ("server", _wire(True, 256)),
+}
+
+
+def run_stage(name, case, seeds, repeats):
+    # Entry point of the child process: times `name` on one synthetic shelf
+    # per seed, after one warm-up run, and reports the process's peak RSS.
+    from benchmarks.synthetic import generate_shelf
+
+    service, build = STAGES[name]
+    _import_service(service)
+
+    timings, extras, boxes = [], [], []
+    for seed in seeds:
+        shelf = generate_shelf(seed=seed, **case)
+        run, extra = build(shelf)
+        run()
+        for _ in range(repeats):
+            started = time.perf_counter()
+            result = run()
+            timings.append(time.perf_counter() - started)
+        boxes.append(len(shelf.boxes))
+        if extra is not None:
+            extras.append(extra(result))
+
+    summary = {}
+    for key in extras[0] if extras else []:
+        summary[key] = float(np.mean([e[key] for e in extras]))
+    return {
+        "timings": timings,
+        "boxes": float(np.mean(boxes)),
+        "extra": summary,
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / (1024 * 1024 if sys.platform == "darwin" else 1024),
+    }
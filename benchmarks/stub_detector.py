@@ -0,0 +1,45 @@
+import argparse
+import hashlib
+import json
+import time
+from flask import Flask, jsonify, request
+
+
+def create_app(manifest, latency):
+    # Stands in for the DETR detector: answers /detect with the synthetic
+    # detections recorded for the uploaded image's SHA-256.
+    app = Flask("stub-detector")
+
+    @app.route("/detect", methods=["POST"])
+    def detect():
+        if "image" not in request.files:
+            return jsonify({"error": "No image provided"}), 400
+        key = hashlib.sha256(request.files["image"].read()).hexdigest()
+        if key not in manifest:
+            return jsonify({"error": "Unknown benchmark image"}), 400
+        if latency:
+            time.sleep(latency)
+        return jsonify({"detections": manifest[key]})
+
+    @app.route("/config", methods=["GET"])
+    def config():
+        return jsonify({"stub": True, "latency": latency})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub detector for benchmarks")
+    parser.add_argument("--manifest", required=True)
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with open(args.manifest, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    app = create_app(manifest, args.latency_ms / 1000)
+    app.run(host="127.0.0.1", port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+from dataclasses import dataclass
+import numpy as np
+from PIL import Image
+
+
+@dataclass
+class Shelf:
+    image: np.ndarray
+    boxes: list
+    labels: list
+    products: int
+
+
+def _product_template(rng, aspect):
+    # A packaging design at a fixed reference size: body colour, a label band,
+    # a "logo" block and a shading gradient, so repeated facings of the same
+    # product look alike and different products do not.
+    height = 96
+    width = max(8, int(height * aspect))
+    template = np.empty((height, width, 3), np.float32)
+    template[:] = rng.integers(20, 236, 3)
+
+    band_top = rng.integers(height // 4, height // 2)
+    band_height = rng.integers(height // 8, height // 4)
+    template[band_top : band_top + band_height] = rng.integers(0, 256, 3)
+
+    logo_w, logo_h = max(2, width // 2), max(2, height // 6)
+    logo_x = rng.integers(0, width - logo_w + 1)
+    logo_y = rng.integers(0, max(1, band_top - logo_h))
+    template[logo_y : logo_y + logo_h, logo_x : logo_x + logo_w] = rng.integers(
+        0, 256, 3
+    )
+
+    template *= np.linspace(0.75, 1.0, width)[None, :, None]
+    return np.clip(template, 0, 255).astype(np.uint8)
+
+
+def generate_shelf(
+    seed=0,
+    width=2000,
+    height=1500,
+    products=8,
+    density=0.85,
+    shelves=None,
+    noise=4.0,
+):
+    # Deterministic synthetic shelf photo for `seed`. `products` distinct
+    # SKUs are placed in runs of facings along each shelf; `density` is the
+    # chance that a slot holds a product rather than a gap. Returns the image
+    # with a ground-truth box and product index per facing.
+    rng = np.random.default_rng(seed)
+    shelves = shelves or max(2, round(height / 200))
+    aspects = rng.uniform(0.35, 0.9, products)
+    templates = [_product_template(rng, aspect) for aspect in aspects]
+
+    image = np.empty((height, width, 3), np.float32)
+    image[:] = rng.integers(170, 220, 3)
+
+    row_height = height / shelves
+    board = max(4, int(row_height * 0.06))
+    boxes, labels = [], []
+    for row in range(shelves):
+        top, bottom = int(row * row_height), int((row + 1) * row_height) - board
+        image[bottom : bottom + board] = 60
+
+        product_height = int((bottom - top) * rng.uniform(0.7, 0.85))
+        resized = [
+            np.asarray(
+                Image.fromarray(t).resize(
+                    (max(4, int(product_height * a)), product_height), Image.BILINEAR
+                )
+            )
+            for t, a in zip(templates, aspects)
+        ]
+
+        x = int(rng.integers(0, max(1, width // 50)))
+        row_full = False
+        while not row_full:
+            product = int(rng.integers(products))
+            for _ in range(int(rng.integers(2, 6))):
+                w = resized[product].shape[1]
+                if x + w > width:
+                    row_full = True
+                    break
+                if rng.random() < density:
+                    y = bottom - product_height
+                    image[y:bottom, x : x + w] = resized[product]
+                    boxes.append([float(x), float(y), float(x + w), float(bottom)])
+                    labels.append(product)
+                x += w + int(rng.integers(1, max(2, w // 10)))
+
+    # Uneven lighting and sensor noise, which luminance normalization removes.
+    image *= np.linspace(0.6, 1.1, width)[None, :, None]
+    image *= np.linspace(0.85, 1.0, height)[:, None, None]
+    image += rng.normal(0, noise, image.shape)
+    return Shelf(np.clip(image, 0, 255).astype(np.uint8), boxes, labels, products)
+
+
+def detections_for(shelf, seed=0, duplicates=0.3, jitter=0.03):
+    # Detector-like output for a shelf: every ground-truth box, plus jittered
+    # duplicates for a fraction of them, as DETR tends to emit. Also returns
+    # the product index of each detection.
+    rng = np.random.default_rng(seed)
+    detections, products = [], []
+    for box, product in zip(shelf.boxes, shelf.labels):
+        detections.append({"label": "object", "score": 0.95, "bbox": box})
+        products.append(product)
+        if rng.random() < duplicates:
+            w, h = box[2] - box[0], box[3] - box[1]
+            offset = rng.uniform(-jitter, jitter, 4) * [w, h, w, h]
+            detections.append(
+                {
+                    "label": "object",
+                    "score": 0.85,
+                    "bbox": [round(float(v), 2) for v in np.add(box, offset)],
+                }
+            )
+            products.append(product)
+    return detections, products
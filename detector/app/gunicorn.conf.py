@@ -0,0 +1,25 @@
+import gc
+from src.util.settings import Settings
+
+settings = Settings()
+
+workers = settings.workers
+threads = settings.worker_threads
+preload_app = settings.preload_model
+# Model loading and warm-up can take well over gunicorn's default 30s.
+timeout = 300
+
+
+def when_ready(server):
+    # Objects created while loading the model are moved out of the garbage
+    # collector's reach, so collections in the workers do not write to (and
+    # un-share) the pages they live on.
+    if preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        from src.blueprints.detector import start_worker
+
+        start_worker()
@@ -1,6 +1,7 @@
 from flask import Flask
-from src.blueprints.detector import detector_bp
+from src.blueprints.detector import detector_bp, start_worker
 from src.util.logger import get_logger
+from src.util.metrics import init_app as init_metrics
 from src.util.settings import Settings
 
 settings = Settings()
@@ -8,7 +9,9 @@ logger = get_logger(__name__)
 
 app = Flask(__name__)
 app.register_blueprint(detector_bp, url_prefix="/")
+init_metrics(app)
 logger.info("Blueprint registered and app created.")
 
 if __name__ == "__main__":
+    start_worker()
     app.run(host=settings.host, port=settings.port, debug=settings.debug)
@@ -1,74 +1,493 @@
-from io import BytesIO
-from flask import Blueprint, request, jsonify
-from transformers import DetrImageProcessor, DetrForObjectDetection
-from PIL import Image, ImageOps, UnidentifiedImageError
-from src.util.logger import get_logger
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import logging
+import os
+import threading
+from flask import Blueprint, Response, request, jsonify
+from PIL import Image, UnidentifiedImageError
+import numpy as np
+from src.util.backends import build_backend, configure_threads
+from src.util.batching import MicroBatcher
+from src.util.image_store import ImageStore
+from src.util.logger import get_logger, log_limited
+from src.util.metrics import register_callback, timed
+from src.util.preprocess import (
+    TensorPreprocessor,
+    decode,
+    detection_arrays,
+    embedding_array,
+    format_detections,
+    frame_from_array,
+    kept_embeddings,
+    postprocess,
+)
+from src.util.settings import Settings
+from src.util.wire import ARRAYS_MIMETYPE, accepts_arrays, encode_array, pack
 import torch
 
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
 detector_bp = Blueprint("detector", __name__)
 logger = get_logger(__name__)
+settings = Settings()
+image_store = ImageStore(settings.image_store_dir)
 
-try:
-    processor: DetrImageProcessor = DetrImageProcessor.from_pretrained(
-        "facebook/detr-resnet-50", revision="no_timm"
-    )
-    model = DetrForObjectDetection.from_pretrained("isalia99/detr-resnet-50-sku110k")
-    model.eval()
+# With DETECTOR_PRELOAD_MODEL the weights are loaded once in the gunicorn
+# master and shared copy-on-write by the forked workers. The master stays
+# single-threaded and never moves the model to a GPU or runs a forward pass,
+# because neither OpenMP thread pools nor CUDA contexts survive fork.
+processor = None
+model = None
+device = None
+label_names = None
+
+
+def load_model():
+    # Processor and weights from the snapshot in DETECTOR_MODEL_DIR when one
+    # was baked into the image, otherwise from the Hugging Face hub (or its
+    # local cache). transformers is imported here rather than at module load
+    # so that the service can answer /healthz while it is still loading.
+    global processor, model, device, label_names
+    from transformers import DetrForObjectDetection, DetrImageProcessor
+
+    try:
+        if settings.model_dir:
+            processor = DetrImageProcessor.from_pretrained(
+                os.path.join(settings.model_dir, "processor"), local_files_only=True
+            )
+            model = DetrForObjectDetection.from_pretrained(
+                os.path.join(settings.model_dir, "model"), local_files_only=True
+            )
+        else:
+            processor = DetrImageProcessor.from_pretrained(
+                "facebook/detr-resnet-50", revision="no_timm"
+            )
+            model = DetrForObjectDetection.from_pretrained(
+                "isalia99/detr-resnet-50-sku110k"
+            )
+        model.eval()
+
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        logger.info("Detection model and processor loaded successfully")
+
+        label_names = np.array(
+            [
+                model.config.id2label.get(i, str(i))
+                for i in range(model.config.num_labels)
+            ],
+            dtype=object,
+        )
+
+    except Exception as e:
+        logger.exception("Failed to load DETR model or processor: %s", e)
+        raise RuntimeError("Model initialization failed") from e
+
+
+if settings.preload_model:
+    torch.set_num_threads(1)
+    load_model()
+else:
+    configure_threads()
+
+
+def infer_reference(frames, embeddings=False):
+    # DetrImageProcessor path, kept for DETECTOR_FAST_PREPROCESSING=false.
+    with timed("preprocess"):
+        images = [Image.fromarray(frame.pixels) for frame in frames]
+        inputs = processor(images=images, return_tensors="pt")
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+
+    with timed("forward"):
+        outputs = backend(inputs)
+
+    with timed("postprocess"):
+        target_sizes = torch.tensor([frame.size[::-1] for frame in frames])
+        results = processor.post_process_object_detection(
+            outputs,
+            target_sizes=target_sizes.to(device),
+            threshold=settings.detection_threshold,
+        )
+        hidden = None
+        if embeddings:
+            hidden = kept_embeddings(outputs, settings.detection_threshold)
+        return [
+            torch.cat(
+                [r["scores"][:, None], r["labels"][:, None].float(), r["boxes"]]
+                + ([hidden[i]] if hidden is not None else []),
+                1,
+            )
+            .cpu()
+            .numpy()
+            .astype(np.float64)
+            for i, r in enumerate(results)
+        ]
+
+
+def infer(frames, embeddings=False):
+    # One (score, label, x0, y0, x1, y1[, embedding...]) array per frame, in
+    # frame.size coordinates. The embedding columns are only added when
+    # asked for, as 256 of them per box would dwarf the rest.
+    if not settings.fast_preprocessing:
+        return infer_reference(frames, embeddings)
+
+    with timed("preprocess"):
+        inputs = preprocessor(frames)
+
+    with timed("forward"):
+        outputs = backend(inputs)
+
+    with timed("postprocess"):
+        return postprocess(
+            outputs,
+            [frame.size for frame in frames],
+            settings.detection_threshold,
+            embeddings,
+        )
+
+
+def run_detection(items):
+    # Rows for a batch of (frame, embeddings) items. A batch computes the
+    # embeddings if any of its requests wants them, and the others get the
+    # rows without them.
+    wanted = [embeddings for _, embeddings in items]
+    results = infer([frame for frame, _ in items], any(wanted))
+    return [rows if want else rows[:, :6] for rows, want in zip(results, wanted)]
+
+
+def tile_origins(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    stride = max(1, tile_size - overlap)
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)
+    return origins
+
+
+def overlapping_spans(origins, size):
+    # (i, j, start, end) for every pair of tile origins i <= j whose spans
+    # share [start, end).
+    return [
+        (i, j, origins[j], origins[i] + size)
+        for i in range(len(origins))
+        for j in range(i, len(origins))
+        if origins[j] < origins[i] + size
+    ]
+
+
+def tile_seams(xs, ys, size):
+    # (tile_a, tile_b, band) for every pair of distinct tiles that overlap,
+    # with band the (x0, y0, x1, y1) area both of them cover. Tile IDs are
+    # row-major, as in detect_tiled.
+    seams = []
+    for ci, cj, x0, x1 in overlapping_spans(xs, size):
+        for ri, rj, y0, y1 in overlapping_spans(ys, size):
+            band = (x0, y0, x1, y1)
+            if (ci, ri) != (cj, rj):
+                seams.append((ri * len(xs) + ci, rj * len(xs) + cj, band))
+            if ci != cj and ri != rj:
+                seams.append((ri * len(xs) + cj, rj * len(xs) + ci, band))
+    return seams
+
+
+def merge_tile_detections(boxes, scores, tile_ids, seams, threshold):
+    # Indices of the boxes to keep after removing duplicates across tile
+    # seams. Only boxes of two overlapping tiles that reach into their shared
+    # band are compared, so interior boxes are never touched and each
+    # comparison is bounded by the query count of two tiles, whatever the
+    # image size. Overlap is intersection over the smaller box, so that a box
+    # truncated at a seam is matched to the full box seen by the neighbour.
+    # Within a seam, a box is dropped when a higher-scoring box of the other
+    # tile overlaps it (ties go to the first tile).
+    keep = np.ones(len(boxes), dtype=bool)
+    bounds = np.searchsorted(tile_ids, np.arange(tile_ids.max(initial=-1) + 2))
+    area = np.clip(boxes[:, 2:] - boxes[:, :2], 0, None).prod(axis=1)
+
+    def in_band(tile, band):
+        index = np.arange(bounds[tile], bounds[tile + 1])
+        b = boxes[index]
+        inside = (b[:, 2] > band[0]) & (b[:, 0] < band[2])
+        inside &= (b[:, 3] > band[1]) & (b[:, 1] < band[3])
+        return index[inside]
+
+    for tile_a, tile_b, band in seams:
+        a, b = in_band(tile_a, band), in_band(tile_b, band)
+        if not len(a) or not len(b):
+            continue
+        top_left = np.maximum(boxes[a, None, :2], boxes[None, b, :2])
+        bottom_right = np.minimum(boxes[a, None, 2:], boxes[None, b, 2:])
+        inter = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+        smaller = np.maximum(np.minimum(area[a, None], area[None, b]), 1e-6)
+        duplicate = inter / smaller >= threshold
+        b_wins = scores[None, b] > scores[a, None]
+        keep[a[(duplicate & b_wins).any(axis=1)]] = False
+        keep[b[(duplicate & ~b_wins).any(axis=0)]] = False
+    return np.flatnonzero(keep)
+
+
+def detect_tiled(frame, embeddings=False):
+    # Rows as returned by infer, whose threshold already drops low-scoring
+    # boxes in every tile before the merge.
+    height, width = frame.pixels.shape[:2]
+    size, overlap = settings.tile_size, settings.tile_overlap
+    xs = tile_origins(width, size, overlap)
+    ys = tile_origins(height, size, overlap)
+    tiles = [(x, y) for y in ys for x in xs]
+
+    rows, tile_ids = [], []
+    for start in range(0, len(tiles), settings.tile_batch_size):
+        chunk = tiles[start:start + settings.tile_batch_size]
+        crops = [
+            frame_from_array(frame.pixels[y:y + size, x:x + size])
+            for x, y in chunk
+        ]
+
+        for tile_id, (x, y), result in zip(
+            range(start, start + len(chunk)), chunk, infer(crops, embeddings)
+        ):
+            result[:, 2:6] += [x, y, x, y]
+            rows.append(result)
+            tile_ids.append(np.full(len(result), tile_id))
+
+    rows, tile_ids = np.concatenate(rows), np.concatenate(tile_ids)
+    with timed("tile_merge"):
+        keep = merge_tile_detections(
+            rows[:, 2:6],
+            rows[:, 0],
+            tile_ids,
+            tile_seams(xs, ys, size),
+            settings.tile_merge_threshold,
+        )
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
     logger.info(
-        "Detection model and processor loaded successfully on device: %s", device
+        "Tiled detection over %d tiles: %d raw boxes, %d after merging",
+        len(tiles),
+        len(rows),
+        len(keep),
     )
+    return rows[keep]
+
+
+def detect_frame(frame, tiled, timeout=None, embeddings=False):
+    # Detection rows for one frame, as returned by infer: tiled when asked for
+    # and the frame is large enough, through the micro-batcher when enabled.
+    if tiled and max(frame.size) > settings.tile_size:
+        return detect_tiled(frame, embeddings)
+    if batcher is not None:
+        with timed("batch"):
+            return batcher.run((frame, embeddings), timeout)
+    return run_detection([(frame, embeddings)])[0]
+
+
+def request_timeout():
+    # Remaining time budget propagated by the server, if any.
+    try:
+        return max(0.0, float(request.headers[DEADLINE_HEADER]) / 1000)
+    except (KeyError, ValueError):
+        return None
+
+
+backend = None
+preprocessor = None
+batcher = None
+_ready = threading.Event()
+_init_error = None
+_start_lock = threading.Lock()
+_started = False
+
+
+def init_worker():
+    # Per-process setup: model loading (unless preloaded), thread budget,
+    # device placement, inference backend with its warm-up pass, and the
+    # micro-batcher thread.
+    global backend, preprocessor, batcher
+    if model is None:
+        load_model()
+    if settings.preload_model:
+        configure_threads()
+    model.to(device)
+    logger.info("Detection model ready on device: %s", device)
+    preprocessor = TensorPreprocessor(processor, device)
+
+    if settings.batching_enabled:
+        batcher = MicroBatcher(
+            run_detection,
+            max_batch_size=settings.batch_max_size,
+            max_delay_ms=settings.batch_max_delay_ms,
+        )
+        logger.info(
+            "Micro-batching enabled (max_batch_size=%d, max_delay_ms=%.1f)",
+            settings.batch_max_size,
+            settings.batch_max_delay_ms,
+        )
+        register_callback(
+            "sku_vision_batch_queue_depth",
+            "Images waiting for the micro-batcher.",
+            (),
+            lambda: {(): batcher.stats()["queue_depth"]},
+        )
+
+    # Assigned last: a non-None backend means the worker is ready.
+    backend = build_backend(model, device)
+
+
+def _run_init(raise_errors):
+    global _init_error
+    try:
+        init_worker()
+    except Exception as e:
+        logger.exception("Detector initialization failed: %s", e)
+        _init_error = e
+        if raise_errors:
+            raise
+    finally:
+        _ready.set()
+
+
+def start_worker():
+    # Runs init_worker once per process. With DETECTOR_BACKGROUND_WARMUP it
+    # runs on a background thread, so the worker answers /healthz while the
+    # model loads and warms up and /readyz turns 200 when it is done. Called
+    # from gunicorn's post_fork hook when the model is preloaded, at import
+    # time otherwise, and by the first request as a fallback.
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+
+    if settings.background_warmup:
+        threading.Thread(
+            target=_run_init, args=(False,), name="detector-init", daemon=True
+        ).start()
+    else:
+        _run_init(True)
 
-except Exception as e:
-    logger.exception("Failed to load DETR model or processor: %s", e)
-    raise RuntimeError("Model initialization failed") from e
+
+def wait_ready(timeout=None):
+    # Starts initialization if needed and waits up to `timeout` seconds for
+    # it. False if the model is still loading or failed to load.
+    start_worker()
+    return _ready.wait(timeout) and _init_error is None
+
+
+def config_values():
+    # Settings that change the detections, keyed into the server's caches.
+    return {
+        "detection_threshold": settings.detection_threshold,
+        "tiling_enabled": settings.tiling_enabled,
+        "tile_size": settings.tile_size,
+        "tile_overlap": settings.tile_overlap,
+        "tile_merge_threshold": settings.tile_merge_threshold,
+        "fast_preprocessing": settings.fast_preprocessing,
+    }
+
+
+if not settings.preload_model:
+    start_worker()
 
 
 @detector_bp.route("/detect", methods=["POST"])
 def detect():
+    if backend is None and not wait_ready(request_timeout()):
+        return jsonify({"error": "Model not ready"}), 503
     try:
-        if "image" not in request.files:
-            logger.warning("No image part in the request")
-            return jsonify({"error": "No image provided"}), 400
+        tiled = request.form.get("tiled", str(settings.tiling_enabled)).lower()
+        tiled = tiled in ("1", "true", "yes")
+        embeddings = request.form.get("embeddings", "false").lower()
+        embeddings = embeddings in ("1", "true", "yes")
 
-        file = request.files["image"]
+        if "image_id" in request.form:
+            try:
+                with timed("load"):
+                    pixels = image_store.get(request.form["image_id"])
+            except ValueError:
+                return jsonify({"error": "Invalid image_id"}), 400
+            if pixels is None:
+                logger.warning("Image %s not found in store", request.form["image_id"])
+                return jsonify({"error": "Unknown image_id"}), 404
+            frame = frame_from_array(pixels)
 
-        try:
-            image = Image.open(BytesIO(file.read())).convert("RGB")
-            image = ImageOps.exif_transpose(image)
-        except UnidentifiedImageError:
-            logger.warning("Invalid image file received")
-            return jsonify({"error": "Invalid image file"}), 400
+        elif "image" in request.files:
+            file = request.files["image"]
+            try:
+                with timed("decode"):
+                    # Tiling needs full resolution; the whole-image path only
+                    # needs enough pixels for the model input.
+                    data = file.read()
+                    if tiled or not settings.fast_preprocessing:
+                        frame = decode(data)
+                    else:
+                        frame = decode(
+                            data,
+                            preprocessor.shortest_edge,
+                            preprocessor.longest_edge,
+                        )
+            except UnidentifiedImageError:
+                logger.warning("Invalid image file received")
+                return jsonify({"error": "Invalid image file"}), 400
 
-        inputs = processor(images=image, return_tensors="pt")
-        inputs = {k: v.to(device) for k, v in inputs.items()}
+        else:
+            logger.warning("No image part in the request")
+            return jsonify({"error": "No image provided"}), 400
 
-        with torch.no_grad():
-            outputs = model(**inputs)
+        rows = detect_frame(frame, tiled, request_timeout(), embeddings)
 
-        target_sizes = torch.tensor([image.size[::-1]]).to(device)
-        results = processor.post_process_object_detection(
-            outputs, target_sizes=target_sizes, threshold=0.8
-        )[0]
+        logger.info("Detected %d objects", len(rows))
+        with timed("serialize"):
+            query_embeddings = embedding_array(rows) if embeddings else None
+            if embeddings and query_embeddings is None:
+                logger.warning("Backend does not return query embeddings")
 
-        detections = []
-        for score, label, box in zip(
-            results["scores"], results["labels"], results["boxes"]
-        ):
-            box = [round(i, 2) for i in box.tolist()]
-            detections.append(
-                {
-                    "label": model.config.id2label[label.item()],
-                    "score": round(score.item(), 3),
-                    "bbox": box,
-                }
-            )
+            if accepts_arrays(request.accept_mimetypes):
+                arrays = detection_arrays(rows)
+                if query_embeddings is not None:
+                    arrays["embeddings"] = query_embeddings
+                return Response(
+                    pack(arrays, {"label_names": label_names.tolist()}),
+                    mimetype=ARRAYS_MIMETYPE,
+                )
+
+            response = {"detections": format_detections(rows, label_names)}
+            if query_embeddings is not None:
+                response["embeddings"] = encode_array(query_embeddings)
+            return jsonify(response)
 
-        logger.info("Detected %d objects", len(detections))
-        return jsonify({"detections": detections})
+    except FutureTimeoutError:
+        # Comes in floods when the detector falls behind.
+        log_limited(
+            logger,
+            logging.WARNING,
+            "Request deadline exceeded while queued for inference",
+        )
+        return jsonify({"error": "Request deadline exceeded"}), 504
 
     except Exception as e:
         logger.exception("Unexpected error in /detect: %s", e)
         return jsonify({"error": "Internal server error"}), 500
+
+
+@detector_bp.route("/healthz", methods=["GET"])
+def healthz():
+    # Liveness: fails only if initialization failed, so the container is
+    # restarted rather than left running without a model.
+    if _init_error is not None:
+        return jsonify({"status": "failed", "error": str(_init_error)}), 500
+    return jsonify({"status": "ok"})
+
+
+@detector_bp.route("/readyz", methods=["GET"])
+def readyz():
+    if backend is None:
+        return jsonify({"status": "loading"}), 503
+    return jsonify({"status": "ready"})
+
+
+@detector_bp.route("/stats", methods=["GET"])
+def stats():
+    if batcher is None:
+        return jsonify({"batching_enabled": False})
+    return jsonify({"batching_enabled": True, **batcher.stats()})
+
+
+@detector_bp.route("/config", methods=["GET"])
+def config():
+    return jsonify(config_values())
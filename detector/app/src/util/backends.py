@@ -0,0 +1,278 @@
+import hashlib
+import os
+import time
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+from src.util.logger import get_logger
+from src.util.settings import Settings
+
+logger = get_logger(__name__)
+settings = Settings()
+
+BACKENDS = ("eager", "quantized", "compiled", "onnx")
+
+# Side of the parity and warm-up input, and the ImageNet normalization the
+# DETR processor applies.
+PARITY_SIZE = 800
+_IMAGE_MEAN = (0.485, 0.456, 0.406)
+_IMAGE_STD = (0.229, 0.224, 0.225)
+
+
+class TorchBackend:
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, inputs):
+        with torch.no_grad():
+            return self.model(**inputs)
+
+
+class OnnxBackend:
+    def __init__(self, session, device):
+        self.session = session
+        self.device = device
+
+    def __call__(self, inputs):
+        from transformers.models.detr.modeling_detr import DetrObjectDetectionOutput
+
+        # Exports made before query embeddings were added have no
+        # last_hidden_state output.
+        names = [o.name for o in self.session.get_outputs()]
+        feeds = {
+            "pixel_values": inputs["pixel_values"].cpu().numpy(),
+            "pixel_mask": inputs["pixel_mask"].cpu().numpy().astype("int64"),
+        }
+        values = self.session.run(names, feeds)
+        return DetrObjectDetectionOutput(
+            **{
+                name: torch.from_numpy(value).to(self.device)
+                for name, value in zip(names, values)
+            }
+        )
+
+
+class _DetrOnnxWrapper(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values, pixel_mask):
+        outputs = self.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+        return outputs.logits, outputs.pred_boxes, outputs.last_hidden_state
+
+
+# PyTorch's default intra-op thread count for this machine, read at import,
+# before a preloading master pins itself to one thread.
+_DEFAULT_THREADS = torch.get_num_threads()
+
+
+def thread_budget():
+    # Intra-op threads for this process: DETECTOR_NUM_THREADS if set, else the
+    # library default split evenly across gunicorn workers so that they do not
+    # oversubscribe the CPU. One worker gets the whole default.
+    if settings.num_threads > 0:
+        return settings.num_threads
+    return max(1, _DEFAULT_THREADS // max(1, settings.workers))
+
+
+def configure_threads():
+    torch.set_num_threads(thread_budget())
+    if settings.num_interop_threads > 0:
+        torch.set_num_interop_threads(settings.num_interop_threads)
+    logger.info(
+        "Torch threads: intra-op=%d, inter-op=%d",
+        torch.get_num_threads(),
+        torch.get_num_interop_threads(),
+    )
+
+
+def _export_onnx(model, sample):
+    path = settings.onnx_model_path
+    if os.path.exists(path):
+        logger.info("Using existing ONNX export at %s", path)
+        return path
+
+    # Exported under a temporary name, since several workers may start at
+    # once and must not load a half-written file.
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    logger.info("Exporting detection model to ONNX at %s", path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.onnx.export(
+        _DetrOnnxWrapper(model).cpu(),
+        (sample["pixel_values"].cpu(), sample["pixel_mask"].cpu()),
+        tmp_path,
+        input_names=["pixel_values", "pixel_mask"],
+        output_names=["logits", "pred_boxes", "last_hidden_state"],
+        dynamic_axes={
+            "pixel_values": {0: "batch", 2: "height", 3: "width"},
+            "pixel_mask": {0: "batch", 1: "height", 2: "width"},
+            "logits": {0: "batch"},
+            "pred_boxes": {0: "batch"},
+            "last_hidden_state": {0: "batch"},
+        },
+        opset_version=17,
+    )
+    os.replace(tmp_path, path)
+    return path
+
+
+def _build(model, device, name, sample):
+    if name == "eager":
+        return TorchBackend(model)
+
+    if name == "quantized":
+        if device.type != "cpu":
+            raise ValueError("Dynamic int8 quantization is only supported on CPU")
+        quantized = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        return TorchBackend(quantized)
+
+    if name == "compiled":
+        return TorchBackend(torch.compile(model, dynamic=True))
+
+    if name == "onnx":
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ValueError("The onnx backend requires onnxruntime") from e
+
+        path = _export_onnx(model, sample)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = thread_budget()
+        if settings.num_interop_threads > 0:
+            options.inter_op_num_threads = settings.num_interop_threads
+        session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        return OnnxBackend(session, device)
+
+    raise ValueError(
+        f"Unknown inference backend '{name}', expected one of {BACKENDS}"
+    )
+
+
+def parity_inputs():
+    # Model inputs for a synthetic shelf photo: rows of shelves stacked with
+    # labelled packs of varying size and colour. Products give the check
+    # confident detections to compare, which random noise does not.
+    rng = np.random.default_rng(0)
+    image = Image.new("RGB", (PARITY_SIZE, PARITY_SIZE), (235, 235, 230))
+    draw = ImageDraw.Draw(image)
+    shelf = PARITY_SIZE // 5
+    for top in range(0, PARITY_SIZE, shelf):
+        floor = top + shelf - 12
+        draw.rectangle([0, floor, PARITY_SIZE, top + shelf], fill=(90, 90, 95))
+        x = int(rng.integers(2, 20))
+        while x < PARITY_SIZE - 90:
+            width = int(rng.integers(40, 90))
+            height = int(rng.integers(shelf // 2, shelf - 24))
+            color = tuple(int(c) for c in rng.integers(30, 230, 3))
+            label = tuple(255 - c for c in color)
+            draw.rectangle(
+                [x, floor - height, x + width, floor], fill=color, outline=(20, 20, 20)
+            )
+            draw.rectangle(
+                [x + 6, floor - height * 2 // 3, x + width - 6, floor - height // 3],
+                fill=label,
+            )
+            x += width + int(rng.integers(2, 10))
+
+    pixels = torch.from_numpy(np.asarray(image, dtype=np.float32) / 255)
+    pixels = (pixels - torch.tensor(_IMAGE_MEAN)) / torch.tensor(_IMAGE_STD)
+    return {
+        "pixel_values": pixels.permute(2, 0, 1).unsqueeze(0).contiguous(),
+        "pixel_mask": torch.ones(1, PARITY_SIZE, PARITY_SIZE, dtype=torch.long),
+    }
+
+
+def model_revision(model):
+    # Short digest of the weights, so that any new checkpoint, from the hub
+    # or a baked snapshot, gets its own parity reference.
+    digest = hashlib.sha256()
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode("utf-8"))
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def reference_path(revision, device, name):
+    return os.path.join(
+        settings.parity_reference_dir, f"{revision}-{device.type}-{name}.pt"
+    )
+
+
+def eager_reference(model, device):
+    # Eager outputs for parity_inputs(), compared against other backends.
+    inputs = {k: v.to(device) for k, v in parity_inputs().items()}
+    with torch.no_grad():
+        outputs = model(**inputs)
+    return {"logits": outputs.logits.cpu(), "pred_boxes": outputs.pred_boxes.cpu()}
+
+
+def save_reference(reference, path):
+    # Written under a temporary name, like the ONNX export, since several
+    # workers may create the same reference at once.
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(reference, tmp_path)
+    os.replace(tmp_path, path)
+    logger.info("Stored eager parity reference at %s", path)
+
+
+def _load_reference(model, device, name):
+    path = reference_path(model_revision(model), device, name)
+    if os.path.exists(path):
+        logger.info("Loading parity reference from %s", path)
+        return torch.load(path)
+
+    reference = eager_reference(model, device)
+    save_reference(reference, path)
+    return reference
+
+
+def parity_error(reference, outputs):
+    scores = outputs.logits.cpu().softmax(-1)[..., :-1].max(-1).values
+    ref_scores = reference["logits"].softmax(-1)[..., :-1].max(-1).values
+    score_error = (scores - ref_scores).abs().max().item()
+    box_error = (outputs.pred_boxes.cpu() - reference["pred_boxes"]).abs().max().item()
+    return score_error, box_error
+
+
+def build_backend(model, device):
+    name = settings.inference_backend.lower()
+    needs_reference = name != "eager" and settings.parity_check
+
+    # Reference outputs are taken from the eager model before any in-place
+    # conversion such as dynamic quantization.
+    reference = _load_reference(model, device, name) if needs_reference else None
+    sample = parity_inputs()
+
+    backend = _build(model, device, name, sample)
+    inputs = {k: v.to(device) for k, v in sample.items()}
+
+    if settings.warmup_enabled or reference is not None:
+        started = time.perf_counter()
+        outputs = backend(inputs)
+        logger.info(
+            "Warm-up pass on '%s' backend took %.1f ms",
+            name,
+            (time.perf_counter() - started) * 1000,
+        )
+
+        if reference is not None:
+            score_error, box_error = parity_error(reference, outputs)
+            logger.info(
+                "Parity vs eager: max score error %.4f, max box error %.4f",
+                score_error,
+                box_error,
+            )
+            if max(score_error, box_error) > settings.parity_tolerance:
+                raise RuntimeError(
+                    f"Backend '{name}' failed parity check "
+                    f"(score error {score_error:.4f}, box error {box_error:.4f})"
+                )
+
+    logger.info("Inference backend '%s' ready", name)
+    return backend
@@ -0,0 +1,130 @@
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from queue import Queue, Empty
+from src.util.logger import get_logger
+from src.util.metrics import observe_stage
+
+logger = get_logger(__name__)
+
+
+class MicroBatcher:
+    def __init__(self, process_batch, max_batch_size=8, max_delay_ms=10.0):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_delay = max(0.0, max_delay_ms) / 1000.0
+
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._batch_size_counts = {}
+        self._batches = 0
+        self._items = 0
+        self._cancelled = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        self._worker = threading.Thread(
+            target=self._run, name="detector-batcher", daemon=True
+        )
+        self._worker.start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def run(self, item, timeout=None):
+        # Result for one item, waiting at most `timeout` seconds. A caller
+        # that times out cancels its future, so the item is skipped unless
+        # its batch has already started.
+        future = self.submit(item)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def _collect(self):
+        # Up to max_batch_size live items, waiting at most max_delay after
+        # the first. Items whose caller gave up are dropped here, and the
+        # rest are marked running so they can no longer be cancelled.
+        batch = []
+        deadline = None
+        while len(batch) < self.max_batch_size:
+            try:
+                if deadline is None:
+                    entry = self._queue.get()
+                else:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        entry = self._queue.get_nowait()
+                    else:
+                        entry = self._queue.get(timeout=remaining)
+            except Empty:
+                break
+
+            if not entry[1].set_running_or_notify_cancel():
+                with self._lock:
+                    self._cancelled += 1
+                continue
+            batch.append(entry)
+            if deadline is None:
+                deadline = time.perf_counter() + self.max_delay
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            waits = [started - enqueued for _, _, enqueued in batch]
+            self._record(len(batch), waits)
+
+            items = [item for item, _, _ in batch]
+            try:
+                results = self.process_batch(items)
+            except Exception as e:
+                logger.exception("Batch of %d failed: %s", len(batch), e)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+            logger.debug(
+                "Processed batch of %d in %.1f ms",
+                len(batch),
+                (time.perf_counter() - started) * 1000,
+            )
+
+    def _record(self, batch_size, waits):
+        with self._lock:
+            self._batches += 1
+            self._items += batch_size
+            self._batch_size_counts[batch_size] = (
+                self._batch_size_counts.get(batch_size, 0) + 1
+            )
+            self._wait_total += sum(waits)
+            self._wait_max = max(self._wait_max, max(waits))
+        for wait in waits:
+            observe_stage("batch_queue_wait", wait)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "max_delay_ms": self.max_delay * 1000,
+                "batches": self._batches,
+                "items": self._items,
+                "cancelled": self._cancelled,
+                "batch_size_histogram": dict(sorted(self._batch_size_counts.items())),
+                "mean_batch_size": (
+                    self._items / self._batches if self._batches else 0.0
+                ),
+                "mean_wait_ms": (
+                    self._wait_total / self._items * 1000 if self._items else 0.0
+                ),
+                "max_wait_ms": self._wait_max * 1000,
+            }
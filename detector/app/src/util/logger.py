@@ -1,4 +1,12 @@
+import atexit
+import json
 import logging
+import os
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
 from src.util.settings import Settings
 
 settings = Settings()
@@ -11,6 +19,119 @@ _log_levels = {
     "CRITICAL": logging.CRITICAL,
 }
 
+# Fields added to every record on the thread that logs it, by name, such as
+# the current request ID from the metrics module.
+_record_fields = {}
+
+_handler = None
+_listener = None
+_lock = threading.Lock()
+_limits = {}
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, for log shippers that index fields.
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "file": f"{record.filename}:{record.lineno}",
+        }
+        for name in _record_fields:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _BoundedQueueHandler(QueueHandler):
+    # Hands records to the writer thread. The message is interpolated here,
+    # so later changes to the arguments do not show up in the log, but the
+    # final formatting and the write happen on the writer thread. When the
+    # queue is full the record is dropped and counted rather than blocking
+    # the request.
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The stock prepare formats the whole line and copies the record on
+        # the logging thread, for handlers that pickle records. The record
+        # stays in this process and has no other handler, so only the
+        # message is rendered and the record is queued as is.
+        for name, field in _record_fields.items():
+            setattr(record, name, field())
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _ContextFilter(logging.Filter):
+    # Adds _record_fields on the synchronous handler.
+
+    def filter(self, record):
+        for name, field in _record_fields.items():
+            setattr(record, name, field())
+        return True
+
+
+def _formatter():
+    if settings.log_json:
+        return JsonFormatter()
+    return logging.Formatter(settings.log_format)
+
+
+def _start_listener():
+    # The writer thread. Also run in forked children (gunicorn --preload),
+    # which inherit the handler but not the thread.
+    global _listener
+    stream = logging.StreamHandler()
+    stream.setFormatter(_formatter())
+    _handler.queue = queue.Queue(settings.log_queue_size)
+    _listener = QueueListener(_handler.queue, stream)
+    _listener.start()
+
+
+def _stop_listener():
+    # Flushes queued records at exit.
+    if _listener is None:
+        return
+    try:
+        _listener.stop()
+    except queue.Full:
+        pass
+
+
+def _shared_handler():
+    global _handler
+    with _lock:
+        if _handler is not None:
+            return _handler
+        if settings.log_async:
+            _handler = _BoundedQueueHandler(None)
+            _start_listener()
+            atexit.register(_stop_listener)
+            os.register_at_fork(after_in_child=_start_listener)
+        else:
+            _handler = logging.StreamHandler()
+            _handler.setFormatter(_formatter())
+            _handler.addFilter(_ContextFilter())
+        return _handler
+
 
 def get_logger(name: str) -> logging.Logger:
     if name in _loggers:
@@ -23,11 +144,37 @@ def get_logger(name: str) -> logging.Logger:
     logger.setLevel(log_level)
 
     if not logger.handlers:
-        formatter = logging.Formatter(settings.log_format)
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
+        logger.addHandler(_shared_handler())
 
     logger.propagate = False
     _loggers[name] = logger
     return logger
+
+
+def add_record_field(name, field):
+    _record_fields[name] = field
+
+
+def dropped_records():
+    # Records dropped because the writer thread fell behind.
+    return getattr(_handler, "dropped", 0)
+
+
+def log_limited(logger, level, msg, *args, key=None, interval=10.0):
+    # Logs at most once per `interval` seconds for each key (the message
+    # format by default), for messages that can repeat per item or per
+    # request under load. The number of calls suppressed in between is
+    # appended to the next message that is logged.
+    if not logger.isEnabledFor(level):
+        return
+    key = (logger.name, key or msg)
+    now = time.monotonic()
+    with _lock:
+        last, suppressed = _limits.get(key, (None, 0))
+        if last is not None and now - last < interval:
+            _limits[key] = (last, suppressed + 1)
+            return
+        _limits[key] = (now, 0)
+    if suppressed:
+        msg += f" ({suppressed} similar messages suppressed)"
+    logger.log(level, msg, *args, stacklevel=2)
@@ -0,0 +1,187 @@
+from collections import namedtuple
+from io import BytesIO
+import numpy as np
+from PIL import Image, ImageOps
+import torch
+import torch.nn.functional as F
+
+# Decoded pixels (H×W×3 uint8) and the (width, height) that boxes are reported
+# in. The two differ when the JPEG decoder was asked for a reduced size.
+Frame = namedtuple("Frame", ["pixels", "size"])
+
+# EXIF orientations that swap width and height.
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def resize_shape(width, height, shortest_edge, longest_edge):
+    # Output (height, width) of DetrImageProcessor's resize: the shortest edge
+    # becomes `shortest_edge` unless that pushes the longest past `longest_edge`.
+    small, large = min(width, height), max(width, height)
+    if large / small * shortest_edge > longest_edge:
+        shortest_edge = int(round(longest_edge * small / large))
+    if small == shortest_edge:
+        return height, width
+    if width < height:
+        return int(shortest_edge * height / width), shortest_edge
+    return shortest_edge, int(shortest_edge * width / height)
+
+
+def decode(data, shortest_edge=None, longest_edge=None):
+    # Decodes upload bytes into a Frame. With a target resolution, JPEGs are
+    # decoded by libjpeg's DCT scaling at the smallest power-of-two reduction
+    # that is still at least as large as the model input, which skips most of
+    # the decode work for large photos. EXIF rotation is applied before the
+    # RGB conversion so that only one full-size copy is made.
+    image = Image.open(BytesIO(data))
+    width, height = image.size
+    if image.getexif().get(0x0112) in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+
+    if shortest_edge and image.format == "JPEG":
+        target_h, target_w = resize_shape(width, height, shortest_edge, longest_edge)
+        scale = max(target_w / width, target_h / height)
+        raw_w, raw_h = image.size
+        image.draft("RGB", (int(raw_w * scale + 0.5), int(raw_h * scale + 0.5)))
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return Frame(np.asarray(image), (width, height))
+
+
+def frame_from_array(pixels):
+    return Frame(pixels, (pixels.shape[1], pixels.shape[0]))
+
+
+class TensorPreprocessor:
+    # Resize, rescale, normalize and pad a batch of Frames as torch operations
+    # on `device`, producing the same `pixel_values`/`pixel_mask` inputs as
+    # DetrImageProcessor without a round trip through PIL per image.
+
+    def __init__(self, processor, device):
+        size = processor.size
+        self.shortest_edge = size.get("shortest_edge", 800)
+        self.longest_edge = size.get("longest_edge", 1333)
+        self.device = device
+
+        # (x / 255 - mean) / std folded into a single multiply-add.
+        mean = torch.tensor(processor.image_mean, dtype=torch.float32)
+        std = torch.tensor(processor.image_std, dtype=torch.float32)
+        self.scale = (1 / (255 * std)).view(3, 1, 1).to(device)
+        self.shift = (-mean / std).view(3, 1, 1).to(device)
+
+    def __call__(self, frames):
+        resized = []
+        for frame in frames:
+            # The target shape is taken from the original size, so a frame
+            # decoded at reduced size gets the same model input shape.
+            height, width = frame.pixels.shape[:2]
+            shape = resize_shape(*frame.size, self.shortest_edge, self.longest_edge)
+
+            # uint8 is moved to the device before conversion to float so the
+            # host-to-device copy is a quarter of the size.
+            pixels = torch.from_numpy(np.ascontiguousarray(frame.pixels))
+            pixels = pixels.to(self.device).permute(2, 0, 1)[None].float()
+            if shape != (height, width):
+                pixels = F.interpolate(
+                    pixels,
+                    size=shape,
+                    mode="bilinear",
+                    align_corners=False,
+                    antialias=True,
+                )
+            resized.append(pixels[0] * self.scale + self.shift)
+
+        max_h = max(p.shape[1] for p in resized)
+        max_w = max(p.shape[2] for p in resized)
+        pixel_values = torch.zeros(len(resized), 3, max_h, max_w, device=self.device)
+        pixel_mask = torch.zeros(
+            len(resized), max_h, max_w, dtype=torch.long, device=self.device
+        )
+        for i, pixels in enumerate(resized):
+            _, h, w = pixels.shape
+            pixel_values[i, :, :h, :w] = pixels
+            pixel_mask[i, :h, :w] = 1
+        return {"pixel_values": pixel_values, "pixel_mask": pixel_mask}
+
+
+def postprocess(outputs, sizes, threshold, embeddings=False):
+    # Thresholded detections for a batch as one float64 array per image with
+    # rows of (score, label, x0, y0, x1, y1) in `sizes` coordinates, followed
+    # with `embeddings` by the query's decoder embedding when the backend
+    # returns last_hidden_state. All of the work runs on the model's device and the
+    # kept rows reach the host in a single transfer.
+    probs = outputs.logits.softmax(-1)[..., :-1]
+    scores, labels = probs.max(-1)
+
+    cx, cy, w, h = outputs.pred_boxes.unbind(-1)
+    boxes = torch.stack([cx - 0.5 * w, cy - 0.5 * h, cx + 0.5 * w, cy + 0.5 * h], -1)
+    scale = torch.tensor(
+        [[width, height, width, height] for width, height in sizes],
+        dtype=boxes.dtype,
+        device=boxes.device,
+    )
+    boxes = boxes * scale[:, None, :]
+
+    batch = torch.arange(len(sizes), device=boxes.device)[:, None].expand_as(scores)
+    rows = torch.cat(
+        [
+            batch[..., None].to(boxes.dtype),
+            scores[..., None],
+            labels[..., None].to(boxes.dtype),
+            boxes,
+        ]
+        + (embedding_columns(outputs, boxes.dtype) if embeddings else []),
+        -1,
+    )
+    rows = rows[scores > threshold].cpu().numpy().astype(np.float64)
+
+    counts = np.bincount(rows[:, 0].astype(np.int64), minlength=len(sizes))
+    return np.split(rows[:, 1:], np.cumsum(counts)[:-1])
+
+
+def embedding_columns(outputs, dtype):
+    hidden = getattr(outputs, "last_hidden_state", None)
+    return [] if hidden is None else [hidden.to(dtype)]
+
+
+def kept_embeddings(outputs, threshold):
+    # Decoder embeddings of the queries post_process_object_detection keeps,
+    # one tensor per image in query order, or None without last_hidden_state.
+    columns = embedding_columns(outputs, torch.float32)
+    if not columns:
+        return None
+    scores = outputs.logits.softmax(-1)[..., :-1].max(-1).values
+    return [hidden[keep] for hidden, keep in zip(columns[0], scores > threshold)]
+
+
+def embedding_array(rows):
+    # Embedding columns of detection rows as float16, row-aligned with the
+    # detections: 512 bytes per detection for DETR's 256-dim queries.
+    if rows.shape[1] <= 6:
+        return None
+    return np.ascontiguousarray(rows[:, 6:], dtype=np.float16)
+
+
+def detection_arrays(rows):
+    # Column arrays of detection rows for the packed wire format; labels are
+    # indices into the label names sent alongside.
+    return {
+        "scores": rows[:, 0].astype(np.float32),
+        "labels": rows[:, 1].astype(np.int32),
+        "boxes": rows[:, 2:6].astype(np.float32),
+    }
+
+
+def format_detections(rows, label_names):
+    # JSON-ready detections from (score, label, x0, y0, x1, y1) rows; rounding
+    # and label lookup are vectorized, leaving only the dict construction.
+    if len(rows) == 0:
+        return []
+    names = label_names[rows[:, 1].astype(np.int64)].tolist()
+    scores = np.round(rows[:, 0], 3).tolist()
+    boxes = np.round(rows[:, 2:6], 2).tolist()
+    return [
+        {"label": name, "score": score, "bbox": box}
+        for name, score, box in zip(names, scores, boxes)
+    ]
@@ -8,9 +8,39 @@ class Settings(BaseSettings):
         " %(levelname)s -"
         " %(filename)s:%(lineno)d - %(name)s - %(message)s"
     )
+    log_async: bool = True
+    log_json: bool = False
+    log_queue_size: int = 10000
     host: str = "0.0.0.0"
     port: int = 5005
     debug: bool = False
+    image_store_dir: str = "/dev/shm/sku-vision"
+    detection_threshold: float = 0.8
+    inference_backend: str = "eager"
+    model_dir: str = ""
+    background_warmup: bool = True
+    workers: int = 1
+    worker_threads: int = 8
+    preload_model: bool = True
+    num_threads: int = 0
+    num_interop_threads: int = 0
+    onnx_model_path: str = "/tmp/detector/detr-sku110k.onnx"
+    warmup_enabled: bool = True
+    parity_check: bool = True
+    parity_reference_dir: str = "/tmp/detector/parity"
+    parity_tolerance: float = 0.05
+    fast_preprocessing: bool = True
+    batching_enabled: bool = True
+    batch_max_size: int = 8
+    batch_max_delay_ms: float = 10.0
+    tiling_enabled: bool = False
+    tile_size: int = 800
+    tile_overlap: int = 160
+    tile_batch_size: int = 4
+    tile_merge_threshold: float = 0.6
+    profiling_enabled: bool = False
+    profile_dir: str = "/tmp/profiles"
+    profile_interval_ms: float = 5
 
     class Config:
         env_prefix = "DETECTOR_"
@@ -0,0 +1,55 @@
+import argparse
+import torch
+from transformers import DetrForObjectDetection, DetrImageProcessor
+from src.util.backends import (
+    BACKENDS,
+    _export_onnx,
+    eager_reference,
+    model_revision,
+    parity_inputs,
+    reference_path,
+    save_reference,
+)
+from src.util.logger import get_logger
+from src.util.settings import Settings
+
+logger = get_logger(__name__)
+settings = Settings()
+
+
+def main():
+    # Bakes everything the detector would otherwise fetch or compute on first
+    # start into local files, for an image that starts offline:
+    #   <model_dir>/processor, <model_dir>/model   save_pretrained snapshots
+    #   DETECTOR_PARITY_REFERENCE_DIR              eager reference outputs,
+    #                                              one per non-eager backend
+    #   DETECTOR_ONNX_MODEL_PATH                   ONNX export (with --onnx)
+    parser = argparse.ArgumentParser(description="Snapshot the detection model")
+    parser.add_argument("--model-dir", default=settings.model_dir)
+    parser.add_argument("--onnx", action="store_true", help="also export ONNX")
+    args = parser.parse_args()
+    if not args.model_dir:
+        parser.error("--model-dir or DETECTOR_MODEL_DIR is required")
+
+    processor = DetrImageProcessor.from_pretrained(
+        "facebook/detr-resnet-50", revision="no_timm"
+    )
+    model = DetrForObjectDetection.from_pretrained("isalia99/detr-resnet-50-sku110k")
+    model.eval()
+
+    processor.save_pretrained(f"{args.model_dir}/processor")
+    model.save_pretrained(f"{args.model_dir}/model", safe_serialization=True)
+    logger.info("Saved processor and model to %s", args.model_dir)
+
+    device = torch.device("cpu")
+    revision = model_revision(model)
+    reference = eager_reference(model, device)
+    for name in BACKENDS:
+        if name != "eager":
+            save_reference(reference, reference_path(revision, device, name))
+    if args.onnx:
+        _export_onnx(model, parity_inputs())
+
+
+if __name__ == "__main__":
+    main()
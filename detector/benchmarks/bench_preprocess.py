@@ -0,0 +1,154 @@
+import argparse
+import io
+import logging
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image, ImageOps
+import torch
+from transformers import DetrImageProcessor
+from transformers.models.detr.modeling_detr import DetrObjectDetectionOutput
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from src.util.preprocess import (  # noqa: E402
+    TensorPreprocessor,
+    decode,
+    format_detections,
+    postprocess,
+)
+
+
+def synthetic_jpeg(rng, width, height):
+    # Smooth colour blocks plus mild noise, so the JPEG compresses roughly like
+    # a photo rather than like random pixels.
+    blocks = rng.integers(0, 256, (height // 64 + 1, width // 64 + 1, 3), np.uint8)
+    image = np.asarray(
+        Image.fromarray(blocks).resize((width, height), Image.BILINEAR), np.float32
+    )
+    image += rng.normal(0, 4, image.shape)
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(
+        buffer, format="JPEG", quality=90
+    )
+    return buffer.getvalue()
+
+
+def fake_outputs(rng, queries, kept, labels=2):
+    # Logits with `kept` confident queries and random boxes, shaped like the
+    # model's output; only pre/post-processing is being measured.
+    logits = torch.full((1, queries, labels + 1), -4.0)
+    logits[0, :, -1] = 4.0
+    logits[0, :kept, 0] = 8.0
+    centers = torch.from_numpy(rng.uniform(0.1, 0.9, (1, queries, 2)))
+    sizes = torch.from_numpy(rng.uniform(0.02, 0.1, (1, queries, 2)))
+    boxes = torch.cat([centers, sizes], -1).float()
+    return DetrObjectDetectionOutput(logits=logits, pred_boxes=boxes)
+
+
+def reference(processor, data, outputs, threshold, id2label):
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    image = ImageOps.exif_transpose(image)
+    inputs = processor(images=[image], return_tensors="pt")
+    started = time.perf_counter()
+    target_sizes = torch.tensor([image.size[::-1]])
+    results = processor.post_process_object_detection(
+        outputs, target_sizes=target_sizes, threshold=threshold
+    )[0]
+    detections = [
+        {
+            "label": id2label[label.item()],
+            "score": round(score.item(), 3),
+            "bbox": [round(i, 2) for i in box.tolist()],
+        }
+        for score, label, box in zip(
+            results["scores"], results["labels"], results["boxes"]
+        )
+    ]
+    return inputs, detections, time.perf_counter() - started
+
+
+def fast(preprocessor, data, outputs, threshold, label_names):
+    frame = decode(data, preprocessor.shortest_edge, preprocessor.longest_edge)
+    inputs = preprocessor([frame])
+    started = time.perf_counter()
+    rows = postprocess(outputs, [frame.size], threshold)[0]
+    detections = format_detections(rows, label_names)
+    return inputs, detections, time.perf_counter() - started
+
+
+def best_of(fn, repeats):
+    timings, post = [], []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        inputs, detections, post_time = fn()
+        timings.append(time.perf_counter() - started - post_time)
+        post.append(post_time)
+    return min(timings), min(post), inputs, detections
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detector pre/post-processing")
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        default=["1280x960", "2000x1500", "4000x3000"],
+        help="WIDTHxHEIGHT",
+    )
+    parser.add_argument("--queries", type=int, default=400)
+    parser.add_argument("--kept", type=int, default=300)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    rng = np.random.default_rng(0)
+    processor = DetrImageProcessor.from_pretrained(
+        "facebook/detr-resnet-50", revision="no_timm"
+    )
+    preprocessor = TensorPreprocessor(processor, torch.device("cpu"))
+    id2label = {0: "object", 1: "empty"}
+    label_names = np.array(["object", "empty"], dtype=object)
+    outputs = fake_outputs(rng, args.queries, args.kept)
+
+    print(
+        f"{'size':>10} {'path':>9} {'pre ms':>8} {'post ms':>8} {'speedup':>8}"
+        f" {'input err':>9} {'boxes':>6}"
+    )
+    for size in args.sizes:
+        width, height = (int(v) for v in size.split("x"))
+        data = synthetic_jpeg(rng, width, height)
+
+        ref_pre, ref_post, ref_inputs, ref_detections = best_of(
+            lambda: reference(processor, data, outputs, args.threshold, id2label),
+            args.repeats,
+        )
+        fast_pre, fast_post, fast_inputs, fast_detections = best_of(
+            lambda: fast(preprocessor, data, outputs, args.threshold, label_names),
+            args.repeats,
+        )
+
+        # Mean absolute difference of the normalized model input; the JPEG
+        # DCT-scaled decode and torch's resampling differ slightly from PIL.
+        ref_pixels = ref_inputs["pixel_values"]
+        input_error = (fast_inputs["pixel_values"] - ref_pixels).abs().mean().item()
+
+        print(
+            f"{size:>10} {'reference':>9} {ref_pre * 1000:>8.1f}"
+            f" {ref_post * 1000:>8.2f} {'':>8} {'':>9} {len(ref_detections):>6}"
+        )
+        print(
+            f"{size:>10} {'fast':>9} {fast_pre * 1000:>8.1f}"
+            f" {fast_post * 1000:>8.2f}"
+            f" {(ref_pre + ref_post) / (fast_pre + fast_post):>7.2f}x"
+            f" {input_error:>9.4f} {len(fast_detections):>6}"
+        )
+        if [d["bbox"] for d in ref_detections] != [
+            d["bbox"] for d in fast_detections
+        ]:
+            print(f"{size:>10} warning: boxes differ from the reference path")
+
+
+if __name__ == "__main__":
+    main()
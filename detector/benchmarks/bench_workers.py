@@ -0,0 +1,148 @@
+import argparse
+import io
+import os
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+from PIL import Image
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+
+def shelf_jpeg(width, height):
+    rng = np.random.default_rng(0)
+    blocks = rng.integers(0, 256, (height // 64 + 1, width // 64 + 1, 3), np.uint8)
+    image = Image.fromarray(blocks).resize((width, height), Image.NEAREST)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def memory_mb(pid):
+    # Resident and proportional set size of a process. PSS splits shared pages
+    # between the processes mapping them, so summing it over the workers gives
+    # the real footprint of the pool.
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup", "r", encoding="utf-8") as f:
+        for line in f:
+            key, _, rest = line.partition(":")
+            if key in ("Rss", "Pss"):
+                values[key.lower()] = int(rest.split()[0]) / 1024
+    return values
+
+
+def children(pid):
+    pids = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children", "r", encoding="utf-8") as f:
+            pids.extend(int(p) for p in f.read().split())
+    return pids
+
+
+def start(workers, port, preload, env):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}", "main:app"],
+        cwd=APP_DIR,
+        env={
+            **os.environ,
+            **env,
+            "DETECTOR_WORKERS": str(workers),
+            "DETECTOR_PRELOAD_MODEL": str(preload).lower(),
+            "DETECTOR_LOG_LEVEL": "WARNING",
+        },
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 600
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {process.returncode}")
+        # Ready once every worker has finished its warm-up and answers.
+        try:
+            ready = requests.get(f"http://127.0.0.1:{port}/config", timeout=1).ok
+        except requests.RequestException:
+            ready = False
+        if ready and len(children(process.pid)) >= workers:
+            return process
+        time.sleep(0.5)
+    process.kill()
+    raise RuntimeError("Timed out waiting for gunicorn")
+
+
+def drive(port, image, concurrency, duration):
+    url = f"http://127.0.0.1:{port}/detect"
+    timings = []
+    stop = time.monotonic() + duration
+
+    def client():
+        session = requests.Session()
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            response = session.post(url, files={"image": ("shelf.jpg", image)})
+            response.raise_for_status()
+            timings.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for future in [pool.submit(client) for _ in range(concurrency)]:
+            future.result()
+    return np.asarray(timings), time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detector worker scaling")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--clients-per-worker", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--size", default="2000x1500", help="WIDTHxHEIGHT")
+    parser.add_argument("--port", type=int, default=5901)
+    parser.add_argument(
+        "--no-preload",
+        action="store_true",
+        help="load the model in every worker, for comparison",
+    )
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split("x"))
+    image = shelf_jpeg(width, height)
+    # Batching would let one worker absorb all clients; it is measured
+    # separately by the micro-batching stats.
+    env = {"DETECTOR_BATCHING_ENABLED": "false"}
+
+    print(
+        f"{'workers':>7} {'req/s':>7} {'scaling':>7} {'p50 ms':>8} {'p95 ms':>8}"
+        f" {'rss/worker':>10} {'pss/worker':>10} {'pss total':>9}"
+    )
+    baseline = None
+    for workers in args.workers:
+        process = start(workers, args.port, not args.no_preload, env)
+        try:
+            drive(args.port, image, workers, 5)
+            timings, wall = drive(
+                args.port, image, workers * args.clients_per_worker, args.duration
+            )
+            memory = [memory_mb(pid) for pid in children(process.pid)]
+            master = memory_mb(process.pid)
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait(timeout=60)
+
+        throughput = len(timings) / wall
+        baseline = baseline or throughput
+        rss = np.mean([m["rss"] for m in memory])
+        pss = np.mean([m["pss"] for m in memory])
+        total = sum(m["pss"] for m in memory) + master["pss"]
+        print(
+            f"{workers:>7} {throughput:>7.2f} {throughput / baseline:>6.2f}x"
+            f" {np.percentile(timings, 50) * 1000:>8.0f}"
+            f" {np.percentile(timings, 95) * 1000:>8.0f}"
+            f" {rss:>8.0f}MB {pss:>8.0f}MB {total:>7.0f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 from flask import Flask
 from src.blueprints.grouper import grouper_bp
 from src.util.logger import get_logger
+from src.util.metrics import init_app as init_metrics
 from src.util.settings import Settings
 
 settings = Settings()
@@ -8,6 +9,7 @@ logger = get_logger(__name__)
 
 app = Flask(__name__)
 app.register_blueprint(grouper_bp, url_prefix="/")
+init_metrics(app)
 logger.info("Blueprint registered and app created.")
 
 if __name__ == "__main__":
@@ -1,16 +1,42 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify
 from PIL import Image, UnidentifiedImageError
 import numpy as np
 import cv2
 import json
-from io import BytesIO
-from sklearn.cluster import HDBSCAN
+import threading
+from src.util.hierarchies import HierarchyStore
+from src.util.image_store import ImageStore, decode_image
 from src.util.logger import get_logger
+from src.util.metrics import stage_timings, timed
+from src.util.prototypes import PrototypeIndex
 from src.util.settings import Settings
+from src.util.wire import ARRAYS_MIMETYPE, accepts_arrays, decode_array, pack, unpack
 
 grouper_bp = Blueprint("grouper", __name__)
 logger = get_logger(__name__)
 settings = Settings()
+image_store = ImageStore(settings.image_store_dir)
+
+prototype_index = None
+if settings.prototype_index_enabled:
+    prototype_index = PrototypeIndex(
+        settings.prototype_index_dir,
+        dim=settings.prototype_dim,
+        exemplars=settings.prototype_exemplars,
+        match_scale=settings.prototype_match_scale,
+        max_clusters=settings.prototype_max_clusters,
+        max_age_days=settings.prototype_max_age_days,
+        usage_flush_seconds=settings.prototype_usage_flush_seconds,
+    )
+    logger.info("Prototype index enabled at %s", settings.prototype_index_dir)
+
+hierarchies = None
+if settings.hierarchy_store_enabled:
+    hierarchies = HierarchyStore(
+        settings.hierarchy_store_dir,
+        settings.hierarchy_store_max_mb,
+        settings.hierarchy_store_max_age_hours,
+    )
 
 
 def normalize_luminance(pil_image, apply_clahe=False):
@@ -50,59 +76,800 @@ def normalize_luminance(pil_image, apply_clahe=False):
         return pil_image
 
 
-@grouper_bp.route("/group", methods=["POST"])
-def group_detections():
-    try:
-        if "image" not in request.files or "detections" not in request.form:
-            return jsonify({"error": "Missing image or detections"}), 400
+# The exact path blurs with a 101x101 kernel and OpenCV's default sigma for
+# that size; the fast path scales both to its downsampled illumination field.
+LUMINANCE_KERNEL = 101
+LUMINANCE_SIGMA = 0.3 * ((LUMINANCE_KERNEL - 1) * 0.5 - 1) + 0.8
+
+
+def _downsample(array, downscale):
+    height, width = array.shape[:2]
+    size = (max(1, round(width / downscale)), max(1, round(height / downscale)))
+    return cv2.resize(array, size, interpolation=cv2.INTER_AREA)
+
+
+def illumination_field(small_l, ratio):
+    # Gaussian estimate of the illumination from an L channel that has been
+    # downsampled by `ratio`, with the exact path's kernel scaled to match.
+    ksize = max(1, int(LUMINANCE_KERNEL * ratio)) | 1
+    field = cv2.GaussianBlur(small_l, (ksize, ksize), LUMINANCE_SIGMA * ratio)
+    field += 1e-6
+    return field
 
+
+def _normalize_l(l_channel, field, scale, clahe):
+    # In place on `field`: L / field * scale, truncated to uint8 like the
+    # exact path, written back into `l_channel`.
+    np.divide(l_channel, field, out=field)
+    if scale is None:
+        scale = cv2.mean(l_channel)[0] / max(cv2.mean(field)[0], 1e-6)
+    np.multiply(field, scale, out=field)
+    np.clip(field, 0, 255, out=field)
+    np.copyto(l_channel, field, casting="unsafe")
+    return clahe.apply(l_channel) if clahe is not None else l_channel
+
+
+def normalize_luminance_fast(image_array, apply_clahe=False, downscale=4):
+    # Same steps as normalize_luminance on an RGB array, with the illumination
+    # field blurred at low resolution and upsampled, direct RGB<->Lab
+    # conversions and the Lab buffer reused for the output.
+    height, width = image_array.shape[:2]
+    lab = cv2.cvtColor(image_array, cv2.COLOR_RGB2Lab)
+    l_channel = cv2.extractChannel(lab, 0)
+
+    small_l = _downsample(l_channel, downscale).astype(np.float32)
+    field = illumination_field(small_l, small_l.shape[1] / width)
+    field = cv2.resize(field, (width, height), interpolation=cv2.INTER_LINEAR)
+
+    clahe = None
+    if apply_clahe:
+        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    l_channel = _normalize_l(l_channel, field, None, clahe)
+
+    cv2.insertChannel(l_channel, lab, 0)
+    return cv2.cvtColor(lab, cv2.COLOR_Lab2RGB, dst=lab)
+
+
+def normalize_luminance_crops(image_array, boxes, downscale=4):
+    # Normalizes only the pixels inside `boxes`, since features are never
+    # read elsewhere. The illumination field and brightness scale come from
+    # the downsampled whole image, so crops match the fast path closely.
+    # CLAHE is not supported: its tiles span the whole image.
+    height, width = image_array.shape[:2]
+    small_lab = cv2.cvtColor(_downsample(image_array, downscale), cv2.COLOR_RGB2Lab)
+    small_l = cv2.extractChannel(small_lab, 0).astype(np.float32)
+    field = illumination_field(small_l, small_l.shape[1] / width)
+    scale = float(small_l.mean() / max((small_l / field).mean(), 1e-6))
+    sx, sy = field.shape[1] / width, field.shape[0] / height
+
+    output = np.array(image_array)
+    failed = 0
+    for box in boxes:
         try:
-            image = Image.open(BytesIO(request.files["image"].read())).convert("RGB")
-        except UnidentifiedImageError:
-            return jsonify({"error": "Invalid image"}), 400
+            x1, y1, x2, y2 = (int(v) for v in box)
+        except Exception:
+            failed += 1
+            continue
+        x1, x2 = max(x1, 0), min(x2, width)
+        y1, y2 = max(y1, 0), min(y2, height)
+        if x2 <= x1 or y2 <= y1:
+            continue
 
-        if settings.luminance_normalization:
-            image = normalize_luminance(image, apply_clahe=settings.apply_clahe)
+        lab = cv2.cvtColor(image_array[y1:y2, x1:x2], cv2.COLOR_RGB2Lab)
+        crop_l = cv2.extractChannel(lab, 0)
+        # Bilinear upsampling of just this window of the field, using the
+        # same pixel-centre mapping as cv2.resize on the whole image.
+        transform = np.float32(
+            [[sx, 0, (x1 + 0.5) * sx - 0.5], [0, sy, (y1 + 0.5) * sy - 0.5]]
+        )
+        crop_field = cv2.warpAffine(
+            field,
+            transform,
+            (x2 - x1, y2 - y1),
+            flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+            borderMode=cv2.BORDER_REPLICATE,
+        )
+        crop_l = _normalize_l(crop_l, crop_field, scale, None)
+
+        cv2.insertChannel(crop_l, lab, 0)
+        output[y1:y2, x1:x2] = cv2.cvtColor(lab, cv2.COLOR_Lab2RGB, dst=lab)
+
+    if failed:
+        logger.warning("Failed to normalize %d of %d crops", failed, len(boxes))
+    return output
+
+
+def normalize_image(image_array, boxes):
+    mode = settings.luminance_mode
+    if mode == "exact":
+        image = normalize_luminance(
+            Image.fromarray(image_array), apply_clahe=settings.apply_clahe
+        )
+        return np.asarray(image)
+    if mode not in ("fast", "crops"):
+        raise ValueError(f"Unknown luminance mode '{mode}'")
 
+    try:
+        if mode == "crops" and not settings.apply_clahe:
+            return normalize_luminance_crops(
+                image_array, boxes, settings.luminance_downscale
+            )
+        return normalize_luminance_fast(
+            image_array, settings.apply_clahe, settings.luminance_downscale
+        )
+    except Exception as e:
+        logger.exception("Error during luminance normalization: %s", e)
+        return image_array
+
+
+def extract_crop_features_pil(image, boxes, resolution):
+    features = []
+    valid_indices = []
+
+    for i, box in enumerate(boxes):
         try:
-            detections = json.loads(request.form["detections"])
-            boxes = [d["bbox"] for d in detections]
-        except json.JSONDecodeError:
-            return jsonify({"error": "Invalid detections JSON"}), 400
+            x1, y1, x2, y2 = map(int, box)
+            if x2 <= x1 or y2 <= y1:
+                # Pillow rejects some empty crops and returns black for others.
+                continue
+            crop = image.crop((x1, y1, x2, y2)).resize(
+                (resolution, resolution),
+                resample=Image.BOX,
+            )
+            arr = np.asarray(crop).astype(np.float32) / 255.0
+            features.append(arr.flatten())
+            valid_indices.append(i)
+        except Exception:
+            pass
+
+    if len(valid_indices) < len(boxes):
+        logger.warning(
+            "Failed to process %d of %d crops",
+            len(boxes) - len(valid_indices),
+            len(boxes),
+        )
+    if not features:
+        return np.empty((0, resolution * resolution * 3), np.float32), []
+    return np.vstack(features), valid_indices
+
+
+def _box_filter_bins(starts, lengths, out_size):
+    # Pixel ranges [lo, hi) averaged by PIL's BOX filter for each output cell.
+    # Pillow keeps pixel p when -0.5 < (p - center + 0.5) * ss <= 0.5, so the
+    # analytic edges are re-checked with that expression to put pixels that
+    # sit exactly on a bin edge on the same side as Pillow does.
+    scale = (lengths / out_size)[:, None]
+    filterscale = np.maximum(scale, 1.0)
+    support = filterscale * 0.5
+    ss = 1.0 / filterscale
+    center = (np.arange(out_size) + 0.5)[None, :] * scale
+
+    lo = np.floor(center - support - 0.5) + 1
+    lo -= (lo - 1 - center + 0.5) * ss > -0.5
+    lo += (lo - center + 0.5) * ss <= -0.5
+    hi = np.floor(center + support - 0.5) + 1
+    hi += (hi - center + 0.5) * ss <= 0.5
+    hi -= (hi - 1 - center + 0.5) * ss > 0.5
+
+    lo = np.maximum(lo, np.maximum(np.trunc(center - support + 0.5), 0))
+    hi = np.minimum(
+        hi, np.minimum(np.trunc(center + support + 0.5), lengths[:, None])
+    )
 
-        features = []
-        valid_indices = []
+    lo = lo.astype(np.int64)
+    hi = np.maximum(hi.astype(np.int64), lo)
+    return lo + starts[:, None], hi + starts[:, None]
 
+
+def _bin_edges(lo, hi):
+    # When bins tile the axis (any downscale), neighbouring cells share an
+    # edge and r + 1 edges suffice; otherwise every cell keeps its own pair.
+    contiguous = (hi[:, :-1] == lo[:, 1:]).all(axis=1)
+    shared = np.concatenate([lo, hi[:, -1:]], axis=1)
+    pairs = np.concatenate([lo, hi], axis=1)
+    return contiguous, shared, pairs
+
+
+def extract_crop_features(image_array, boxes, resolution):
+    height, width = image_array.shape[:2]
+    r = resolution
+    dim = r * r * 3
+
+    if isinstance(boxes, np.ndarray):
+        # Packed boxes: truncate like int() would, and drop non-finite rows.
+        valid = np.isfinite(boxes).all(axis=1)
+        coords = np.where(valid[:, None], boxes, 0).astype(np.int64)
+    else:
+        coords = np.zeros((len(boxes), 4), np.int64)
+        valid = np.zeros(len(boxes), bool)
         for i, box in enumerate(boxes):
             try:
-                x1, y1, x2, y2 = map(int, box)
-                crop = image.crop((x1, y1, x2, y2)).resize(
-                    (settings.downsample_resolution, settings.downsample_resolution),
-                    resample=Image.BOX,
-                )
-                arr = np.asarray(crop).astype(np.float32) / 255.0
-                features.append(arr.flatten())
-                valid_indices.append(i)
+                coords[i] = [int(v) for v in box]
+                valid[i] = True
             except Exception:
-                logger.warning("Failed to process crop %d", i)
+                pass
 
-        if not features:
-            return jsonify({"error": "No valid features"}), 400
+    # Empty crops are dropped, as in the PIL path.
+    valid &= (coords[:, 2] > coords[:, 0]) & (coords[:, 3] > coords[:, 1])
+    if not valid.all():
+        logger.warning(
+            "Failed to process %d of %d crops", len(boxes) - valid.sum(), len(boxes)
+        )
+    valid_indices = np.flatnonzero(valid)
+    coords = coords[valid_indices]
+    n = len(coords)
+    if not n:
+        return np.empty((0, dim), np.float32), []
+
+    x_lo, x_hi = _box_filter_bins(coords[:, 0], coords[:, 2] - coords[:, 0], r)
+    y_lo, y_hi = _box_filter_bins(coords[:, 1], coords[:, 3] - coords[:, 1], r)
+    y_scale = 1.0 / (255.0 * np.maximum(y_hi - y_lo, 1)).astype(np.float32)
+    x_scale = 1.0 / np.maximum(x_hi - x_lo, 1).astype(np.float32)
+
+    # Pixels outside the image count as black, as they do in PIL crops.
+    x_lo, x_hi = np.clip(x_lo, 0, width), np.clip(x_hi, 0, width)
+    y_lo, y_hi = np.clip(y_lo, 0, height), np.clip(y_hi, 0, height)
+
+    # Summed-area table with a zero border, so any box sum is four lookups.
+    # It only spans the area the boxes cover, since building it is the fixed
+    # cost of this path. The int32 table may wrap on very large images, but
+    # box sums are still exact in uint32 modular arithmetic since each one
+    # fits in 32 bits.
+    # At least one pixel, for boxes that lie wholly outside the image.
+    x0, y0 = min(x_lo.min(), width - 1), min(y_lo.min(), height - 1)
+    x1, y1 = max(x_hi.max(), x0 + 1), max(y_hi.max(), y0 + 1)
+    region = image_array[y0:y1, x0:x1]
+    table = cv2.integral(region, sdepth=cv2.CV_32S).view(np.uint32)
+    table = table.reshape(-1, 3)
+    stride = x1 - x0 + 1
+
+    x_contig, x_shared, x_pairs = _bin_edges(x_lo - x0, x_hi - x0)
+    y_contig, y_shared, y_pairs = _bin_edges(y_lo - y0, y_hi - y0)
+
+    features = np.empty((n, r, r, 3), np.float32)
+    for row_contig in (True, False):
+        for col_contig in (True, False):
+            rows = np.flatnonzero((y_contig == row_contig) & (x_contig == col_contig))
+            if not len(rows):
+                continue
+
+            y_edges = (y_shared if row_contig else y_pairs)[rows]
+            x_edges = (x_shared if col_contig else x_pairs)[rows]
+            idx = y_edges[:, :, None] * stride + x_edges[:, None, :]
+            corners = np.take(table, idx.ravel(), axis=0).reshape(*idx.shape, 3)
+
+            lo = slice(0, r)
+            y_hi_edge = slice(y_edges.shape[1] - r, None)
+            x_hi_edge = slice(x_edges.shape[1] - r, None)
+            sums = corners[:, y_hi_edge, x_hi_edge] - corners[:, lo, x_hi_edge]
+            sums -= corners[:, y_hi_edge, lo]
+            sums += corners[:, lo, lo]
+
+            cell_scale = y_scale[rows, :, None, None] * x_scale[rows, None, :, None]
+            if len(rows) == n:
+                np.multiply(sums, cell_scale, out=features, casting="unsafe")
+            else:
+                features[rows] = sums * cell_scale
+
+    return features.reshape(n, dim), valid_indices.tolist()
+
+
+def reduce_features(X, method, dim):
+    if method == "none" or X.shape[0] <= dim or X.shape[1] <= dim:
+        return X
+    from sklearn.decomposition import PCA
+    from sklearn.random_projection import GaussianRandomProjection
+
+    if method == "pca":
+        reducer = PCA(n_components=dim, svd_solver="randomized", random_state=0)
+    elif method == "random_projection":
+        reducer = GaussianRandomProjection(n_components=dim, random_state=0)
+    else:
+        raise ValueError(f"Unknown feature reduction '{method}'")
+    return reducer.fit_transform(X).astype(np.float32)
+
+
+def knn_graph_labels(X, n_neighbors, distance_scale, min_cluster_size=2):
+    # Mutual k-nearest-neighbour graph with edges shorter than a multiple of
+    # the median nearest-neighbour distance; connected components become
+    # clusters and components below min_cluster_size are noise.
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components
+    from sklearn.neighbors import NearestNeighbors
+
+    n = X.shape[0]
+    k = min(n_neighbors, n - 1)
+    if k < 1:
+        return np.full(n, -1)
+
+    distances, indices = NearestNeighbors(n_neighbors=k + 1).fit(X).kneighbors(X)
+    distances, indices = distances[:, 1:], indices[:, 1:]
+    cutoff = np.median(distances[:, 0]) * distance_scale
+
+    keep = distances <= cutoff
+    rows = np.repeat(np.arange(n), k)[keep.ravel()]
+    graph = csr_matrix((np.ones(len(rows), bool), (rows, indices[keep])), shape=(n, n))
+    graph = graph.multiply(graph.T)
+
+    _, components = connected_components(graph, directed=False)
+    sizes = np.bincount(components)
+    big = sizes >= min_cluster_size
+    relabel = np.full(len(sizes), -1)
+    relabel[big] = np.arange(big.sum())
+    return relabel[components]
+
+
+HDBSCAN_ALGORITHMS = {
+    "hdbscan": "auto",
+    "hdbscan_kdtree": "kd_tree",
+    "hdbscan_balltree": "ball_tree",
+}
+
+
+def _tree_to_labels():
+    # scikit-learn's internal cluster-selection helper, which HDBSCAN.fit
+    # calls itself, or None if this version has moved or renamed it.
+    try:
+        from sklearn.cluster._hdbscan._tree import tree_to_labels
+    except ImportError:
+        return None
+    return tree_to_labels
+
+
+def fit_hdbscan(
+    X,
+    backend,
+    min_cluster_size=None,
+    method=None,
+    epsilon=None,
+    min_samples=None,
+):
+    # HDBSCAN labels and the single-linkage tree of the mutual-reachability
+    # graph they were selected from, for re-cutting with select_clusters.
+    # The tree is a private attribute; it is None when this scikit-learn
+    # version lacks it or the helper to cut it. Parameters left as None come
+    # from the settings.
+    from sklearn.cluster import HDBSCAN
+
+    clusterer = HDBSCAN(
+        metric="euclidean",
+        min_cluster_size=min_cluster_size or settings.hdbscan_min_cluster_size,
+        min_samples=min_samples or settings.hdbscan_min_samples,
+        cluster_selection_method=method or settings.hdbscan_selection_method,
+        cluster_selection_epsilon=(
+            settings.hdbscan_selection_epsilon if epsilon is None else epsilon
+        ),
+        algorithm=HDBSCAN_ALGORITHMS[backend],
+    )
+    clusterer.fit(X)
+    tree = getattr(clusterer, "_single_linkage_tree_", None)
+    if _tree_to_labels() is None:
+        tree = None
+    return clusterer.labels_, tree
+
+
+def select_clusters(entry, min_cluster_size, method, epsilon):
+    # Labels for new selection parameters from a stored hierarchy entry.
+    # With a single-linkage tree, only the condensed tree and cluster
+    # selection are recomputed, which takes about a millisecond. Entries
+    # stored without one hold the features instead and are re-fitted. An
+    # epsilon that merges a cluster up to the root fails inside
+    # scikit-learn either way, and is reported as a ValueError.
+    tree_to_labels = _tree_to_labels()
+    try:
+        if entry["tree"] is not None and tree_to_labels is not None:
+            labels, _ = tree_to_labels(
+                entry["tree"], min_cluster_size, method, False, epsilon, None
+            )
+        elif entry["features"] is not None:
+            labels, _ = fit_hdbscan(
+                entry["features"],
+                "hdbscan",
+                min_cluster_size,
+                method,
+                epsilon,
+                entry["min_samples"],
+            )
+        else:
+            raise LookupError("Stored hierarchy cannot be re-cut, group again")
+    except TypeError:
+        raise ValueError(
+            "cluster_selection_epsilon too large for this hierarchy"
+        ) from None
+    return labels
+
+
+def cluster_features(X, backend):
+    if backend == "knn_graph":
+        return knn_graph_labels(X, settings.knn_neighbors, settings.knn_distance_scale)
 
-        X = np.vstack(features)
+    if backend not in HDBSCAN_ALGORITHMS:
+        raise ValueError(f"Unknown clustering backend '{backend}'")
 
-        clusterer = HDBSCAN(
-            metric="euclidean",
-            min_cluster_size=2,
-            min_samples=2,
-            cluster_selection_method="eom",
+    if X.shape[0] < 2:
+        return np.full(X.shape[0], -1)
+
+    return fit_hdbscan(X, backend)[0]
+
+
+# scikit-learn and SciPy take most of the import time, so they are imported
+# where they are used and a background warm-up loads them (and exercises the
+# configured clustering path once) while the service is already answering
+# /healthz. /readyz reports when that has finished.
+_ready = threading.Event()
+
+
+def warm_up():
+    try:
+        X = np.random.default_rng(0).random((64, 3 * settings.downsample_resolution**2))
+        X = reduce_features(
+            X.astype(np.float32), settings.feature_reduction, settings.reduced_dim
+        )
+        cluster_features(X, settings.clustering_backend)
+        logger.info("Grouper warm-up finished")
+    except Exception as e:
+        logger.exception("Grouper warm-up failed: %s", e)
+    finally:
+        _ready.set()
+
+
+if settings.background_warmup:
+    threading.Thread(target=warm_up, name="grouper-warmup", daemon=True).start()
+else:
+    warm_up()
+
+
+def wait_ready(timeout=None):
+    return _ready.wait(timeout)
+
+
+def feature_signature(source="pixels"):
+    # Settings that change crop features; a store's prototypes are only valid
+    # while these stay the same.
+    if source == "embeddings":
+        return {"features": source, "prototype_dim": settings.prototype_dim}
+    return {
+        "downsample_resolution": settings.downsample_resolution,
+        "luminance_normalization": settings.luminance_normalization,
+        "luminance_mode": settings.luminance_mode,
+        "luminance_downscale": settings.luminance_downscale,
+        "apply_clahe": settings.apply_clahe,
+        "prototype_dim": settings.prototype_dim,
+    }
+
+
+def cluster_with_prototypes(X, store_id, source):
+    # Crops close to a known prototype of the store take its stable ID; only
+    # the rest are clustered, and the clusters found among them are added to
+    # the index. Returns the ID per row (-1 for noise) and match counts.
+    signature = feature_signature(source)
+    with timed("prototype_match"):
+        Z = prototype_index.project(X)
+        ids = prototype_index.assign(store_id, signature, Z)
+    unmatched = np.flatnonzero(ids < 0)
+
+    with timed("reduction"):
+        X_rest = reduce_features(
+            X[unmatched], settings.feature_reduction, settings.reduced_dim
         )
-        labels = clusterer.fit_predict(X)
+    with timed("clustering"):
+        labels = cluster_features(X_rest, settings.clustering_backend)
+
+    found = [c for c in np.unique(labels) if c != -1]
+    with timed("prototype_update"):
+        new_ids = prototype_index.update(
+            store_id,
+            signature,
+            ids[ids >= 0],
+            [Z[unmatched[labels == c]] for c in found],
+        )
+    for c, new_id in zip(found, new_ids):
+        ids[unmatched[labels == c]] = new_id
+
+    return ids, {
+        "store_id": store_id,
+        "matched": int(len(ids) - len(unmatched)),
+        "new_clusters": len(new_ids),
+    }
 
-        for idx, cid in zip(valid_indices, labels):
-            detections[idx]["label"] = f"cluster_{cid}" if cid != -1 else "noise"
 
-        return jsonify({"detections": detections})
+def embedding_features(embeddings, count):
+    # Detector query embeddings (float16 rows aligned with the detections) as
+    # L2-normalized float32 features, so that Euclidean distances between
+    # them behave like cosine distances.
+    if embeddings.ndim != 2:
+        raise ValueError("Expected a 2-D embeddings array")
+    if len(embeddings) != count:
+        raise ValueError(f"Got {len(embeddings)} embeddings for {count} detections")
+    X = embeddings.astype(np.float32)
+    X /= np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-6)
+    return X
+
+
+def read_detections():
+    # (boxes, embeddings or None, detection dicts or None) from either a
+    # packed-array "detections" part or the JSON "detections" and
+    # "embeddings" form fields. Raises ValueError on malformed input.
+    part = request.files.get("detections")
+    if part is not None and part.mimetype == ARRAYS_MIMETYPE:
+        arrays, _ = unpack(part.read())
+        boxes = arrays.get("boxes")
+        if boxes is None or boxes.ndim != 2 or boxes.shape[1] != 4:
+            raise ValueError("Expected an (N, 4) boxes array")
+        return boxes, arrays.get("embeddings"), None
+
+    detections = json.loads(request.form["detections"])
+    boxes = [d["bbox"] for d in detections]
+    embeddings = None
+    if "embeddings" in request.form:
+        embeddings = decode_array(json.loads(request.form["embeddings"]))
+    return boxes, embeddings, detections
+
+
+def box_features(boxes, embeddings=None, image_array=None):
+    # Feature rows, the indices of the boxes they belong to, and the feature
+    # source. Detector embeddings replace the whole pixel path: no luminance
+    # normalization or crop extraction. Raises ValueError for embeddings that
+    # do not match the boxes.
+    if embeddings is not None:
+        with timed("features"):
+            X = embedding_features(embeddings, len(boxes))
+        return X, list(range(len(boxes))), "embeddings"
+
+    if settings.luminance_normalization:
+        with timed("luminance"):
+            image_array = normalize_image(image_array, boxes)
+
+    # The summed-area table costs one pass over the image, which only pays
+    # off over the per-crop PIL path once there are enough boxes.
+    with timed("features"):
+        if len(boxes) >= settings.vectorized_min_boxes:
+            X, valid_indices = extract_crop_features(
+                image_array, boxes, settings.downsample_resolution
+            )
+        else:
+            X, valid_indices = extract_crop_features_pil(
+                Image.fromarray(image_array), boxes, settings.downsample_resolution
+            )
+    return X, valid_indices, "pixels"
+
+
+def group_boxes(X, valid_indices, count, store_id=None, source="pixels"):
+    # Cluster ID per box, -1 for noise and for boxes without features, and
+    # extra response fields: the prototype match summary when a store's
+    # index was used, or the ID of the stored HDBSCAN hierarchy.
+    prototypes = None
+    extra = {}
+    backend = settings.clustering_backend
+    if store_id is not None:
+        labels, prototypes = cluster_with_prototypes(X, store_id, source)
+        extra["prototypes"] = prototypes
+    else:
+        with timed("reduction"):
+            X = reduce_features(X, settings.feature_reduction, settings.reduced_dim)
+        if hierarchies is not None and backend in HDBSCAN_ALGORITHMS and len(X) >= 2:
+            with timed("clustering"):
+                labels, tree = fit_hdbscan(X, backend)
+            with timed("hierarchy_store"):
+                key = HierarchyStore.key_for(
+                    X, {"min_samples": settings.hdbscan_min_samples}
+                )
+                # Without a tree to cut, the features are kept for a refit.
+                hierarchies.put(
+                    key,
+                    valid_indices,
+                    count,
+                    tree=tree,
+                    features=X if tree is None else None,
+                    min_samples=settings.hdbscan_min_samples,
+                )
+            extra["hierarchy_id"] = key
+        else:
+            with timed("clustering"):
+                labels = cluster_features(X, backend)
+
+    clusters = np.full(count, -1, dtype=np.int64)
+    clusters[valid_indices] = labels
+
+    logger.info(
+        "Grouped %d boxes (%s features, %s, %s%s): %s",
+        len(valid_indices),
+        source,
+        settings.feature_reduction,
+        settings.clustering_backend,
+        (
+            f", store {store_id}: {prototypes['matched']} matched,"
+            f" {prototypes['new_clusters']} new clusters"
+            if prototypes
+            else ""
+        ),
+        ", ".join(f"{k}={v * 1000:.1f}ms" for k, v in stage_timings().items()),
+    )
+    return clusters, extra
+
+
+def load_image():
+    # Request image as an RGB array, or a (response, status) error tuple.
+    if "image_id" in request.form:
+        try:
+            with timed("load"):
+                image_array = image_store.get(request.form["image_id"])
+        except ValueError:
+            return None, (jsonify({"error": "Invalid image_id"}), 400)
+        if image_array is None:
+            return None, (jsonify({"error": "Unknown image_id"}), 404)
+        return image_array, None
+
+    try:
+        with timed("decode"):
+            return decode_image(request.files["image"].read()), None
+    except UnidentifiedImageError:
+        return None, (jsonify({"error": "Invalid image"}), 400)
+
+
+@grouper_bp.route("/group", methods=["POST"])
+def group_detections():
+    try:
+        has_image = "image" in request.files or "image_id" in request.form
+        has_detections = "detections" in request.form or "detections" in request.files
+        if not has_detections:
+            return jsonify({"error": "Missing image or detections"}), 400
+
+        store_id = request.form.get("store_id") or None
+        if store_id is not None and not PrototypeIndex.valid_store_id(store_id):
+            return jsonify({"error": "Invalid store_id"}), 400
+        if prototype_index is None:
+            store_id = None
+
+        try:
+            with timed("parse"):
+                boxes, embeddings, detections = read_detections()
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Invalid detections: %s", e)
+            return jsonify({"error": "Invalid detections"}), 400
+        if embeddings is None and not has_image:
+            return jsonify({"error": "Missing image or detections"}), 400
+
+        image_array = None
+        if embeddings is None:
+            image_array, error = load_image()
+            if error is not None:
+                return error
+
+        try:
+            X, valid_indices, source = box_features(boxes, embeddings, image_array)
+        except ValueError as e:
+            logger.warning("Invalid embeddings: %s", e)
+            return jsonify({"error": "Invalid embeddings"}), 400
+        if not valid_indices:
+            return jsonify({"error": "No valid features"}), 400
+
+        clusters, extra = group_boxes(X, valid_indices, len(boxes), store_id, source)
+
+        # Packed responses carry only the cluster IDs; JSON clients get their
+        # detections back with a label attached.
+        if accepts_arrays(request.accept_mimetypes):
+            return Response(
+                pack({"clusters": clusters}, extra), mimetype=ARRAYS_MIMETYPE
+            )
+
+        if detections is None:
+            rounded = np.round(boxes.astype(np.float64), 2).tolist()
+            detections = [{"bbox": box} for box in rounded]
+        for detection, cid in zip(detections, clusters.tolist()):
+            detection["label"] = f"cluster_{cid}" if cid != -1 else "noise"
+        return jsonify({"detections": detections, **extra})
     except Exception as e:
         logger.exception("Internal error in /group: %s", e)
         return jsonify({"error": "Internal server error"}), 500
+
+
+def config_values():
+    # Settings that change the grouping, keyed into the server's caches.
+    return {
+        "downsample_resolution": settings.downsample_resolution,
+        "luminance_normalization": settings.luminance_normalization,
+        "apply_clahe": settings.apply_clahe,
+        "luminance_mode": settings.luminance_mode,
+        "luminance_downscale": settings.luminance_downscale,
+        "feature_reduction": settings.feature_reduction,
+        "reduced_dim": settings.reduced_dim,
+        "clustering_backend": settings.clustering_backend,
+        "knn_neighbors": settings.knn_neighbors,
+        "knn_distance_scale": settings.knn_distance_scale,
+        "hdbscan_min_cluster_size": settings.hdbscan_min_cluster_size,
+        "hdbscan_min_samples": settings.hdbscan_min_samples,
+        "hdbscan_selection_method": settings.hdbscan_selection_method,
+        "hdbscan_selection_epsilon": settings.hdbscan_selection_epsilon,
+        "prototype_index_enabled": settings.prototype_index_enabled,
+        "prototype_match_scale": settings.prototype_match_scale,
+    }
+
+
+@grouper_bp.route("/config", methods=["GET"])
+def config():
+    return jsonify(config_values())
+
+
+@grouper_bp.route("/healthz", methods=["GET"])
+def healthz():
+    return jsonify({"status": "ok"})
+
+
+@grouper_bp.route("/readyz", methods=["GET"])
+def readyz():
+    if not _ready.is_set():
+        return jsonify({"status": "warming_up"}), 503
+    return jsonify({"status": "ready"})
+
+
+@grouper_bp.route("/prototypes/<store_id>", methods=["GET"])
+def prototype_stats(store_id):
+    if prototype_index is None:
+        return jsonify({"error": "Prototype index disabled"}), 404
+    if not PrototypeIndex.valid_store_id(store_id):
+        return jsonify({"error": "Invalid store_id"}), 400
+    stats = prototype_index.stats(store_id)
+    if stats is None:
+        return jsonify({"error": "Unknown store_id"}), 404
+    return jsonify({"store_id": store_id, **stats})
+
+
+def recluster_params():
+    # Selection parameters from the request form, defaulting to the settings
+    # /group used. Raises ValueError for out-of-range values.
+    form = request.form
+    try:
+        min_cluster_size = int(
+            form.get("min_cluster_size", settings.hdbscan_min_cluster_size)
+        )
+        epsilon = float(
+            form.get("cluster_selection_epsilon", settings.hdbscan_selection_epsilon)
+        )
+    except ValueError:
+        raise ValueError("Invalid selection parameters") from None
+    method = form.get("cluster_selection_method", settings.hdbscan_selection_method)
+    if min_cluster_size < 2 or not epsilon >= 0 or method not in ("eom", "leaf"):
+        raise ValueError("Invalid selection parameters")
+    return min_cluster_size, method, epsilon
+
+
+@grouper_bp.route("/recluster", methods=["POST"])
+def recluster():
+    # New labels for the boxes of an earlier /group request, in its box order
+    # and label format, from its stored hierarchy. min_samples shapes the
+    # hierarchy itself, so changing it needs a new /group request.
+    if hierarchies is None:
+        return jsonify({"error": "Hierarchy store disabled"}), 404
+    hierarchy_id = request.form.get("hierarchy_id", "")
+    try:
+        params = recluster_params()
+        entry = hierarchies.get(hierarchy_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if entry is None:
+        return jsonify({"error": "Unknown hierarchy_id"}), 404
+
+    try:
+        with timed("selection"):
+            labels = select_clusters(entry, *params)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    clusters = np.full(entry["count"], -1, dtype=np.int64)
+    clusters[entry["valid_indices"]] = labels
+    logger.info(
+        "Re-cut hierarchy %s (min_cluster_size=%d, %s, epsilon=%g): %d clusters",
+        hierarchy_id[:12],
+        *params,
+        len(set(labels.tolist()) - {-1}),
+    )
+
+    if accepts_arrays(request.accept_mimetypes):
+        return Response(
+            pack({"clusters": clusters}, {"hierarchy_id": hierarchy_id}),
+            mimetype=ARRAYS_MIMETYPE,
+        )
+    labels = [f"cluster_{cid}" if cid != -1 else "noise" for cid in clusters.tolist()]
+    return jsonify({"hierarchy_id": hierarchy_id, "labels": labels})
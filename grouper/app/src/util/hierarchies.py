@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+import numpy as np
+from src.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+_KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class HierarchyStore:
+    # HDBSCAN single-linkage trees of recent /group requests, one .npz file
+    # per hierarchy ID, so that new cluster-selection parameters can be
+    # applied without recomputing core distances and the spanning tree. Each
+    # file also holds which boxes the tree's points belong to. When no tree
+    # can be had from scikit-learn, the features and min_samples are stored
+    # instead, for a full refit. Files unused
+    # for `max_age_hours` are evicted, then the least recently used beyond
+    # `max_mb` in total.
+
+    def __init__(self, root: str, max_mb: float = 256, max_age_hours: float = 24):
+        self.root = root
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_age = max_age_hours * 3600
+
+    @staticmethod
+    def key_for(X, params) -> str:
+        # The tree depends only on the features and the parameters that
+        # shape the mutual-reachability graph.
+        X = np.ascontiguousarray(X)
+        digest = hashlib.sha256()
+        digest.update(json.dumps([X.dtype.str, X.shape, params]).encode("utf-8"))
+        digest.update(X.data)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        if not _KEY_PATTERN.match(key):
+            raise ValueError(f"Invalid hierarchy ID '{key}'")
+        return os.path.join(self.root, f"{key}.npz")
+
+    def put(
+        self,
+        key: str,
+        valid_indices,
+        count: int,
+        tree=None,
+        features=None,
+        min_samples: int = 0,
+    ):
+        path = self._path(key)
+        if os.path.exists(path):
+            os.utime(path)
+            return
+
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                arrays = {"tree": tree, "features": features}
+                np.savez(
+                    f,
+                    valid_indices=np.asarray(valid_indices, np.int64),
+                    count=np.int64(count),
+                    min_samples=np.int64(min_samples),
+                    **{k: v for k, v in arrays.items() if v is not None},
+                )
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self._evict()
+
+    def get(self, key: str):
+        # {"tree", "features", "min_samples", "valid_indices", "count"} or
+        # None if unknown or evicted. Either the tree or the features is None.
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                entry = {
+                    "tree": data["tree"] if "tree" in data else None,
+                    "features": data["features"] if "features" in data else None,
+                    "min_samples": int(data.get("min_samples", 0)),
+                    "valid_indices": data["valid_indices"],
+                    "count": int(data["count"]),
+                }
+            os.utime(path)
+            return entry
+        except FileNotFoundError:
+            return None
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith(".npz"):
+                path = os.path.join(self.root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort(reverse=True)
+        cutoff = time.time() - self.max_age
+        total, evicted = 0, 0
+        for mtime, size, path in entries:
+            if mtime >= cutoff and total + size <= self.max_bytes:
+                total += size
+                continue
+            try:
+                os.unlink(path)
+                evicted += 1
+            except FileNotFoundError:
+                pass
+        if evicted:
+            logger.info("Evicted %d stored hierarchies", evicted)
@@ -0,0 +1,92 @@
+import hashlib
+import os
+import re
+import tempfile
+from io import BytesIO
+import numpy as np
+from PIL import Image, ImageOps
+from src.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+_KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def decode_image(data: bytes) -> np.ndarray:
+    image = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+    return np.asarray(image.convert("RGB"))
+
+
+class ImageStore:
+    # Decoded RGB images stored once per content hash as .npy files, so every
+    # service on the host can memory-map the same pixels instead of decoding
+    # its own copy. Point the root at /dev/shm (or a tmpfs volume) to keep it
+    # in memory, or at a regular directory for an on-disk blob store. The
+    # oldest images are evicted beyond `max_items` or `max_bytes`, whichever
+    # is hit first; the newest image is always kept.
+
+    def __init__(self, root: str, max_items: int = 64, max_bytes: int = 1 << 30):
+        self.root = root
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key_for(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _path(self, key: str) -> str:
+        if not _KEY_PATTERN.match(key):
+            raise ValueError(f"Invalid image key '{key}'")
+        return os.path.join(self.root, f"{key}.npy")
+
+    def put(self, data: bytes) -> str:
+        key = self.key_for(data)
+        path = self._path(key)
+
+        if os.path.exists(path):
+            os.utime(path)
+            return key
+
+        pixels = decode_image(data)
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, pixels)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+        height, width = pixels.shape[:2]
+        logger.info("Stored image %s (%dx%d)", key[:12], width, height)
+        self._evict()
+        return key
+
+    def get(self, key: str):
+        try:
+            return np.load(self._path(key), mmap_mode="r")
+        except FileNotFoundError:
+            return None
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith(".npy"):
+                path = os.path.join(self.root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort(reverse=True)
+        total = 0
+        for count, (_, size, path) in enumerate(entries):
+            total += size
+            if count == 0 or (count < self.max_items and total <= self.max_bytes):
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,302 @@
+import bisect
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from flask import Response, g, request
+from src.util.logger import add_record_field, dropped_records, get_logger
+from src.util.settings import Settings
+
+logger = get_logger(__name__)
+settings = Settings()
+
+REQUEST_ID_HEADER = "X-Request-ID"
+PROFILE_HEADER = "X-Profile"
+
+# Latency buckets in seconds, from sub-millisecond stages to slow requests.
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)  # fmt: skip
+
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,128}$")
+_trace = ContextVar("trace", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = {k: (list(v[0]), v[1], v[2]) for k, v in self._series.items()}
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _labels(self.label_names, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _labels(self.label_names, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            lines.append(
+                f"{self.name}_count{_labels(self.label_names, labels)} {count}"
+            )
+        return lines
+
+
+class CounterMetric:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class CallbackMetric:
+    # Sampled at scrape time from a callback returning {label values: value},
+    # for state a component already tracks (queue depths, cache counters).
+
+    def __init__(self, name, help_text, label_names, callback, kind):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.callback = callback
+        self.kind = kind
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.warning("Failed to collect metric %s: %s", self.name, e)
+            return lines
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+stage_seconds = Histogram(
+    "sku_vision_stage_seconds", "Time spent in each pipeline stage.", ("stage",)
+)
+request_seconds = Histogram(
+    "sku_vision_request_seconds", "HTTP request latency.", ("endpoint",)
+)
+requests_total = CounterMetric(
+    "sku_vision_requests_total", "HTTP requests handled.", ("endpoint", "status")
+)
+_metrics = [stage_seconds, request_seconds, requests_total]
+
+
+def register_callback(name, help_text, label_names, callback, kind="gauge"):
+    _metrics.append(CallbackMetric(name, help_text, label_names, callback, kind))
+
+
+def render_metrics():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe((stage,), seconds)
+    trace = _trace.get()
+    if trace is not None:
+        trace["stages"][stage] = trace["stages"].get(stage, 0.0) + seconds
+
+
+class timed:
+    # Context manager that records the block's duration in the stage
+    # histogram and, inside a request, in that request's trace. A plain class
+    # rather than @contextmanager keeps it to about a microsecond.
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe_stage(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+def current_request_id():
+    trace = _trace.get()
+    return trace["request_id"] if trace is not None else None
+
+
+add_record_field("request_id", current_request_id)
+register_callback(
+    "sku_vision_log_records_dropped_total",
+    "Log records dropped because the log writer thread fell behind.",
+    (),
+    lambda: {(): dropped_records()},
+    kind="counter",
+)
+
+
+def stage_timings():
+    trace = _trace.get()
+    return dict(trace["stages"]) if trace is not None else {}
+
+
+def run_traced(request_id, fn, *args):
+    # Runs fn under its own trace, for work outside the Flask request thread
+    # such as the per-image stages of a batch on a thread pool.
+    token = _trace.set({"request_id": request_id, "stages": {}})
+    try:
+        return fn(*args)
+    finally:
+        _trace.reset(token)
+
+
+class SamplingProfiler:
+    # Samples one thread's Python stack at a fixed interval and writes the
+    # collapsed stacks (flame graph input) when stopped.
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                    f":{frame.f_lineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self, path):
+        self._stop.set()
+        self._thread.join()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return sum(self.samples.values())
+
+
+def init_app(app):
+    # Request IDs, per-request stage traces, request metrics, the optional
+    # per-request profiler and the /metrics endpoint.
+
+    @app.before_request
+    def start_trace():
+        g.request_id = request.headers.get(REQUEST_ID_HEADER, "")
+        if not _REQUEST_ID_PATTERN.match(g.request_id):
+            g.request_id = uuid.uuid4().hex
+        g.started = time.perf_counter()
+        _trace.set({"request_id": g.request_id, "stages": {}})
+        g.profiler = None
+        if settings.profiling_enabled and request.headers.get(PROFILE_HEADER):
+            g.profiler = SamplingProfiler(
+                threading.get_ident(), settings.profile_interval_ms / 1000
+            ).start()
+
+    @app.after_request
+    def finish_trace(response):
+        if "started" not in g:
+            return response
+        elapsed = time.perf_counter() - g.started
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        request_seconds.observe((endpoint,), elapsed)
+        requests_total.inc((endpoint, str(response.status_code)))
+
+        stages = stage_timings()
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+        if stages:
+            response.headers["Server-Timing"] = ", ".join(
+                f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages.items()
+            )
+            logger.debug(
+                "Request %s %s in %.1fms: %s",
+                g.request_id,
+                endpoint,
+                elapsed * 1000,
+                ", ".join(f"{k}={v * 1000:.1f}ms" for k, v in stages.items()),
+            )
+        return response
+
+    @app.teardown_request
+    def end_trace(_exc):
+        # Runs after streamed responses finish, so profiles cover them too.
+        if g.get("profiler") is not None:
+            path = os.path.join(settings.profile_dir, f"{g.request_id}.folded")
+            samples = g.profiler.stop(path)
+            logger.info("Wrote %d profile samples to %s", samples, path)
+        _trace.set(None)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,315 @@
+import fcntl
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from functools import lru_cache
+import numpy as np
+from src.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+_STORE_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$")
+
+CLUSTER_DTYPE = np.dtype(
+    [
+        ("id", "<i8"),
+        ("count", "<i8"),
+        ("radius", "<f4"),
+        ("created", "<f8"),
+        ("last_seen", "<f8"),
+        ("hits", "<i8"),
+    ]
+)
+
+
+@lru_cache(maxsize=4)
+def projection(in_dim, out_dim):
+    # Fixed Gaussian random projection, identical in every worker, so index
+    # vectors written by one process are comparable with another's crops.
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((in_dim, out_dim)) / np.sqrt(out_dim)
+    return matrix.astype(np.float32)
+
+
+def _save_atomic(path, array):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def _save_json_atomic(path, value):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+class PrototypeIndex:
+    # Per-store memory of known SKU clusters: a centroid and a few exemplar
+    # feature vectors per cluster, each with a stable ID. Crops that fall
+    # within a known cluster's radius are labelled without re-clustering, and
+    # clusters found in the remaining crops are added back.
+    #
+    # Each store is a directory of .npy files memory-mapped by every worker:
+    #   meta.json             generation, next ID and feature signature
+    #   vectors-<gen>.npy     (clusters, 1 + exemplars, dim) float32
+    #   clusters-<gen>.npy    CLUSTER_DTYPE row per cluster, same order
+    # Adding or evicting clusters writes a new generation; usage statistics
+    # only rewrite the clusters file. Hits are buffered in each worker and
+    # written at most every `usage_flush_seconds`, or with the next new
+    # cluster, since every write makes all workers reload the store. Writers
+    # serialize on a lock file, and all files are replaced atomically so
+    # readers never see a partial write.
+
+    def __init__(
+        self,
+        root,
+        dim=64,
+        exemplars=4,
+        match_scale=1.5,
+        max_clusters=1024,
+        max_age_days=30.0,
+        usage_flush_seconds=60.0,
+    ):
+        self.root = root
+        self.dim = dim
+        self.exemplars = max(1, exemplars)
+        self.match_scale = match_scale
+        self.max_clusters = max_clusters
+        self.max_age = max_age_days * 86400
+        self.usage_flush_seconds = usage_flush_seconds
+        self._cache = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def valid_store_id(store_id):
+        return bool(_STORE_PATTERN.match(store_id))
+
+    def _dir(self, store_id):
+        if not self.valid_store_id(store_id):
+            raise ValueError(f"Invalid store ID '{store_id}'")
+        return os.path.join(self.root, store_id)
+
+    def project(self, X):
+        # Rows of X in the index's `dim` dimensions: randomly projected when
+        # wider, zero-padded when narrower, which keeps their distances.
+        X = X.astype(np.float32, copy=False)
+        if X.shape[1] > self.dim:
+            return X @ projection(X.shape[1], self.dim)
+        if X.shape[1] < self.dim:
+            return np.pad(X, ((0, 0), (0, self.dim - X.shape[1])))
+        return X
+
+    def _read(self, directory):
+        # Current generation of a store, or None if it has none yet. A writer
+        # can retire the generation between reading meta.json and opening its
+        # files, in which case the read is retried.
+        for _ in range(3):
+            try:
+                with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+                    meta = json.load(f)
+                gen = meta["generation"]
+                vectors = np.load(
+                    os.path.join(directory, f"vectors-{gen}.npy"), mmap_mode="r"
+                )
+                clusters = np.load(os.path.join(directory, f"clusters-{gen}.npy"))
+                return {"meta": meta, "vectors": vectors, "clusters": clusters}
+            except FileNotFoundError:
+                if not os.path.exists(os.path.join(directory, "meta.json")):
+                    return None
+        return None
+
+    def _snapshot(self, store_id):
+        # Cached read of a store, refreshed when another worker has written it.
+        # Every write replaces meta.json, so its inode and mtime identify the
+        # version on disk.
+        directory = self._dir(store_id)
+        try:
+            stat = os.stat(os.path.join(directory, "meta.json"))
+        except FileNotFoundError:
+            return None
+        version = (stat.st_ino, stat.st_mtime_ns)
+
+        with self._lock:
+            cached = self._cache.get(store_id)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        state = self._read(directory)
+        if state is not None:
+            per_cluster = state["vectors"].shape[1]
+            radius = state["clusters"]["radius"]
+            floor = float(np.median(radius)) if len(radius) else 0.0
+            rows = np.asarray(state["vectors"]).reshape(-1, state["vectors"].shape[2])
+            state.update(
+                rows=rows,
+                row_norms=(rows**2).sum(axis=1),
+                row_ids=np.repeat(state["clusters"]["id"], per_cluster),
+                thresholds=np.repeat(
+                    self.match_scale * np.maximum(radius, floor), per_cluster
+                ),
+            )
+            with self._lock:
+                self._cache[store_id] = (version, state)
+        return state
+
+    def assign(self, store_id, signature, Z):
+        # Stable cluster ID of the nearest known prototype for each row of Z,
+        # or -1 where no cluster is close enough.
+        assigned = np.full(len(Z), -1, dtype=np.int64)
+        state = self._snapshot(store_id)
+        if (
+            state is None
+            or state["meta"]["signature"] != signature
+            or not len(state["rows"])
+        ):
+            return assigned
+
+        distances = (
+            (Z**2).sum(axis=1)[:, None]
+            + state["row_norms"][None, :]
+            - 2 * Z @ state["rows"].T
+        )
+        nearest = distances.argmin(axis=1)
+        nearest_distance = np.sqrt(
+            np.maximum(distances[np.arange(len(Z)), nearest], 0)
+        )
+        matched = nearest_distance <= state["thresholds"][nearest]
+        assigned[matched] = state["row_ids"][nearest[matched]]
+        return assigned
+
+    def _prototype(self, members):
+        centroid = members.mean(axis=0)
+        distances = np.sqrt(((members - centroid) ** 2).sum(axis=1))
+        closest = np.argsort(distances)
+        picks = closest[np.arange(self.exemplars) % len(members)]
+        return np.vstack([centroid, members[picks]]), float(distances.max())
+
+    def _take_usage(self, store_id, matched_ids, flush):
+        # Adds `matched_ids` to the store's buffered hits. Returns all of them
+        # for writing when `flush` is set or the buffer is due, else None.
+        now = time.monotonic()
+        with self._lock:
+            ids, since = self._pending.get(store_id, ([], now))
+            ids.append(np.asarray(matched_ids, dtype=np.int64))
+            if not flush and now - since < self.usage_flush_seconds:
+                self._pending[store_id] = (ids, since)
+                return None
+            self._pending.pop(store_id, None)
+        return np.concatenate(ids)
+
+    def update(self, store_id, signature, matched_ids, new_clusters):
+        # Records hits on `matched_ids` and adds one cluster per array of
+        # member vectors in `new_clusters`. Returns the new clusters' IDs.
+        # Without new clusters, nothing is written until the buffered hits
+        # are due.
+        matched_ids = self._take_usage(store_id, matched_ids, bool(new_clusters))
+        if matched_ids is None:
+            return []
+        directory = self._dir(store_id)
+        os.makedirs(directory, exist_ok=True)
+        now = time.time()
+
+        with open(os.path.join(directory, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            previous = self._read(directory)
+            state = previous
+            if state is not None and state["meta"]["signature"] != signature:
+                logger.warning(
+                    "Feature settings changed, resetting prototypes for store %s",
+                    store_id,
+                )
+                state = None
+            if state is None:
+                meta = {"generation": 0, "next_id": 0, "signature": signature}
+                vectors = np.empty((0, self.exemplars + 1, self.dim), np.float32)
+                clusters = np.empty(0, CLUSTER_DTYPE)
+            else:
+                meta, clusters = state["meta"], state["clusters"]
+                vectors = np.asarray(state["vectors"])
+
+            ids, hits = np.unique(matched_ids, return_counts=True)
+            seen = np.isin(clusters["id"], ids)
+            clusters["last_seen"][seen] = now
+            clusters["hits"][seen] += hits[np.searchsorted(ids, clusters["id"][seen])]
+
+            new_ids = []
+            changed = state is None
+            if new_clusters:
+                added_vectors = []
+                added = np.empty(len(new_clusters), CLUSTER_DTYPE)
+                for i, members in enumerate(new_clusters):
+                    prototype, radius = self._prototype(members)
+                    added_vectors.append(prototype)
+                    added[i] = (meta["next_id"], len(members), radius, now, now, 0)
+                    new_ids.append(meta["next_id"])
+                    meta["next_id"] += 1
+                vectors = np.concatenate([vectors, np.stack(added_vectors)])
+                clusters = np.concatenate([clusters, added])
+                changed = True
+
+            # Age-based eviction first, then least recently seen beyond the cap.
+            keep = clusters["last_seen"] >= now - self.max_age
+            if keep.sum() > self.max_clusters:
+                recent = np.argsort(-clusters["last_seen"], kind="stable")
+                keep[:] = False
+                keep[recent[: self.max_clusters]] = True
+            if not keep.all():
+                logger.info(
+                    "Evicting %d prototypes from store %s", (~keep).sum(), store_id
+                )
+                vectors, clusters = vectors[keep], clusters[keep]
+                changed = True
+
+            # A reset store continues the old generation numbering so that its
+            # files are retired like any other generation's.
+            retired = None
+            if previous is not None and changed:
+                retired = previous["meta"]["generation"]
+                meta["generation"] = retired + 1
+            if changed:
+                _save_atomic(
+                    os.path.join(directory, f"vectors-{meta['generation']}.npy"),
+                    vectors,
+                )
+            _save_atomic(
+                os.path.join(directory, f"clusters-{meta['generation']}.npy"),
+                clusters,
+            )
+            _save_json_atomic(os.path.join(directory, "meta.json"), meta)
+
+            if retired is not None:
+                for name in (f"vectors-{retired}.npy", f"clusters-{retired}.npy"):
+                    try:
+                        os.unlink(os.path.join(directory, name))
+                    except FileNotFoundError:
+                        pass
+
+        return new_ids
+
+    def stats(self, store_id):
+        state = self._snapshot(store_id)
+        if state is None:
+            return None
+        clusters = state["clusters"]
+        return {
+            "clusters": len(clusters),
+            "exemplars": self.exemplars,
+            "dim": int(state["vectors"].shape[2]),
+            "hits": int(clusters["hits"].sum()),
+            "next_id": state["meta"]["next_id"],
+        }
@@ -8,12 +8,44 @@ class Settings(BaseSettings):
         " %(levelname)s -"
         " %(filename)s:%(lineno)d - %(name)s - %(message)s"
     )
+    log_async: bool = True
+    log_json: bool = False
+    log_queue_size: int = 10000
     host: str = "0.0.0.0"
     port: int = 5003
     debug: bool = False
+    image_store_dir: str = "/dev/shm/sku-vision"
     luminance_normalization: bool = False
     apply_clahe: bool = True
+    luminance_mode: str = "exact"
+    luminance_downscale: int = 4
     downsample_resolution: int = 28
+    vectorized_min_boxes: int = 150
+    feature_reduction: str = "none"
+    reduced_dim: int = 32
+    clustering_backend: str = "hdbscan"
+    knn_neighbors: int = 10
+    knn_distance_scale: float = 1.5
+    hdbscan_min_cluster_size: int = 2
+    hdbscan_min_samples: int = 2
+    hdbscan_selection_method: str = "eom"
+    hdbscan_selection_epsilon: float = 0.0
+    hierarchy_store_enabled: bool = False
+    hierarchy_store_dir: str = "/tmp/sku-vision/hierarchies"
+    hierarchy_store_max_mb: float = 256
+    hierarchy_store_max_age_hours: float = 24
+    background_warmup: bool = True
+    prototype_index_enabled: bool = False
+    prototype_index_dir: str = "/tmp/sku-vision/prototypes"
+    prototype_dim: int = 64
+    prototype_exemplars: int = 4
+    prototype_match_scale: float = 1.5
+    prototype_max_clusters: int = 1024
+    prototype_max_age_days: float = 30.0
+    prototype_usage_flush_seconds: float = 60.0
+    profiling_enabled: bool = False
+    profile_dir: str = "/tmp/profiles"
+    profile_interval_ms: float = 5
 
     class Config:
         env_prefix = "GROUPER_"
@@ -0,0 +1,92 @@
+import base64
+import json
+import struct
+import numpy as np
+
+# Packed NumPy arrays exchanged between the services in place of JSON lists of
+# detection dicts. Responses use it when the client lists the type in Accept;
+# requests send it as the content type of a multipart part.
+ARRAYS_MIMETYPE = "application/vnd.sku-vision.arrays"
+
+_MAGIC = b"SKUA"
+_ALIGN = 8
+_DTYPES = ("<f2", "<f4", "<f8", "<i4", "<i8", "|u1")
+
+
+def _padding(size):
+    return -size % _ALIGN
+
+
+def _check_dtype(dtype):
+    if dtype not in _DTYPES:
+        raise ValueError(f"Unsupported array dtype '{dtype}'")
+
+
+def pack(arrays, meta=None):
+    # Magic, uint32 header length, JSON header naming each array's dtype and
+    # shape, then the raw array bytes. Everything is 8-byte aligned so that
+    # unpack can view the arrays in place without copying.
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    specs = []
+    for name, array in arrays.items():
+        _check_dtype(array.dtype.str)
+        specs.append([name, array.dtype.str, list(array.shape)])
+    header = json.dumps({"arrays": specs, "meta": meta or {}}).encode("utf-8")
+
+    parts = [_MAGIC, struct.pack("<I", len(header)), header]
+    parts.append(b"\0" * _padding(8 + len(header)))
+    for array in arrays.values():
+        parts.append(array.tobytes())
+        parts.append(b"\0" * _padding(array.nbytes))
+    return b"".join(parts)
+
+
+def unpack(data):
+    # (arrays, meta) from pack's output. The arrays are read-only views of
+    # `data`. Raises ValueError on a malformed or truncated payload.
+    view = memoryview(data)
+    if len(view) < 8 or bytes(view[:4]) != _MAGIC:
+        raise ValueError("Not a packed array payload")
+    (length,) = struct.unpack_from("<I", view, 4)
+    if 8 + length > len(view):
+        raise ValueError("Truncated array header")
+    header = json.loads(bytes(view[8 : 8 + length]))
+
+    arrays = {}
+    offset = 8 + length + _padding(8 + length)
+    for name, dtype, shape in header["arrays"]:
+        _check_dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        size = count * np.dtype(dtype).itemsize
+        if count < 0 or offset + size > len(view):
+            raise ValueError(f"Truncated array '{name}'")
+        array = np.frombuffer(view[offset : offset + size], dtype)
+        arrays[name] = array.reshape(shape)
+        offset += size + _padding(size)
+    return arrays, header.get("meta", {})
+
+
+def accepts_arrays(accept):
+    # Whether a Flask Accept header explicitly lists ARRAYS_MIMETYPE. A
+    # wildcard is not enough, so plain HTTP clients keep getting JSON.
+    return any(value == ARRAYS_MIMETYPE and quality > 0 for value, quality in accept)
+
+
+def encode_array(array):
+    # One array as a JSON-safe dict of dtype, shape and base64 bytes, for
+    # JSON payloads and cache entries.
+    array = np.ascontiguousarray(array)
+    _check_dtype(array.dtype.str)
+    return {
+        "dtype": array.dtype.name,
+        "shape": list(array.shape),
+        "data": base64.b64encode(array.tobytes()).decode("ascii"),
+    }
+
+
+def decode_array(spec):
+    dtype = np.dtype(spec["dtype"]).newbyteorder("<")
+    _check_dtype(dtype.str)
+    return np.frombuffer(base64.b64decode(spec["data"]), dtype).reshape(
+        spec["shape"]
+    )
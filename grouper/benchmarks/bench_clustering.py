@@ -0,0 +1,74 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from src.blueprints.grouper import cluster_features, reduce_features  # noqa: E402
+
+CONFIGS = [
+    ("none", "hdbscan"),
+    ("pca", "hdbscan"),
+    ("pca", "hdbscan_kdtree"),
+    ("random_projection", "hdbscan_balltree"),
+    ("pca", "knn_graph"),
+    ("random_projection", "knn_graph"),
+]
+
+
+def synthetic_features(rng, count, dim, products, noise_fraction=0.1):
+    # Repeated "products": each crop is a prototype plus pixel noise, with a
+    # fraction of one-off crops that should come out as noise.
+    prototypes = rng.uniform(0, 1, (products, dim)).astype(np.float32)
+    singles = int(count * noise_fraction)
+    truth = rng.integers(0, products, count - singles)
+    X = prototypes[truth] + rng.normal(0, 0.05, (len(truth), dim))
+    X = np.vstack([X, rng.uniform(0, 1, (singles, dim))]).astype(np.float32)
+    return np.clip(X, 0, 1), np.concatenate([truth, np.full(singles, -1)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Grouper clustering benchmark")
+    parser.add_argument(
+        "--counts", type=int, nargs="+", default=[100, 300, 1000, 3000]
+    )
+    parser.add_argument("--resolution", type=int, default=28)
+    parser.add_argument("--reduced-dim", type=int, default=32)
+    parser.add_argument("--products", type=int, default=25)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    dim = args.resolution * args.resolution * 3
+
+    print(
+        f"{'boxes':>6} {'reduction':>18} {'backend':>17}"
+        f" {'reduce ms':>10} {'cluster ms':>11} {'ARI current':>12} {'ARI truth':>10}"
+    )
+    for count in args.counts:
+        X, truth = synthetic_features(rng, count, dim, args.products)
+        baseline = None
+
+        for method, backend in CONFIGS:
+            started = time.perf_counter()
+            reduced = reduce_features(X, method, args.reduced_dim)
+            reduce_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            labels = cluster_features(reduced, backend)
+            cluster_time = time.perf_counter() - started
+
+            if baseline is None:
+                baseline = labels
+            print(
+                f"{count:>6} {method:>18} {backend:>17} {reduce_time * 1000:>10.1f}"
+                f" {cluster_time * 1000:>11.1f}"
+                f" {adjusted_rand_score(baseline, labels):>12.3f}"
+                f" {adjusted_rand_score(truth, labels):>10.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
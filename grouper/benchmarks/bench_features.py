@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from src.blueprints.grouper import (  # noqa: E402
+    extract_crop_features,
+    extract_crop_features_pil,
+)
+
+
+def random_boxes(rng, count, width, height, max_side):
+    x1 = rng.uniform(0, width - max_side, count)
+    y1 = rng.uniform(0, height - max_side, count)
+    w = rng.uniform(max_side / 4, max_side, count)
+    h = rng.uniform(max_side / 4, max_side, count)
+    return np.stack([x1, y1, x1 + w, y1 + h], axis=1).round(2).tolist()
+
+
+def best_of(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crop feature extraction benchmark")
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--resolution", type=int, default=28)
+    parser.add_argument("--max-side", type=int, default=300)
+    parser.add_argument(
+        "--counts", type=int, nargs="+", default=[10, 100, 300, 1000, 3000]
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    image_array = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    image = Image.fromarray(image_array)
+
+    print(f"{'boxes':>6} {'pil ms':>9} {'vector ms':>10} {'speedup':>8} {'max err':>8}")
+    for count in args.counts:
+        boxes = random_boxes(rng, count, args.width, args.height, args.max_side)
+        pil_time, (expected, _) = best_of(
+            lambda: extract_crop_features_pil(image, boxes, args.resolution),
+            args.repeats,
+        )
+        vec_time, (actual, _) = best_of(
+            lambda: extract_crop_features(image_array, boxes, args.resolution),
+            args.repeats,
+        )
+        error = np.abs(actual - expected).max() * 255
+        print(
+            f"{count:>6} {pil_time * 1000:>9.1f} {vec_time * 1000:>10.1f}"
+            f" {pil_time / vec_time:>7.2f}x {error:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import logging
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from src.blueprints.grouper import (  # noqa: E402
+    normalize_luminance,
+    normalize_luminance_crops,
+    normalize_luminance_fast,
+)
+
+
+def synthetic_shelf(rng, width, height, count):
+    # Flat-coloured products on a light background under a lighting gradient,
+    # with sensor noise, so the illumination field has something to remove.
+    image = np.full((height, width, 3), 200.0)
+    boxes = []
+    side = max(width, height) // 40
+    for _ in range(count):
+        w, h = rng.integers(side, 2 * side), rng.integers(side * 3 // 2, 3 * side)
+        x, y = rng.integers(0, width - w), rng.integers(0, height - h)
+        image[y : y + h, x : x + w] = rng.integers(0, 256, 3)
+        boxes.append([float(x), float(y), float(x + w), float(y + h)])
+
+    image *= np.linspace(0.5, 1.1, width)[None, :, None]
+    image *= np.linspace(0.8, 1.0, height)[:, None, None]
+    image += rng.normal(0, 5, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8), boxes
+
+
+def best_of(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def errors(actual, expected, mask=None):
+    diff = np.abs(actual.astype(np.int16) - expected.astype(np.int16))
+    if mask is not None:
+        diff = diff[mask]
+    return diff.mean(), np.percentile(diff, 99), diff.max()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Luminance normalization benchmark")
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        default=["1280x960", "2000x1500", "4000x3000"],
+        help="WIDTHxHEIGHT",
+    )
+    parser.add_argument("--boxes", type=int, default=300)
+    parser.add_argument("--downscale", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    rng = np.random.default_rng(0)
+
+    print(
+        f"{'size':>10} {'clahe':>5} {'mode':>6} {'ms':>8} {'speedup':>8}"
+        f" {'mean err':>9} {'p99 err':>8} {'max err':>8}"
+    )
+    for size in args.sizes:
+        width, height = (int(v) for v in size.split("x"))
+        image, boxes = synthetic_shelf(rng, width, height, args.boxes)
+        mask = np.zeros((height, width), bool)
+        for x1, y1, x2, y2 in boxes:
+            mask[int(y1) : int(y2), int(x1) : int(x2)] = True
+
+        for clahe in (False, True):
+            exact_time, expected = best_of(
+                lambda: np.asarray(normalize_luminance(Image.fromarray(image), clahe)),
+                args.repeats,
+            )
+            modes = [
+                (
+                    "fast",
+                    lambda: normalize_luminance_fast(image, clahe, args.downscale),
+                    None,
+                )
+            ]
+            if not clahe:
+                modes.append(
+                    (
+                        "crops",
+                        lambda: normalize_luminance_crops(image, boxes, args.downscale),
+                        mask,
+                    )
+                )
+
+            print(f"{size:>10} {clahe!s:>5} {'exact':>6} {exact_time * 1000:>8.1f}")
+            for mode, fn, region in modes:
+                elapsed, actual = best_of(fn, args.repeats)
+                mean, p99, worst = errors(actual, expected, region)
+                print(
+                    f"{size:>10} {clahe!s:>5} {mode:>6} {elapsed * 1000:>8.1f}"
+                    f" {exact_time / elapsed:>7.2f}x {mean:>9.3f} {p99:>8.1f}"
+                    f" {worst:>8.0f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 import streamlit as st
 import requests
-from PIL import Image, ImageDraw
+import hashlib
+import json
+import os
+import time
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageOps
 import random
-from collections import defaultdict
 from src.util.settings import Settings
 from src.util.logger import get_logger
 
@@ -10,7 +14,171 @@ settings = Settings()
 logger = get_logger(__name__)
 
 SERVER_URL = settings.server_url
+JOBS_URL = settings.jobs_url
 TIMEOUT = settings.request_timeout
+POLL_WAIT = settings.poll_wait
+PREVIEW_SIZE = settings.preview_max_side
+CACHE_ENTRIES = settings.cache_entries
+
+# EXIF orientations that swap width and height.
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+# Boxes that have not been grouped yet.
+UNGROUPED_COLOR = (255, 215, 0)
+LINE_WIDTH = 5
+
+
+class JobPending(Exception):
+    pass
+
+
+def file_digest(uploaded_file):
+    # SHA-256 of an upload, hashed once per upload rather than on every
+    # rerun. Cached decodes and results are keyed by it.
+    key = f"digest-{uploaded_file.file_id}"
+    if key not in st.session_state:
+        st.session_state[key] = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    return st.session_state[key]
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def load_preview(digest, _data):
+    # RGB preview at most PREVIEW_SIZE pixels on a side, and the full
+    # (width, height) after EXIF rotation, which the server's boxes refer
+    # to. JPEGs are decoded at reduced size by libjpeg, so this costs a
+    # fraction of a full decode.
+    image = Image.open(BytesIO(_data))
+    width, height = image.size
+    if image.getexif().get(0x0112) in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    image.draft("RGB", (PREVIEW_SIZE, PREVIEW_SIZE))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE), Image.BILINEAR)
+    return image, (width, height)
+
+
+def label_color(label):
+    # Random per label, but the same on every rerun.
+    if label is None:
+        return UNGROUPED_COLOR
+    rng = random.Random(label)
+    return (rng.randint(50, 255), rng.randint(50, 255), rng.randint(50, 255))
+
+
+def draw_detections(image, detections, scale=1.0):
+    # Copy of `image` with the boxes, given in full-size pixels, drawn at
+    # `scale`.
+    image = image.copy()
+    draw = ImageDraw.Draw(image)
+    width = max(2, round(LINE_WIDTH * scale))
+    for det in detections:
+        bbox = [v * scale for v in det["bbox"]]
+        label = det.get("label")
+        color = label_color(label)
+        draw.rectangle(bbox, outline=color, width=width)
+        if label is not None:
+            draw.text((bbox[0], bbox[1] - 10), label, fill=color)
+    return image
+
+
+def detections_digest(detections):
+    return hashlib.sha256(json.dumps(detections).encode("utf-8")).hexdigest()
+
+
+@st.cache_data(max_entries=2, show_spinner="Rendering full-resolution overlay...")
+def full_overlay(digest, boxes_digest, _data, _detections):
+    # JPEG of the full-size image with all boxes, only rendered on request;
+    # two are kept, since each is a full decode and a large encode. Keyed by
+    # the detections too, so new results for the same upload redraw it.
+    image = ImageOps.exif_transpose(Image.open(BytesIO(_data))).convert("RGB")
+    buffer = BytesIO()
+    draw_detections(image, _detections).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def process_sync(digest, _files):
+    # Result of one synchronous /process call, for use_jobs off.
+    logger.info("Sending image '%s' to %s", _files["image"][0], SERVER_URL)
+    response = requests.post(SERVER_URL, files=_files, timeout=TIMEOUT)
+    response.raise_for_status()
+    result = response.json()
+    logger.info("Detection successful: %d detections", len(result["detections"]))
+    return result
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def submit_job(digest, _files):
+    # Job ID for an upload. Clicking again, or any rerun, reuses the job
+    # instead of posting the image again.
+    logger.info("Sending image '%s' to %s", _files["image"][0], JOBS_URL)
+    response = requests.post(
+        JOBS_URL, files=_files, data={"priority": "interactive"}, timeout=30
+    )
+    response.raise_for_status()
+    return response.json()["job_id"]
+
+
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def job_result(job_id):
+    # Result of a finished job. Raises JobPending while it runs, which is
+    # not cached.
+    response = requests.get(f"{JOBS_URL}/{job_id}", timeout=30)
+    response.raise_for_status()
+    job = response.json()
+    if job["state"] == "failed":
+        raise RuntimeError(f"Job {job_id} failed: {job.get('error')}")
+    if job["state"] != "done":
+        raise JobPending(job_id)
+    detections = job["result"]["detections"]
+    logger.info("Detection successful: %d detections", len(detections))
+    return job["result"]
+
+
+def wait_for_job(job_id, on_detected):
+    # Long-polls until the job finishes. The first polls also return as
+    # soon as the server has detections, which are passed to `on_detected`
+    # while grouping runs.
+    deadline = time.monotonic() + TIMEOUT
+    partial = True
+    while True:
+        response = requests.get(
+            f"{JOBS_URL}/{job_id}",
+            params={"wait": POLL_WAIT, "partial": str(partial).lower()},
+            timeout=POLL_WAIT + 10,
+        )
+        response.raise_for_status()
+        job = response.json()
+        if job["state"] in ("done", "failed"):
+            return
+        if partial and "partial" in job:
+            on_detected(job["partial"]["detections"])
+            partial = False
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Job {job_id} did not finish in time")
+
+
+def process(digest, files, on_detected):
+    # Pipeline result for one upload, cached by file hash. By default the
+    # image is queued as a job and long-polled, so a slow image holds no
+    # single request open for the whole run; with use_jobs off it is one
+    # synchronous /process call.
+    if not settings.use_jobs:
+        return process_sync(digest, files)
+
+    job_id = submit_job(digest, files)
+    try:
+        try:
+            return job_result(job_id)
+        except JobPending:
+            pass
+        wait_for_job(job_id, on_detected)
+        return job_result(job_id)
+    except Exception:
+        # Also for a cached job that has since failed or been purged: the
+        # next click submits the image again.
+        submit_job.clear(digest, files)
+        raise
+
 
 st.set_page_config(page_title="Product Detector", layout="centered")
 st.title("🧠 Product Detection Interface")
@@ -19,50 +187,60 @@ st.markdown("Upload a retail shelf image and see detected products.")
 uploaded_file = st.file_uploader("Choose an image", type=["jpg", "jpeg", "png"])
 
 if uploaded_file:
-    uploaded_file.seek(0)
-    image = Image.open(uploaded_file).convert("RGB")
+    data = uploaded_file.getvalue()
+    digest = file_digest(uploaded_file)
+    preview, (full_width, _) = load_preview(digest, data)
+    scale = preview.width / full_width
 
     if st.button("🔍 Detect Products"):
-        st.info("Sending image to server...")
-        logger.info("Sending image '%s' to %s", uploaded_file.name, SERVER_URL)
+        st.session_state["detect"] = digest
+
+    # Results stay on screen across reruns, such as the download button's.
+    if st.session_state.get("detect") == digest:
+        view = st.empty()
+        status = st.empty()
+
+        def show_detected(detections):
+            view.image(
+                draw_detections(preview, detections, scale),
+                caption=f"{len(detections)} products detected, grouping...",
+                use_container_width=True,
+            )
+            status.info("Grouping similar products...")
 
         try:
-            uploaded_file.seek(0)
-            files = {
-                "image": (uploaded_file.name, uploaded_file.read(), uploaded_file.type)
-            }
-            response = requests.post(SERVER_URL, files=files, timeout=TIMEOUT)
-            response.raise_for_status()
-
-            result = response.json()
+            status.info("Sending image to server...")
+            files = {"image": (uploaded_file.name, data, uploaded_file.type)}
+            result = process(digest, files, show_detected)
             detections = result.get("detections", [])
-            logger.info("Detection successful: %d detections", len(detections))
-            st.success("Detection complete!")
-
-            label_colors = defaultdict(
-                lambda: (
-                    random.randint(50, 255),
-                    random.randint(50, 255),
-                    random.randint(50, 255),
-                )
+            status.success("Detection complete!")
+
+            view.image(
+                draw_detections(preview, detections, scale),
+                caption="Detected Products",
+                use_container_width=True,
             )
 
-            draw = ImageDraw.Draw(image)
-            for det in detections:
-                bbox = det["bbox"]
-                label = det["label"]
-                color = label_colors[label]
-                draw.rectangle(bbox, outline=color, width=5)
-                draw.text((bbox[0], bbox[1] - 10), label, fill=color)
+            stem = os.path.splitext(uploaded_file.name)[0]
+            if st.button("🖼️ Prepare full-resolution overlay"):
+                st.session_state["overlay"] = digest
+            if st.session_state.get("overlay") == digest:
+                st.download_button(
+                    "⬇️ Download overlay",
+                    full_overlay(
+                        digest, detections_digest(detections), data, detections
+                    ),
+                    file_name=f"{stem}_detections.jpg",
+                    mime="image/jpeg",
+                )
 
-            st.image(image, caption="Detected Products", use_container_width=True)
             st.markdown("### 📝 Detection Results")
             st.json(result)
 
         except requests.RequestException as e:
             logger.exception("Request failed: %s", e)
-            st.error("Something went wrong!")
+            status.error("Something went wrong!")
 
         except Exception as e:
             logger.exception("Unexpected error: %s", e)
-            st.error("Something went wrong!")
+            status.error("Something went wrong!")
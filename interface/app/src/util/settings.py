@@ -8,9 +8,17 @@ class Settings(BaseSettings):
         " %(levelname)s -"
         " %(filename)s:%(lineno)d - %(name)s - %(message)s"
     )
+    log_async: bool = True
+    log_json: bool = False
+    log_queue_size: int = 10000
     debug: bool = False
     server_url: str = "http://server:5000/process"
     request_timeout: float = 300
+    use_jobs: bool = True
+    jobs_url: str = "http://server:5000/jobs"
+    poll_wait: float = 20
+    preview_max_side: int = 1280
+    cache_entries: int = 32
 
     class Config:
         env_prefix = "INTERFACE_"
@@ -1,17 +1,143 @@
-from flask import Blueprint, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+import logging
+import numpy as np
+import queue
 import requests
-from src.util.logger import get_logger
+import threading
+import time
+from src.util.batch_input import iter_batch_images, spool_uploads
+from src.util.downstream import (
+    DEADLINE_HEADER,
+    Deadline,
+    DeadlineExceeded,
+    Downstream,
+    Overloaded,
+)
+from src.util.image_store import ImageStore, decode_image
+from src.util.job_queue import PRIORITIES, JobQueue, JobWorkers, QueueFull
+from src.util.logger import get_logger, log_limited
+from src.util.monolith import LocalServices
+from src.util.metrics import (
+    current_request_id,
+    register_callback,
+    run_traced,
+    timed,
+)
+from src.util.result_cache import ResultCache, cache_key
 from src.util.settings import Settings
+from src.util.shelf_state import (
+    ShelfStore,
+    carry_labels,
+    centers_inside,
+    changed_blocks,
+    changed_regions,
+    cluster_ids,
+    encode_crop,
+    estimate_shift,
+    gray_thumbnail,
+)
+from src.util.wire import ARRAYS_MIMETYPE, decode_array, encode_array, pack, unpack
 import json
 
 server_bp = Blueprint("server", __name__)
 logger = get_logger(__name__)
 settings = Settings()
 
+CLIENT_ID_HEADER = "X-Client-ID"
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
 DETECTOR_URL = settings.detector_url
 GROUPER_URL = settings.grouper_url
-DETECTOR_TIMEOUT = settings.detector_timeout
-GROUPER_TIMEOUT = settings.grouper_timeout
+
+detector = Downstream(
+    "detector", settings.detector_max_in_flight, settings.detector_max_queue
+)
+grouper = Downstream(
+    "grouper", settings.grouper_max_in_flight, settings.grouper_max_queue
+)
+
+# In monolith mode the detector and grouper run in this process and are
+# called as functions; the Downstream limits still bound their concurrency.
+local = None
+if settings.pipeline_mode == "monolith":
+    local = LocalServices(settings.services_root)
+elif settings.pipeline_mode != "services":
+    raise ValueError(f"Unknown pipeline mode '{settings.pipeline_mode}'")
+
+image_store = None
+if local is None and settings.image_store_enabled:
+    image_store = ImageStore(
+        settings.image_store_dir,
+        settings.image_store_max_items,
+        settings.image_store_max_bytes,
+    )
+    logger.info("Shared image store enabled at %s", settings.image_store_dir)
+
+detection_cache = ResultCache(
+    "detections",
+    settings.cache_max_items,
+    settings.cache_dir,
+    settings.cache_disk_max_items,
+)
+result_cache = ResultCache(
+    "results",
+    settings.cache_max_items,
+    settings.cache_dir,
+    settings.cache_disk_max_items,
+)
+shelf_store = ShelfStore(settings.shelf_state_dir, settings.shelf_state_max_items)
+_downstream_config = {"fetched_at": 0.0, "value": None}
+_downstream_config_lock = threading.Lock()
+
+register_callback(
+    "sku_vision_cache_events_total",
+    "Result cache lookups and writes by cache and event.",
+    ("cache", "event"),
+    lambda: {
+        (cache.name, event): value
+        for cache in (detection_cache, result_cache)
+        for event, value in cache.stats().items()
+        if event in ("hits", "disk_hits", "misses", "stores", "evictions")
+    },
+    kind="counter",
+)
+register_callback(
+    "sku_vision_downstream_calls",
+    "Downstream calls in flight or waiting for a slot.",
+    ("service", "state"),
+    lambda: {
+        (service.name, state): service.stats()[state]
+        for service in (detector, grouper)
+        for state in ("in_flight", "waiting")
+    },
+)
+
+# Asynchronous jobs, persisted in SQLite and run by a pool of worker threads
+# in every server process. The pool starts at the end of this module, once
+# the pipeline functions exist.
+jobs = None
+if settings.jobs_enabled:
+    jobs = JobQueue(
+        settings.job_dir,
+        settings.job_max_queued,
+        settings.request_deadline + 60,
+        settings.job_max_attempts,
+        settings.job_retention_hours,
+    )
+    register_callback(
+        "sku_vision_jobs",
+        "Asynchronous jobs queued or running, by priority.",
+        ("priority", "state"),
+        jobs.counts,
+    )
+    register_callback(
+        "sku_vision_job_oldest_wait_seconds",
+        "Time the oldest queued job has waited, by priority.",
+        ("priority",),
+        jobs.oldest_wait,
+    )
 
 
 def compute_iou(boxA, boxB):
@@ -35,53 +161,655 @@ def compute_iou(boxA, boxB):
         return 0.0
 
 
+def _iou_one_to_many(box, coords, areas):
+    # Same arithmetic as compute_iou, applied to many boxes at once.
+    x1 = np.maximum(box[0], coords[:, 0])
+    y1 = np.maximum(box[1], coords[:, 1])
+    x2 = np.minimum(box[2], coords[:, 2])
+    y2 = np.minimum(box[3], coords[:, 3])
+
+    inter_area = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+    box_area = (box[2] - box[0]) * (box[3] - box[1])
+    union_area = box_area + areas - inter_area
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iou = inter_area / union_area
+    iou[(inter_area == 0) | ~np.isfinite(iou)] = 0.0
+    return iou
+
+
+def _merge_cluster(boxes, iou_threshold):
+    # Greedy merge in input order: each unused box grows by absorbing later
+    # unused boxes whose IoU with the grown box reaches the threshold. Boxes
+    # are sorted by x1 so only those that can overlap the grown box in x are
+    # scored, and the first hit in input order is merged next.
+    n = len(boxes)
+    coords = np.asarray(boxes, dtype=np.float64)
+    areas = (coords[:, 2] - coords[:, 0]) * (coords[:, 3] - coords[:, 1])
+    order = np.argsort(coords[:, 0], kind="stable")
+    sorted_x1 = coords[order, 0]
+    max_width = max(0.0, (coords[:, 2] - coords[:, 0]).max())
+    used = np.zeros(n, dtype=bool)
+
+    merged_boxes = []
+    merges = 0
+    for i in range(n):
+        if used[i]:
+            continue
+        used[i] = True
+        merged_box = list(boxes[i])
+        start = i + 1
+
+        while start < n:
+            if iou_threshold > 0:
+                lo = np.searchsorted(sorted_x1, merged_box[0] - max_width, "left")
+                hi = np.searchsorted(sorted_x1, merged_box[2], "right")
+                candidates = order[lo:hi]
+            else:
+                candidates = np.arange(n)
+            candidates = candidates[(candidates >= start) & ~used[candidates]]
+            if not len(candidates):
+                break
+
+            iou = _iou_one_to_many(merged_box, coords[candidates], areas[candidates])
+            hits = candidates[iou >= iou_threshold]
+            if not len(hits):
+                break
+
+            j = hits.min()
+            box_j = boxes[j]
+            merged_box[0] = min(merged_box[0], box_j[0])
+            merged_box[1] = min(merged_box[1], box_j[1])
+            merged_box[2] = max(merged_box[2], box_j[2])
+            merged_box[3] = max(merged_box[3], box_j[3])
+            used[j] = True
+            merges += 1
+            start = j + 1
+
+        merged_boxes.append(merged_box)
+
+    return merged_boxes, merges
+
+
 def merge_grouped_boxes(detections, iou_threshold=0.7):
     merged_by_cluster = {}
     for d in detections:
         label = d.get("label", "noise")
         merged_by_cluster.setdefault(label, []).append(d["bbox"])
 
+    # Counted per call and logged once: per-box and per-cluster lines cost
+    # more than the merge itself on dense shelves.
     final_detections = []
+    merges, invalid, first_error = 0, 0, None
+    for label, boxes in merged_by_cluster.items():
+        valid_boxes = []
+        for i, box in enumerate(boxes):
+            try:
+                x1, y1, x2, y2 = (float(v) for v in box)
+                valid_boxes.append(box)
+            except Exception as e:
+                invalid += 1
+                first_error = first_error or f"box {i} in cluster '{label}': {e}"
+
+        if not valid_boxes:
+            continue
+
+        merged_boxes, cluster_merges = _merge_cluster(valid_boxes, iou_threshold)
+        merges += cluster_merges
+        final_detections.extend({"bbox": box, "label": label} for box in merged_boxes)
+
+    if invalid:
+        logger.warning("Skipped %d invalid boxes, first %s", invalid, first_error)
     logger.info(
-        "Starting merge of grouped boxes with IoU threshold %.2f", iou_threshold
+        "Merged %d boxes in %d clusters into %d (%d merges, IoU threshold %.2f)",
+        len(detections),
+        len(merged_by_cluster),
+        len(final_detections),
+        merges,
+        iou_threshold,
     )
+    return final_detections
 
-    for label, boxes in merged_by_cluster.items():
-        logger.info("Processing cluster '%s' with %d boxes", label, len(boxes))
-        used = [False] * len(boxes)
 
-        for i, box_i in enumerate(boxes):
-            if used[i]:
-                continue
-            try:
-                x1, y1, x2, y2 = box_i
-                merged_box = [x1, y1, x2, y2]
-
-                for j, box_j in enumerate(boxes[i + 1:], start=i + 1):
-                    if used[j]:
-                        continue
-                    iou = compute_iou(merged_box, box_j)
-                    if iou >= iou_threshold:
-                        logger.info(
-                            "Merging box %s with %s (IoU=%.2f)", merged_box, box_j, iou
-                        )
-                        merged_box[0] = min(merged_box[0], box_j[0])
-                        merged_box[1] = min(merged_box[1], box_j[1])
-                        merged_box[2] = max(merged_box[2], box_j[2])
-                        merged_box[3] = max(merged_box[3], box_j[3])
-                        used[j] = True
-
-                used[i] = True
-                final_detections.append({"bbox": merged_box, "label": label})
-            except Exception as e:
-                logger.warning(
-                    "Failed to merge box index %d in cluster '%s': %s", i, label, e
+def store_image(image_bytes):
+    if image_store is None:
+        return None
+    try:
+        with timed("store_image"):
+            return image_store.put(image_bytes)
+    except Exception as e:
+        logger.warning("Could not store image, using multipart upload: %s", e)
+        return None
+
+
+def post_image(
+    service,
+    url,
+    image_id,
+    upload,
+    image_bytes,
+    deadline,
+    data=None,
+    files=None,
+    headers=None,
+):
+    # Prefer passing the shared-store handle; fall back to uploading the bytes
+    # when the store is disabled or the downstream service cannot see it.
+    if image_id is not None:
+        response = service.post(
+            url,
+            deadline,
+            data={"image_id": image_id, **(data or {})},
+            files=files,
+            headers=headers,
+        )
+        if response.status_code != 404:
+            return response
+        logger.warning("%s could not resolve image %s, re-uploading", url, image_id)
+
+    return service.post(
+        url,
+        deadline,
+        files={"image": (upload[0], image_bytes, upload[1]), **(files or {})},
+        data=data,
+        headers=headers,
+    )
+
+
+def wire_headers():
+    # Asks for packed arrays; services that only speak JSON ignore it.
+    if settings.wire_format == "binary":
+        return {"Accept": f"{ARRAYS_MIMETYPE}, application/json;q=0.5"}
+    return None
+
+
+def is_packed(response):
+    return response.headers.get("Content-Type", "").startswith(ARRAYS_MIMETYPE)
+
+
+def parse_detections(response):
+    # (boxes, embeddings or None) from a packed or JSON detector response.
+    if is_packed(response):
+        arrays, _ = unpack(response.content)
+        return arrays["boxes"], arrays.get("embeddings")
+
+    body = response.json()
+    boxes = np.array(
+        [d["bbox"] for d in body.get("detections", [])], dtype=np.float32
+    ).reshape(-1, 4)
+    embeddings = body.get("embeddings")
+    return boxes, decode_array(embeddings) if embeddings else None
+
+
+def cluster_labels(clusters):
+    return [f"cluster_{cid}" if cid != -1 else "noise" for cid in clusters.tolist()]
+
+
+def parse_labels(response, count):
+    # Cluster label per detection from a packed or JSON grouper response, and
+    # the ID of the grouper's stored hierarchy, if it kept one.
+    if is_packed(response):
+        arrays, extra = unpack(response.content)
+        labels = cluster_labels(arrays["clusters"])
+    else:
+        extra = response.json()
+        labels = [d.get("label", "noise") for d in extra.get("detections", [])]
+    if len(labels) != count:
+        raise ValueError(f"Grouper returned {len(labels)} labels for {count} boxes")
+    return labels, extra.get("hierarchy_id")
+
+
+def downstream_config():
+    # Settings of the detector and grouper that change their output, fetched
+    # from each service and reused for a short TTL. None disables caching.
+    if local is not None:
+        return local.config()
+
+    with _downstream_config_lock:
+        age = time.monotonic() - _downstream_config["fetched_at"]
+        value = _downstream_config["value"]
+        if value is not None and age < settings.downstream_config_ttl:
+            return value
+
+    try:
+        value = {
+            "detector": detector.session.get(
+                settings.detector_config_url, timeout=5
+            ).json(),
+            "grouper": grouper.session.get(
+                settings.grouper_config_url, timeout=5
+            ).json(),
+        }
+    except (requests.RequestException, ValueError) as e:
+        logger.warning("Could not fetch downstream config, caching disabled: %s", e)
+        return None
+
+    with _downstream_config_lock:
+        _downstream_config.update(fetched_at=time.monotonic(), value=value)
+    return value
+
+
+def summarize(detections, merged_detections):
+    cluster_counts = {}
+    for d in detections:
+        label = d.get("label", "noise")
+        cluster_counts[label] = cluster_counts.get(label, 0) + 1
+
+    return {
+        "detections": merged_detections,
+        "metadata": {
+            "cluster_counts": cluster_counts,
+            "total_clusters": len(cluster_counts),
+        },
+    }
+
+
+def new_job(image_bytes, upload, deadline, store_id=None):
+    return {
+        "image_bytes": image_bytes,
+        "upload": upload,
+        "deadline": deadline,
+        "store_id": store_id,
+        "image_hash": ImageStore.key_for(image_bytes),
+        "image_id": None,
+        "result_key": None,
+        "pixels": None,
+        "boxes": None,
+        "embeddings": None,
+        "hierarchy_id": None,
+        "result": None,
+    }
+
+
+def detect_stage(image_bytes, upload, deadline, store_id=None, cache_result=True):
+    # First half of the pipeline: result-cache lookup and detection. Returns
+    # the job state for group_stage, with "result" set if nothing is left.
+    job = new_job(image_bytes, upload, deadline, store_id)
+    embeddings = settings.grouping_features == "embeddings"
+    config = downstream_config() if settings.cache_enabled else None
+
+    # Grouping against a store's prototype index depends on the index state,
+    # so only detections are cached for those requests.
+    detection_key = None
+    if config is not None:
+        detection_key = cache_key(
+            job["image_hash"],
+            config["detector"],
+            {"embeddings": embeddings, "layout": "arrays"},
+        )
+    if config is not None and store_id is None and cache_result:
+        job["result_key"] = cache_key(
+            job["image_hash"],
+            config,
+            {
+                "merge_iou": settings.merge_iou_threshold,
+                "grouping_features": settings.grouping_features,
+            },
+        )
+        with timed("cache_lookup"):
+            cached = result_cache.get(job["result_key"])
+        if cached is not None:
+            logger.info("Result cache hit for image %s", job["image_hash"][:12])
+            job["result"] = cached
+            return job
+
+    if local is None:
+        job["image_id"] = store_image(image_bytes)
+
+    # Detections are kept as a box array, plus each detection's query
+    # embedding with embedding features. Cache entries hold both base64
+    # encoded, which round-trips the arrays without per-box JSON.
+    cached = None
+    if detection_key is not None:
+        with timed("cache_lookup"):
+            cached = detection_cache.get(detection_key)
+
+    if cached is None:
+        if local is not None:
+            decode_pixels(job)
+            with timed("detect"):
+                job["boxes"], job["embeddings"] = detector.run(
+                    deadline,
+                    local.detect,
+                    job["pixels"],
+                    embeddings,
+                    deadline.remaining(),
+                )
+        else:
+            logger.info("Forwarding image to detector service at %s", DETECTOR_URL)
+            with timed("detect"):
+                detector_response = post_image(
+                    detector,
+                    DETECTOR_URL,
+                    job["image_id"],
+                    upload,
+                    image_bytes,
+                    deadline,
+                    data={"embeddings": "true"} if embeddings else None,
+                    headers=wire_headers(),
                 )
+                detector_response.raise_for_status()
+                job["boxes"], job["embeddings"] = parse_detections(
+                    detector_response
+                )
+        if detection_key is not None:
+            detection_cache.put(
+                detection_key,
+                {
+                    "boxes": encode_array(job["boxes"]),
+                    "embeddings": (
+                        encode_array(job["embeddings"])
+                        if job["embeddings"] is not None
+                        else None
+                    ),
+                },
+            )
+    else:
+        logger.info("Detection cache hit for image %s", job["image_hash"][:12])
+        job["boxes"] = decode_array(cached["boxes"])
+        if cached["embeddings"] is not None:
+            job["embeddings"] = decode_array(cached["embeddings"])
+
+    logger.info("Detector returned %d detections", len(job["boxes"]))
+
+    if not len(job["boxes"]):
+        logger.info("No detections found, skipping grouping step")
+        job["result"] = summarize([], [])
+        if job["result_key"] is not None:
+            result_cache.put(job["result_key"], job["result"])
+    return job
+
+
+def decode_pixels(job):
+    # Monolith mode decodes each image once, for detection and grouping.
+    if job["pixels"] is None:
+        with timed("decode"):
+            job["pixels"] = decode_image(job["image_bytes"])
+
+
+def post_group(job, bboxes):
+    # Cluster label per box from the grouper service.
+    logger.info("Forwarding detection result to grouper at %s", GROUPER_URL)
+    boxes, embeddings = job["boxes"], job["embeddings"]
+    data, files = {}, None
+    if job["store_id"]:
+        data["store_id"] = job["store_id"]
+
+    with timed("serialize"):
+        if settings.wire_format == "binary":
+            arrays = {"boxes": boxes}
+            if embeddings is not None:
+                arrays["embeddings"] = embeddings
+            files = {"detections": ("detections", pack(arrays), ARRAYS_MIMETYPE)}
+        else:
+            data["detections"] = json.dumps([{"bbox": box} for box in bboxes])
+            if embeddings is not None:
+                data["embeddings"] = json.dumps(encode_array(embeddings))
+
+    with timed("group"):
+        if embeddings is not None:
+            # Grouping on detector embeddings does not need the image.
+            grouper_response = grouper.post(
+                GROUPER_URL,
+                job["deadline"],
+                data=data,
+                files=files,
+                headers=wire_headers(),
+            )
+        else:
+            grouper_response = post_image(
+                grouper,
+                GROUPER_URL,
+                job["image_id"],
+                job["upload"],
+                job["image_bytes"],
+                job["deadline"],
+                data=data,
+                files=files,
+                headers=wire_headers(),
+            )
+        grouper_response.raise_for_status()
+        labels, job["hierarchy_id"] = parse_labels(grouper_response, len(boxes))
+    logger.info("Received grouped detections")
+    return labels
+
+
+def group_labels(job):
+    # Cluster label per box, from the local grouper or the grouper service.
+    boxes, embeddings = job["boxes"], job["embeddings"]
+    if local is not None:
+        if embeddings is None:
+            decode_pixels(job)
+        with timed("group"):
+            clusters = grouper.run(
+                job["deadline"],
+                local.group,
+                job["pixels"],
+                boxes,
+                embeddings,
+                job["store_id"],
+            )
+        return cluster_labels(clusters)
+    return post_group(job, np.round(boxes.astype(np.float64), 2).tolist())
+
+
+def build_result(job, labels):
+    # Merged detections and summary for the job's boxes and labels, stored
+    # in the result cache when the job has a key.
+    bboxes = np.round(job["boxes"].astype(np.float64), 2).tolist()
+    detections = [
+        {"bbox": box, "label": label} for box, label in zip(bboxes, labels)
+    ]
+    with timed("merge"):
+        merged_detections = merge_grouped_boxes(
+            detections, iou_threshold=settings.merge_iou_threshold
+        )
 
+    result = summarize(detections, merged_detections)
+    if job["hierarchy_id"] is not None:
+        result["metadata"]["hierarchy_id"] = job["hierarchy_id"]
+    if job["result_key"] is not None:
+        result_cache.put(job["result_key"], result)
+    return result
+
+
+def group_stage(job):
+    # Second half of the pipeline: grouping, merging and storing the result.
+    return build_result(job, group_labels(job))
+
+
+def shelf_config():
+    # Everything besides the image that a shelf's stored boxes and labels
+    # depend on; a change forces a full run.
+    return cache_key(
+        downstream_config(), settings.grouping_features, settings.change_downscale
+    )
+
+
+def plan_shelf_update(state, thumbnail, size, config):
+    # How to process a new photo of a shelf given its stored state: "full"
+    # when there is no usable state or too much changed, "unchanged" when no
+    # block changed, otherwise "incremental" with the changed regions in
+    # full-image pixels. The shift is the camera translation since the
+    # previous photo, also in pixels.
+    plan = {"mode": "full", "shift": [0, 0], "regions": [], "changed_fraction": 1.0}
+    if state is None or state["size"] != size or state["config"] != config:
+        return plan
+
+    factor = settings.change_downscale
+    block = max(1, settings.change_block_size // factor)
+    height, width = thumbnail.shape
+    dx, dy = estimate_shift(state["thumbnail"].astype(np.float32), thumbnail)
+    if abs(dx) > width // 4 or abs(dy) > height // 4:
+        return plan
+
+    mask = changed_blocks(
+        state["thumbnail"], thumbnail, (dx, dy), block, settings.change_threshold
+    )
+    scale = block * factor
+    regions = [
+        [x0 * scale, y0 * scale, min(x1 * scale, size[0]), min(y1 * scale, size[1])]
+        for x0, y0, x1, y1 in changed_regions(mask)
+    ]
+    area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions)
+    plan.update(
+        shift=[dx * factor, dy * factor],
+        regions=regions,
+        changed_fraction=round(area / (size[0] * size[1]), 3),
+    )
+    if (
+        plan["changed_fraction"] > settings.change_max_fraction
+        or len(regions) > settings.change_max_regions
+    ):
+        return plan
+    plan["mode"] = "incremental" if regions else "unchanged"
+    return plan
+
+
+def detect_region(job, region, embeddings):
+    # (boxes, embeddings or None) of the detections centred in one changed
+    # region, in full-image pixels. The detector sees the region plus a
+    # margin, so products cut by the region's edge are still whole.
+    height, width = job["pixels"].shape[:2]
+    margin = settings.change_margin
+    x0, y0 = max(0, region[0] - margin), max(0, region[1] - margin)
+    x1, y1 = min(width, region[2] + margin), min(height, region[3] + margin)
+    deadline = job["deadline"]
+    if local is not None:
+        boxes, region_embeddings = detector.run(
+            deadline,
+            local.detect,
+            np.ascontiguousarray(job["pixels"][y0:y1, x0:x1]),
+            embeddings,
+            deadline.remaining(),
+        )
+    else:
+        with timed("serialize"):
+            crop = encode_crop(job["pixels"], (x0, y0, x1, y1))
+        response = detector.post(
+            DETECTOR_URL,
+            deadline,
+            files={"image": ("region.jpg", crop, "image/jpeg")},
+            data={"embeddings": "true"} if embeddings else None,
+            headers=wire_headers(),
+        )
+        response.raise_for_status()
+        boxes, region_embeddings = parse_detections(response)
+
+    boxes = boxes + np.array([x0, y0, x0, y0], dtype=np.float32)
+    inside = centers_inside(boxes, [region])
+    if region_embeddings is not None:
+        region_embeddings = region_embeddings[inside]
+    return boxes[inside], region_embeddings
+
+
+def process_shelf(image_bytes, upload, deadline, shelf_id, store_id=None):
+    # /process for a shelf that may have been photographed before. Only the
+    # regions that changed since its last photo go to the detector; boxes
+    # and cluster labels elsewhere are carried over from that photo.
+    with timed("change_detection"):
+        thumbnail, size = gray_thumbnail(image_bytes, settings.change_downscale)
+        state = shelf_store.get(shelf_id)
+        config = shelf_config()
+        plan = plan_shelf_update(state, thumbnail, size, config)
     logger.info(
-        "Box merging completed. Final merged box count: %d", len(final_detections)
+        "Shelf %s: %s update, %d regions, %.1f%% changed, shift %s",
+        shelf_id,
+        plan["mode"],
+        len(plan["regions"]),
+        plan["changed_fraction"] * 100,
+        plan["shift"],
     )
-    return final_detections
+
+    if plan["mode"] == "full":
+        job = detect_stage(image_bytes, upload, deadline, store_id, cache_result=False)
+        labels = group_labels(job) if job["result"] is None else []
+        clusters = cluster_ids(labels)
+    else:
+        job = new_job(image_bytes, upload, deadline, store_id)
+        clusters = update_shelf(job, state, plan)
+
+    shelf_store.put(
+        shelf_id, thumbnail, size, job["boxes"], clusters, job["embeddings"], config
+    )
+    result = build_result(job, cluster_labels(clusters))
+    result["metadata"]["shelf"] = {"shelf_id": shelf_id, **plan}
+    return result
+
+
+def update_shelf(job, state, plan):
+    # Sets the job's boxes and embeddings to the carried-over ones followed by
+    # those found in the changed regions, and returns their cluster IDs.
+    # New boxes are grouped together with the carried-over ones, and each
+    # resulting cluster is given the label its carried-over members had.
+    width, height = state["size"]
+    dx, dy = plan["shift"]
+    boxes = state["boxes"] + np.array([dx, dy, dx, dy], dtype=np.float32)
+    kept = centers_inside(boxes, [(0, 0, width, height)])
+    kept &= ~centers_inside(boxes, plan["regions"])
+    boxes = np.clip(boxes[kept], 0, [width, height, width, height])
+    previous = state["clusters"][kept]
+    embeddings = state["embeddings"]
+    if embeddings is not None:
+        embeddings = embeddings[kept]
+
+    new_boxes, new_embeddings = [], []
+    if plan["regions"]:
+        decode_pixels(job)
+        with timed("detect"):
+            for region in plan["regions"]:
+                region_boxes, region_embeddings = detect_region(
+                    job, region, embeddings is not None
+                )
+                new_boxes.append(region_boxes)
+                new_embeddings.append(region_embeddings)
+
+    job["boxes"] = np.concatenate([boxes, *new_boxes]).astype(np.float32)
+    if embeddings is not None:
+        job["embeddings"] = np.concatenate([embeddings, *new_embeddings])
+    if len(job["boxes"]) == len(boxes):
+        return previous
+
+    if local is None:
+        job["image_id"] = store_image(job["image_bytes"])
+    clusters = cluster_ids(group_labels(job))
+    is_kept = np.arange(len(clusters)) < len(previous)
+    next_id = int(state["clusters"].max(initial=-1)) + 1
+    return carry_labels(clusters, is_kept, previous, next_id)
+
+
+def run_pipeline(
+    image_bytes, upload, deadline, store_id=None, shelf_id=None, on_detected=None
+):
+    # Result for one image through the whole pipeline. Raises whatever the
+    # stages raise; pipeline_error turns that into a response. `on_detected`
+    # is called with the unlabelled detections before grouping, except for
+    # shelf updates.
+    if shelf_id is not None:
+        return process_shelf(image_bytes, upload, deadline, shelf_id, store_id)
+    job = detect_stage(image_bytes, upload, deadline, store_id)
+    if job["result"] is not None:
+        return job["result"]
+    if on_detected is not None:
+        bboxes = np.round(job["boxes"].astype(np.float64), 2).tolist()
+        on_detected([{"bbox": box} for box in bboxes])
+    return group_stage(job)
+
+
+def pipeline_error(e):
+    # (status, error message, Retry-After) for an exception from either stage.
+    # Overload and deadline warnings come in floods, so they are rate-limited.
+    if isinstance(e, Overloaded):
+        log_limited(logger, logging.WARNING, "Rejecting request: %s", e)
+        return 429, "Server busy, retry later", e.retry_after
+    if isinstance(e, (DeadlineExceeded, requests.Timeout)):
+        log_limited(logger, logging.WARNING, "Deadline exceeded: %s", e)
+        return 504, "Request deadline exceeded", None
+    if isinstance(e, requests.RequestException):
+        logger.exception("HTTP call failed: %s", e)
+        return 500, "Failed to contact downstream service", None
+    logger.exception("Unexpected error in pipeline: %s", e)
+    return 500, "Internal server error", None
 
 
 @server_bp.route("/process", methods=["POST"])
@@ -91,66 +819,300 @@ def process_image():
         return jsonify({"error": "No image provided"}), 400
 
     file = request.files["image"]
+    deadline = Deadline.from_header(
+        request.headers.get(DEADLINE_HEADER), settings.request_deadline
+    )
 
     try:
-        logger.info("Forwarding image to detector service at %s", DETECTOR_URL)
-        image_bytes = file.read()
-        detector_response = requests.post(
-            DETECTOR_URL,
-            files={"image": (file.filename, image_bytes, file.mimetype)},
-            timeout=DETECTOR_TIMEOUT,
+        return jsonify(
+            run_pipeline(
+                file.read(),
+                (file.filename, file.mimetype),
+                deadline,
+                request.form.get("store_id") or None,
+                request.form.get("shelf_id") or None,
+            )
         )
-        detector_response.raise_for_status()
-        detections_json = detector_response.json()
+    except Exception as e:
+        status, message, retry_after = pipeline_error(e)
+        response = jsonify({"error": message})
+        if retry_after is not None:
+            response.headers["Retry-After"] = str(retry_after)
+        return response, status
+
+
+def stream_batch(images, deadline_header, batch_id, store_id=None):
+    # Runs detect and group for many images on separate thread pools so image
+    # N+1 is being detected while image N is grouped, and yields one NDJSON
+    # line per image as soon as it finishes. At most batch_window images are
+    # read and in flight at once.
+    completed = queue.Queue()
+    detect_pool = ThreadPoolExecutor(
+        settings.batch_detect_workers, thread_name_prefix="batch-detect"
+    )
+    group_pool = ThreadPoolExecutor(
+        settings.batch_group_workers, thread_name_prefix="batch-group"
+    )
+
+    def finish(index, filename, started, result=None, error=None):
+        line = {
+            "index": index,
+            "filename": filename,
+            "request_id": f"{batch_id}-{index}",
+        }
+        if error is None:
+            line.update(status=200, **result)
+        else:
+            status, message, retry_after = pipeline_error(error)
+            line.update(status=status, error=message)
+            if retry_after is not None:
+                line["retry_after"] = retry_after
+        line["elapsed_s"] = round(time.perf_counter() - started, 4)
+        completed.put(line)
+
+    def grouped(index, filename, started, future):
+        try:
+            finish(index, filename, started, result=future.result())
+        except Exception as e:
+            finish(index, filename, started, error=e)
+
+    def detected(index, filename, started, future):
+        try:
+            job = future.result()
+        except Exception as e:
+            finish(index, filename, started, error=e)
+            return
+        if job["result"] is not None:
+            finish(index, filename, started, result=job["result"])
+            return
+        try:
+            future = group_pool.submit(
+                run_traced, f"{batch_id}-{index}", group_stage, job
+            )
+        except RuntimeError:
+            return  # batch was abandoned and the pool shut down
+        future.add_done_callback(partial(grouped, index, filename, started))
+
+    batch_started = time.perf_counter()
+    counts = {"images": 0, "failed": 0}
+    pending = 0
+    exhausted = False
+    images = enumerate(images)
+    try:
+        while True:
+            while not exhausted and pending < settings.batch_window:
+                try:
+                    index, (filename, image_bytes, mimetype) = next(images)
+                except StopIteration:
+                    exhausted = True
+                    break
+                except ValueError as e:
+                    logger.warning("Stopped reading batch input: %s", e)
+                    yield json.dumps({"error": str(e)}) + "\n"
+                    exhausted = True
+                    break
+
+                deadline = Deadline.from_header(
+                    deadline_header, settings.request_deadline
+                )
+                started = time.perf_counter()
+                detect_pool.submit(
+                    run_traced,
+                    f"{batch_id}-{index}",
+                    detect_stage,
+                    image_bytes,
+                    (filename, mimetype),
+                    deadline,
+                    store_id,
+                ).add_done_callback(partial(detected, index, filename, started))
+                pending += 1
+
+            if not pending:
+                break
+
+            line = completed.get()
+            pending -= 1
+            counts["images"] += 1
+            counts["failed"] += line["status"] != 200
+            yield json.dumps(line) + "\n"
+
+        elapsed = time.perf_counter() - batch_started
         logger.info(
-            "Detector returned %d detections",
-            len(detections_json.get("detections", [])),
+            "Batch finished: %d images, %d failed in %.2fs",
+            counts["images"],
+            counts["failed"],
+            elapsed,
         )
+        yield json.dumps({"summary": {**counts, "elapsed_s": round(elapsed, 4)}})
+        yield "\n"
+    finally:
+        # Also reached when the client disconnects mid-stream.
+        detect_pool.shutdown(wait=False, cancel_futures=True)
+        group_pool.shutdown(wait=False, cancel_futures=True)
 
-        detections = detections_json.get("detections", [])
-        if not detections:
-            logger.info("No detections found, skipping grouping step")
-            return jsonify({
-                "detections": [],
-                "metadata": {
-                    "cluster_counts": {},
-                    "total_clusters": 0,
-                },
-            })
-
-        logger.info("Forwarding detection result to grouper at %s", GROUPER_URL)
-        grouper_response = requests.post(
-            GROUPER_URL,
-            files={"image": (file.filename, image_bytes, file.mimetype)},
-            data={"detections": json.dumps(detections_json.get("detections", []))},
-            timeout=GROUPER_TIMEOUT,
+
+@server_bp.route("/process_batch", methods=["POST"])
+def process_batch():
+    images = spool_uploads(request.files.getlist("images"))
+    archives = spool_uploads(request.files.getlist("archive"))
+    if not images and not archives:
+        logger.warning("No images or archive in the batch request")
+        return jsonify({"error": "No images provided"}), 400
+
+    logger.info(
+        "Starting batch of %d images and %d archives", len(images), len(archives)
+    )
+    lines = stream_batch(
+        iter_batch_images(images, archives),
+        request.headers.get(DEADLINE_HEADER),
+        current_request_id(),
+        request.form.get("store_id") or None,
+    )
+    return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+
+
+def run_job(job, image_bytes):
+    # (status, result, error) for a queued job. A job refused because the
+    # detector or grouper queue is full goes back to the queue instead.
+    params = job["params"]
+    try:
+        result = run_pipeline(
+            image_bytes,
+            job["upload"],
+            Deadline(settings.request_deadline),
+            params.get("store_id"),
+            params.get("shelf_id"),
+            lambda detections: jobs.progress(job, {"detections": detections}),
         )
-        grouper_response.raise_for_status()
-        grouped_json = grouper_response.json()
-        logger.info("Received grouped detections")
+        return 200, result, None
+    except Overloaded as e:
+        logger.info("Requeueing job %s: %s", job["job_id"], e)
+        return None, None, None
+    except Exception as e:
+        status, message, _ = pipeline_error(e)
+        return status, None, message
 
-        detections = grouped_json.get("detections", [])
-        merged_detections = merge_grouped_boxes(detections, iou_threshold=0.33)
 
-        cluster_counts = {}
-        for d in detections:
-            label = d.get("label", "noise")
-            cluster_counts[label] = cluster_counts.get(label, 0) + 1
+def job_body(job):
+    return {k: v for k, v in job.items() if k not in ("upload", "claim")}
 
-        return jsonify(
-            {
-                "detections": merged_detections,
-                "metadata": {
-                    "cluster_counts": cluster_counts,
-                    "total_clusters": len(cluster_counts),
-                },
-            }
+
+@server_bp.route("/jobs", methods=["POST"])
+def submit_job():
+    # Queues an image for the pipeline and returns at once with the job's
+    # ID; results are fetched from GET /jobs/<job_id>.
+    if jobs is None:
+        return jsonify({"error": "Job API disabled"}), 404
+    if "image" not in request.files:
+        logger.warning("No image part in the job request")
+        return jsonify({"error": "No image provided"}), 400
+    priority = request.form.get("priority") or "interactive"
+    if priority not in PRIORITIES:
+        return jsonify({"error": "Invalid priority"}), 400
+
+    client = (
+        request.headers.get(CLIENT_ID_HEADER)
+        or request.form.get("client_id")
+        or request.remote_addr
+        or "anonymous"
+    )
+    params = {
+        name: request.form[name]
+        for name in ("store_id", "shelf_id")
+        if request.form.get(name)
+    }
+    file = request.files["image"]
+    try:
+        job, created = jobs.submit(
+            file.read(),
+            (file.filename, file.mimetype),
+            params,
+            client,
+            priority,
+            request.headers.get(IDEMPOTENCY_HEADER) or None,
         )
+    except QueueFull as e:
+        logger.warning("Rejecting job: %s", e)
+        response = jsonify({"error": "Job queue is full, retry later"})
+        response.headers["Retry-After"] = "5"
+        return response, 429
 
-    except requests.RequestException as e:
-        logger.exception("HTTP call failed: %s", e)
-        return jsonify({"error": "Failed to contact downstream service"}), 500
+    if created:
+        job_workers.wake()
+        logger.info("Queued %s job %s for %s", priority, job["job_id"], client)
+    response = jsonify(job_body(job))
+    response.headers["Location"] = f"/jobs/{job['job_id']}"
+    return response, 202 if created else 200
 
-    except Exception as e:
-        logger.exception("Unexpected error in /process: %s", e)
-        return jsonify({"error": "Internal server error"}), 500
+
+@server_bp.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    # The job's state, its detections before grouping once they are known,
+    # and its result or error once finished. With ?wait=N the request is
+    # held for up to N seconds (at most job_max_wait) until the job
+    # finishes, or with &partial=true until its detections are known.
+    if jobs is None:
+        return jsonify({"error": "Job API disabled"}), 404
+    if not JobQueue.valid_id(job_id):
+        return jsonify({"error": "Invalid job_id"}), 400
+    try:
+        wait = min(float(request.args.get("wait", 0)), settings.job_max_wait)
+    except ValueError:
+        return jsonify({"error": "Invalid wait"}), 400
+
+    partial = request.args.get("partial", "false").lower() == "true"
+    job = jobs.wait(job_id, wait, partial) if wait > 0 else jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job_id"}), 404
+    return jsonify(job_body(job))
+
+
+@server_bp.route("/healthz", methods=["GET"])
+def healthz():
+    return jsonify({"status": "ok"})
+
+
+@server_bp.route("/readyz", methods=["GET"])
+def readyz():
+    # Ready once both downstream services report ready, so that orchestration
+    # holds traffic while the detector loads and warms up its model.
+    if local is not None:
+        states = local.ready()
+    else:
+        states = {}
+        for name, service, url in (
+            ("detector", detector, settings.detector_ready_url),
+            ("grouper", grouper, settings.grouper_ready_url),
+        ):
+            try:
+                states[name] = service.session.get(url, timeout=2).ok
+            except requests.RequestException:
+                states[name] = False
+
+    ready = all(states.values())
+    services = {k: "ready" if v else "not_ready" for k, v in states.items()}
+    body = {"status": "ready" if ready else "not_ready", **services}
+    return jsonify(body), 200 if ready else 503
+
+
+@server_bp.route("/stats", methods=["GET"])
+def stats():
+    return jsonify(
+        {
+            "cache": {
+                "enabled": settings.cache_enabled,
+                "detections": detection_cache.stats(),
+                "results": result_cache.stats(),
+            },
+            "downstream": {
+                "detector": detector.stats(),
+                "grouper": grouper.stats(),
+            },
+        }
+    )
+
+
+job_workers = None
+if jobs is not None:
+    job_workers = JobWorkers(jobs, run_job, settings.job_workers)
+    job_workers.start()
@@ -0,0 +1,79 @@
+import mimetypes
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from collections import namedtuple
+from src.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff"}
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+Upload = namedtuple("Upload", ["filename", "mimetype", "stream"])
+
+
+def spool_uploads(files):
+    # Flask closes uploaded files when the view returns, before a streamed
+    # response has consumed them, so copy each into a spooled temporary file
+    # that stays in memory when small and spills to disk otherwise.
+    uploads = []
+    for file in files:
+        stream = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        shutil.copyfileobj(file.stream, stream)
+        stream.seek(0)
+        uploads.append(Upload(file.filename, file.mimetype, stream))
+    return uploads
+
+
+def _is_image_member(name: str) -> bool:
+    base = os.path.basename(name)
+    if not base or base.startswith(".") or "__MACOSX/" in name:
+        return False
+    return os.path.splitext(base)[1].lower() in IMAGE_EXTENSIONS
+
+
+def _iter_zip(stream):
+    with zipfile.ZipFile(stream) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not _is_image_member(info.filename):
+                continue
+            yield info.filename, archive.read(info)
+
+
+def _iter_tar(stream):
+    with tarfile.open(fileobj=stream, mode="r:*") as archive:
+        for member in archive:
+            if not member.isfile() or not _is_image_member(member.name):
+                continue
+            yield member.name, archive.extractfile(member).read()
+
+
+def iter_archive(upload):
+    # Images inside a zip or (optionally compressed) tar upload, read one
+    # member at a time so large archives are never fully held in memory.
+    stream = upload.stream
+    is_zip = zipfile.is_zipfile(stream)
+    stream.seek(0)
+    try:
+        members = _iter_zip(stream) if is_zip else _iter_tar(stream)
+        for name, data in members:
+            yield name, data, mimetypes.guess_type(name)[0]
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        logger.warning("Could not read archive '%s': %s", upload.filename, e)
+        raise ValueError(f"'{upload.filename}' is not a readable zip or tar archive")
+
+
+def iter_batch_images(images, archives):
+    # (filename, bytes, mimetype) for every uploaded image followed by every
+    # image found in the uploaded archives, in upload order. Each upload is
+    # closed once it has been read.
+    for upload in images:
+        with upload.stream:
+            yield upload.filename, upload.stream.read(), upload.mimetype
+    for upload in archives:
+        logger.info("Reading images from archive '%s'", upload.filename)
+        with upload.stream:
+            yield from iter_archive(upload)
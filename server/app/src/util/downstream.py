@@ -0,0 +1,141 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from src.util.logger import get_logger
+from src.util.metrics import REQUEST_ID_HEADER, current_request_id
+
+logger = get_logger(__name__)
+
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Overloaded(Exception):
+    def __init__(self, service, retry_after):
+        super().__init__(f"{service} queue is full")
+        self.retry_after = retry_after
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_header(cls, value, default: float):
+        try:
+            seconds = float(value) / 1000 if value else default
+        except ValueError:
+            seconds = default
+        return cls(min(seconds, default))
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def check(self) -> float:
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("Request deadline exceeded")
+        return remaining
+
+
+class Downstream:
+    # Pooled keep-alive client for one downstream service, with a cap on
+    # concurrent calls and a bounded number of callers waiting for a slot.
+
+    def __init__(self, name: str, max_in_flight: int, max_queue: int):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._in_flight = 0
+        self._latency = 1.0
+        self._rejected = 0
+
+    def retry_after(self) -> int:
+        # Time for the current queue to drain at the observed call latency.
+        with self._lock:
+            backlog = self._waiting + self._in_flight
+            latency = self._latency
+        return max(1, math.ceil(latency * backlog / self.max_in_flight))
+
+    @contextmanager
+    def _slot(self, deadline: Deadline):
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                self._rejected += 1
+                full = True
+            else:
+                self._waiting += 1
+                full = False
+        if full:
+            raise Overloaded(self.name, self.retry_after())
+
+        try:
+            acquired = self._slots.acquire(timeout=max(0.0, deadline.remaining()))
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        if not acquired:
+            raise DeadlineExceeded(f"Deadline exceeded waiting for {self.name}")
+
+        with self._lock:
+            self._in_flight += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._in_flight -= 1
+                self._latency = 0.8 * self._latency + 0.2 * elapsed
+            self._slots.release()
+
+    def request(self, method: str, url: str, deadline: Deadline, **kwargs):
+        with self._slot(deadline):
+            remaining = deadline.check()
+            headers = dict(kwargs.pop("headers", None) or {})
+            headers[DEADLINE_HEADER] = str(int(remaining * 1000))
+            request_id = current_request_id()
+            if request_id is not None:
+                headers[REQUEST_ID_HEADER] = request_id
+            return self.session.request(
+                method, url, headers=headers, timeout=remaining, **kwargs
+            )
+
+    def run(self, deadline: Deadline, fn, *args, **kwargs):
+        # Calls `fn` in-process under the same concurrency cap, queue bound
+        # and deadline as a request, for the monolith deployment.
+        with self._slot(deadline):
+            deadline.check()
+            return fn(*args, **kwargs)
+
+    def post(self, url: str, deadline: Deadline, **kwargs):
+        return self.request("POST", url, deadline, **kwargs)
+
+    def get(self, url: str, deadline: Deadline, **kwargs):
+        return self.request("GET", url, deadline, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue,
+                "rejected": self._rejected,
+                "latency_ewma_s": self._latency,
+            }
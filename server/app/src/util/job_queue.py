@@ -0,0 +1,487 @@
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from src.util.logger import get_logger
+from src.util.metrics import observe_stage, run_traced
+
+logger = get_logger(__name__)
+
+# Lower values are claimed first.
+PRIORITIES = {"interactive": 0, "bulk": 1}
+PRIORITY_NAMES = {value: name for name, value in PRIORITIES.items()}
+
+FINISHED_STATES = ("done", "failed")
+
+_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    client TEXT NOT NULL,
+    idempotency_key TEXT,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    params TEXT NOT NULL,
+    filename TEXT,
+    mimetype TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claim TEXT,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    status INTEGER,
+    result TEXT,
+    error TEXT,
+    partial TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_idempotency
+    ON jobs (client, idempotency_key) WHERE idempotency_key IS NOT NULL;
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, priority, created_at);
+CREATE TABLE IF NOT EXISTS clients (
+    client TEXT PRIMARY KEY,
+    last_served REAL NOT NULL
+);
+"""
+
+# Among the highest-priority queued jobs, the one whose client was served
+# least recently, then the oldest: clients take turns instead of a burst
+# from one client holding every worker. When each client was last served is
+# kept in its own table, so a claim looks it up once per queued job rather
+# than scanning the client's finished jobs.
+_NEXT_JOB = """
+SELECT j.id, j.client FROM jobs AS j
+LEFT JOIN clients AS c ON c.client = j.client
+WHERE j.state = 'queued'
+ORDER BY j.priority, COALESCE(c.last_served, 0), j.created_at
+LIMIT 1
+"""
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    # Pipeline jobs in a SQLite database under `root`, with each job's image
+    # stored next to it until the job finishes. The database is shared by
+    # every worker process on the host and survives restarts. A job is
+    # claimed by one worker in a single transaction and holds a lease while
+    # it runs. Finished jobs are never run again; a job whose worker died is
+    # queued again when its lease expires, up to `max_attempts` runs.
+
+    def __init__(
+        self,
+        root: str,
+        max_queued: int = 1000,
+        lease_seconds: float = 360,
+        max_attempts: int = 2,
+        retention_hours: float = 24,
+    ):
+        self.root = root
+        self.max_queued = max_queued
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention = retention_hours * 3600
+        self.path = os.path.join(root, "jobs.sqlite3")
+
+        self._local = threading.local()
+        self._finished = threading.Condition()
+        os.makedirs(os.path.join(root, "images"), exist_ok=True)
+        self._db().executescript(_SCHEMA)
+        self._migrate()
+
+    @staticmethod
+    def valid_id(job_id):
+        return bool(_ID_PATTERN.match(job_id))
+
+    def _migrate(self):
+        # Databases created before partial results lack the column. Another
+        # process may add it at the same time.
+        db = self._db()
+        columns = [row["name"] for row in db.execute("PRAGMA table_info(jobs)")]
+        if "partial" not in columns:
+            try:
+                db.execute("ALTER TABLE jobs ADD COLUMN partial TEXT")
+            except sqlite3.OperationalError:
+                pass
+        # Databases from before the clients table took when each client was
+        # last served from its jobs, with an index for that.
+        db.execute("DROP INDEX IF EXISTS jobs_client")
+        if db.execute("SELECT 1 FROM clients LIMIT 1").fetchone() is None:
+            db.execute(
+                "INSERT OR IGNORE INTO clients (client, last_served)"
+                " SELECT client, MAX(started_at) FROM jobs"
+                " WHERE started_at IS NOT NULL GROUP BY client"
+            )
+
+    def _db(self):
+        # One connection per thread, in autocommit mode so that transactions
+        # are explicit. WAL lets readers poll while a worker writes.
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _image_path(self, job_id):
+        return os.path.join(self.root, "images", job_id)
+
+    def submit(
+        self, image_bytes, upload, params, client, priority, idempotency_key=None
+    ):
+        # (job, created). A repeated idempotency key from the same client
+        # returns the existing job instead of queueing the image again.
+        # Raises QueueFull beyond `max_queued` queued jobs.
+        db = self._db()
+        if idempotency_key is not None:
+            existing = self._find(client, idempotency_key)
+            if existing is not None:
+                return existing, False
+
+        job_id = uuid.uuid4().hex
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, "images"))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(image_bytes)
+            os.replace(tmp_path, self._image_path(job_id))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                (queued,) = db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE state = 'queued'"
+                ).fetchone()
+                if queued >= self.max_queued:
+                    raise QueueFull(f"{queued} jobs queued")
+                db.execute(
+                    "INSERT INTO jobs (id, client, idempotency_key, priority, state,"
+                    " params, filename, mimetype, created_at)"
+                    " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+                    (
+                        job_id,
+                        client,
+                        idempotency_key,
+                        PRIORITIES[priority],
+                        json.dumps(params),
+                        upload[0],
+                        upload[1],
+                        time.time(),
+                    ),
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        except sqlite3.IntegrityError:
+            # The same key was submitted concurrently and the other won.
+            self._remove_image(job_id)
+            return self._find(client, idempotency_key), False
+        except BaseException:
+            self._remove_image(job_id)
+            raise
+        return self.get(job_id), True
+
+    def _find(self, client, idempotency_key):
+        row = (
+            self._db()
+            .execute(
+                "SELECT * FROM jobs WHERE client = ? AND idempotency_key = ?",
+                (client, idempotency_key),
+            )
+            .fetchone()
+        )
+        return self._job(row)
+
+    def claim(self):
+        # The next job to run, marked running under a new claim token, or
+        # None if nothing is queued. Expired leases are resolved first.
+        db = self._db()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(
+                "UPDATE jobs SET state = 'queued', claim = NULL, lease_until = NULL"
+                " WHERE state = 'running' AND lease_until < ? AND attempts < ?",
+                (now, self.max_attempts),
+            )
+            expired = [
+                row["id"]
+                for row in db.execute(
+                    "SELECT id FROM jobs WHERE state = 'running' AND lease_until < ?",
+                    (now,),
+                )
+            ]
+            db.execute(
+                "UPDATE jobs SET state = 'failed', status = 500, finished_at = ?,"
+                " error = 'Job was interrupted', claim = NULL, lease_until = NULL"
+                " WHERE state = 'running' AND lease_until < ?",
+                (now, now),
+            )
+            row = db.execute(_NEXT_JOB).fetchone()
+            if row is not None:
+                claim = uuid.uuid4().hex
+                db.execute(
+                    "UPDATE jobs SET state = 'running', claim = ?, lease_until = ?,"
+                    " started_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    (claim, now + self.lease_seconds, now, row["id"]),
+                )
+                db.execute(
+                    "INSERT OR REPLACE INTO clients (client, last_served)"
+                    " VALUES (?, ?)",
+                    (row["client"], now),
+                )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+        if expired:
+            logger.warning(
+                "%d jobs failed after %d attempts", len(expired), self.max_attempts
+            )
+            for job_id in expired:
+                self._remove_image(job_id)
+            self._notify()
+        if row is None:
+            return None
+        job = self.get(row["id"])
+        job["claim"] = claim
+        return job
+
+    def image(self, job):
+        with open(self._image_path(job["job_id"]), "rb") as f:
+            return f.read()
+
+    def finish(self, job, status, result=None, error=None):
+        # Stores the outcome of a claimed job. Ignored if the lease expired
+        # and the job was handed to another worker in the meantime.
+        updated = (
+            self._db()
+            .execute(
+                "UPDATE jobs SET state = ?, status = ?, result = ?, error = ?,"
+                " finished_at = ?, claim = NULL, lease_until = NULL, partial = NULL"
+                " WHERE id = ? AND claim = ?",
+                (
+                    "done" if error is None else "failed",
+                    status,
+                    json.dumps(result) if result is not None else None,
+                    error,
+                    time.time(),
+                    job["job_id"],
+                    job["claim"],
+                ),
+            )
+            .rowcount
+        )
+        if not updated:
+            logger.warning("Job %s lost its lease before finishing", job["job_id"])
+            return
+        self._remove_image(job["job_id"])
+        self._notify()
+
+    def progress(self, job, partial):
+        # Stores a partial result of a claimed job, shown while it runs.
+        # Best effort: a failed write only delays what clients see.
+        try:
+            self._db().execute(
+                "UPDATE jobs SET partial = ? WHERE id = ? AND claim = ?",
+                (json.dumps(partial), job["job_id"], job["claim"]),
+            )
+        except sqlite3.Error as e:
+            logger.warning("Could not store progress of job %s: %s", job["job_id"], e)
+            return
+        self._notify()
+
+    def _remove_image(self, job_id):
+        try:
+            os.unlink(self._image_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def release(self, job):
+        # Returns a claimed job to the queue without counting the attempt,
+        # for work the pipeline refused because it was overloaded.
+        self._db().execute(
+            "UPDATE jobs SET state = 'queued', claim = NULL, lease_until = NULL,"
+            " started_at = NULL, attempts = attempts - 1 WHERE id = ? AND claim = ?",
+            (job["job_id"], job["claim"]),
+        )
+
+    def _notify(self):
+        with self._finished:
+            self._finished.notify_all()
+
+    def get(self, job_id):
+        row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return self._job(row.fetchone())
+
+    def wait(self, job_id, timeout, partial=False):
+        # The job once it has finished, or with `partial` once it has a
+        # partial result, or when `timeout` seconds have passed. Updates in
+        # this process wake the waiter at once; jobs run by other processes
+        # are seen within half a second.
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if (
+                job is None
+                or job["state"] in FINISHED_STATES
+                or (partial and "partial" in job)
+                or remaining <= 0
+            ):
+                return job
+            with self._finished:
+                self._finished.wait(min(remaining, 0.5))
+
+    def _job(self, row):
+        if row is None:
+            return None
+        job = {
+            "job_id": row["id"],
+            "client": row["client"],
+            "priority": PRIORITY_NAMES[row["priority"]],
+            "state": row["state"],
+            "params": json.loads(row["params"]),
+            "upload": (row["filename"], row["mimetype"]),
+            "attempts": row["attempts"],
+            "created_at": row["created_at"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"],
+        }
+        if row["state"] in FINISHED_STATES:
+            job["status"] = row["status"]
+            if row["result"] is not None:
+                job["result"] = json.loads(row["result"])
+            if row["error"] is not None:
+                job["error"] = row["error"]
+        elif row["partial"] is not None:
+            job["partial"] = json.loads(row["partial"])
+        return job
+
+    def counts(self):
+        # {(priority, state): jobs} for every priority and unfinished state.
+        counts = {
+            (name, state): 0 for name in PRIORITIES for state in ("queued", "running")
+        }
+        rows = self._db().execute(
+            "SELECT priority, state, COUNT(*) FROM jobs"
+            " WHERE state IN ('queued', 'running') GROUP BY priority, state"
+        )
+        for priority, state, count in rows:
+            counts[(PRIORITY_NAMES[priority], state)] = count
+        return counts
+
+    def oldest_wait(self):
+        # {(priority,): seconds the oldest queued job has waited}.
+        now = time.time()
+        waits = {(name,): 0.0 for name in PRIORITIES}
+        rows = self._db().execute(
+            "SELECT priority, MIN(created_at) FROM jobs"
+            " WHERE state = 'queued' GROUP BY priority"
+        )
+        for priority, created_at in rows:
+            waits[(PRIORITY_NAMES[priority],)] = round(now - created_at, 3)
+        return waits
+
+    def purge(self):
+        # Deletes finished jobs older than the retention period, and clients
+        # not served within it. Those would be claimed ahead of every recently
+        # served client with or without their entry.
+        db = self._db()
+        cutoff = time.time() - self.retention
+        deleted = db.execute(
+            "DELETE FROM jobs WHERE state IN ('done', 'failed') AND finished_at < ?",
+            (cutoff,),
+        ).rowcount
+        db.execute("DELETE FROM clients WHERE last_served < ?", (cutoff,))
+        if deleted:
+            logger.info("Purged %d finished jobs", deleted)
+
+
+class JobWorkers:
+    # A pool of threads that claim jobs from a JobQueue and run them with
+    # `run(job, image_bytes)`, which returns (status, result, error), or a
+    # None status to put the job back in the queue for later. Each
+    # job is traced under its job ID, and its time in the queue is recorded
+    # as the `job_wait` stage.
+
+    def __init__(self, jobs: JobQueue, run, count: int, poll_interval: float = 0.5):
+        self.jobs = jobs
+        self.run = run
+        self.count = count
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._last_purge = 0.0
+
+    def start(self):
+        for i in range(self.count):
+            threading.Thread(
+                target=self._loop, name=f"job-worker-{i}", daemon=True
+            ).start()
+        logger.info("Started %d job workers", self.count)
+
+    def wake(self):
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            try:
+                job = self.jobs.claim()
+            except sqlite3.Error as e:
+                logger.warning("Could not claim a job: %s", e)
+                job = None
+            if job is None:
+                self._purge()
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            observe_stage("job_wait", job["started_at"] - job["created_at"])
+            run_traced(job["job_id"], self._run, job)
+
+    def _run(self, job):
+        try:
+            image_bytes = self.jobs.image(job)
+        except FileNotFoundError:
+            self.jobs.finish(job, 500, error="Job image is missing")
+            return
+
+        logger.info(
+            "Running %s job %s for %s (attempt %d)",
+            job["priority"],
+            job["job_id"],
+            job["client"],
+            job["attempts"],
+        )
+        try:
+            status, result, error = self.run(job, image_bytes)
+        except Exception as e:
+            logger.exception("Job %s failed: %s", job["job_id"], e)
+            status, result, error = 500, None, "Internal server error"
+        if status is None:
+            self.jobs.release(job)
+            time.sleep(self.poll_interval)
+            return
+        self.jobs.finish(job, status, result, error)
+
+    def _purge(self):
+        now = time.monotonic()
+        if now - self._last_purge < 600:
+            return
+        self._last_purge = now
+        try:
+            self.jobs.purge()
+        except sqlite3.Error as e:
+            logger.warning("Could not purge finished jobs: %s", e)
@@ -0,0 +1,100 @@
+import importlib
+import os
+import sys
+import numpy as np
+from src.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Repository root when running from a checkout; the monolith image copies the
+# detector and grouper apps to the same relative paths under its own root.
+DEFAULT_ROOT = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "..", "..", "..")
+)
+
+# Utility modules that are identical in every service. The other services
+# use the server's copies, so their stage timings land in the server's
+# request traces and their callbacks in its /metrics.
+SHARED_MODULES = ("src.util.logger", "src.util.metrics")
+
+
+def _is_src(name):
+    return name == "src" or name.startswith("src.")
+
+
+def load_service(name, app_dir):
+    # Imports another service's blueprint module into this process. Every
+    # service is an app with its own top-level `src` package, so the server's
+    # modules are set aside while the other service is imported, and that
+    # service's modules are then kept as `<name>_src...` so the two never
+    # resolve to each other. Must run before requests are served.
+    own = {k: sys.modules.pop(k) for k in list(sys.modules) if _is_src(k)}
+    sys.modules.update({k: own[k] for k in SHARED_MODULES if k in own})
+    sys.path.insert(0, app_dir)
+    try:
+        module = importlib.import_module(f"src.blueprints.{name}")
+    finally:
+        loaded = {k: sys.modules.pop(k) for k in list(sys.modules) if _is_src(k)}
+        sys.path.remove(app_dir)
+        sys.modules.update(own)
+    for key, value in loaded.items():
+        if key not in SHARED_MODULES:
+            sys.modules[f"{name}_{key}"] = value
+    logger.info("Loaded %s in-process from %s", name, app_dir)
+    return module
+
+
+class LocalServices:
+    # The detector and grouper as library calls in the server process, for
+    # single-node deployments. Each image is decoded once and the same pixel
+    # array is used for detection and crop features.
+
+    def __init__(self, root=""):
+        root = root or DEFAULT_ROOT
+        self.detector = load_service("detector", os.path.join(root, "detector", "app"))
+        self.grouper = load_service("grouper", os.path.join(root, "grouper", "app"))
+        self.detector.start_worker()
+
+    def ready(self):
+        return {
+            "detector": self.detector.wait_ready(0),
+            "grouper": self.grouper.wait_ready(0),
+        }
+
+    def config(self):
+        return {
+            "detector": self.detector.config_values(),
+            "grouper": self.grouper.config_values(),
+        }
+
+    def detect(self, pixels, embeddings, timeout):
+        # (boxes, embeddings or None) for an RGB array, like the detector's
+        # packed response.
+        detector = self.detector
+        if not detector.wait_ready(timeout):
+            raise RuntimeError("Detection model not ready")
+        rows = detector.detect_frame(
+            detector.frame_from_array(pixels),
+            detector.settings.tiling_enabled,
+            timeout,
+            embeddings,
+        )
+        boxes = rows[:, 2:6].astype(np.float32)
+        return boxes, detector.embedding_array(rows) if embeddings else None
+
+    def group(self, pixels, boxes, embeddings, store_id):
+        # Cluster ID per box, -1 for noise, like the grouper's packed response.
+        grouper = self.grouper
+        if store_id is not None:
+            if not grouper.PrototypeIndex.valid_store_id(store_id):
+                raise ValueError(f"Invalid store ID '{store_id}'")
+            if grouper.prototype_index is None:
+                store_id = None
+
+        X, valid_indices, source = grouper.box_features(boxes, embeddings, pixels)
+        if not valid_indices:
+            raise ValueError("No valid features")
+        clusters, _ = grouper.group_boxes(
+            X, valid_indices, len(boxes), store_id, source
+        )
+        return clusters
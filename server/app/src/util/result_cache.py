@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from src.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def cache_key(*parts) -> str:
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    # In-process LRU of JSON-serializable results, optionally backed by a
+    # directory of JSON files that survives restarts.
+
+    def __init__(self, name: str, max_items: int, disk_dir="", disk_max_items=0):
+        self.name = name
+        self.max_items = max_items
+        self.disk_dir = os.path.join(disk_dir, name) if disk_dir else ""
+        self.disk_max_items = disk_max_items
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "disk_evictions": 0,
+        }
+
+    def _count(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] += amount
+
+    def get(self, key: str):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._counters["hits"] += 1
+                return self._memory[key]
+
+        value = self._disk_get(key)
+        if value is None:
+            self._count("misses")
+            return None
+
+        self._count("disk_hits")
+        self._memory_put(key, value)
+        return value
+
+    def put(self, key: str, value):
+        self._count("stores")
+        self._memory_put(key, value)
+        self._disk_put(key, value)
+
+    def _memory_put(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(self._disk_path(key))
+            return value
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Failed to read %s cache entry %s: %s", self.name, key, e)
+            return None
+
+    def _disk_put(self, key, value):
+        if not self.disk_dir:
+            return
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, self._disk_path(key))
+            self._disk_evict()
+        except OSError as e:
+            logger.warning("Failed to write %s cache entry %s: %s", self.name, key, e)
+
+    def _disk_evict(self):
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".json"):
+                path = os.path.join(self.disk_dir, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except FileNotFoundError:
+                    continue
+
+        excess = len(entries) - self.disk_max_items
+        if excess <= 0:
+            return
+        entries.sort()
+        for _, path in entries[:excess]:
+            try:
+                os.unlink(path)
+                self._count("disk_evictions")
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            lookups = (
+                self._counters["hits"]
+                + self._counters["disk_hits"]
+                + self._counters["misses"]
+            )
+            hits = self._counters["hits"] + self._counters["disk_hits"]
+            return {
+                **self._counters,
+                "items": len(self._memory),
+                "max_items": self.max_items,
+                "disk_enabled": bool(self.disk_dir),
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
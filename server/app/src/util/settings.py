@@ -8,13 +8,58 @@ class Settings(BaseSettings):
         " %(levelname)s -"
         " %(filename)s:%(lineno)d - %(name)s - %(message)s"
     )
+    log_async: bool = True
+    log_json: bool = False
+    log_queue_size: int = 10000
     host: str = "0.0.0.0"
     port: int = 5000
     debug: bool = False
+    pipeline_mode: str = "services"
+    services_root: str = ""
     detector_url: str = "http://detector:5001/detect"
     grouper_url: str = "http://grouper:5003/group"
-    detector_timeout: float = 300
-    grouper_timeout: float = 300
+    request_deadline: float = 300
+    detector_max_in_flight: int = 4
+    detector_max_queue: int = 32
+    grouper_max_in_flight: int = 4
+    grouper_max_queue: int = 32
+    detector_config_url: str = "http://detector:5001/config"
+    grouper_config_url: str = "http://grouper:5003/config"
+    detector_ready_url: str = "http://detector:5001/readyz"
+    grouper_ready_url: str = "http://grouper:5003/readyz"
+    merge_iou_threshold: float = 0.33
+    grouping_features: str = "pixels"
+    wire_format: str = "binary"
+    image_store_enabled: bool = False
+    image_store_dir: str = "/dev/shm/sku-vision"
+    image_store_max_items: int = 64
+    image_store_max_bytes: int = 1 << 30
+    cache_enabled: bool = True
+    cache_max_items: int = 256
+    cache_dir: str = ""
+    cache_disk_max_items: int = 10000
+    downstream_config_ttl: float = 30
+    shelf_state_dir: str = "/tmp/sku-vision/shelves"
+    shelf_state_max_items: int = 1024
+    change_downscale: int = 4
+    change_block_size: int = 64
+    change_threshold: float = 12.0
+    change_margin: int = 128
+    change_max_fraction: float = 0.5
+    change_max_regions: int = 8
+    jobs_enabled: bool = True
+    job_dir: str = "/tmp/sku-vision/jobs"
+    job_workers: int = 2
+    job_max_queued: int = 1000
+    job_max_attempts: int = 2
+    job_retention_hours: float = 24
+    job_max_wait: float = 30
+    batch_window: int = 16
+    batch_detect_workers: int = 4
+    batch_group_workers: int = 4
+    profiling_enabled: bool = False
+    profile_dir: str = "/tmp/profiles"
+    profile_interval_ms: float = 5
 
     class Config:
         env_prefix = "SERVER_"
@@ -0,0 +1,251 @@
+import hashlib
+import itertools
+import os
+import tempfile
+from collections import Counter
+from io import BytesIO
+import numpy as np
+from PIL import Image, ImageOps
+from src.util.logger import get_logger
+
+logger = get_logger(__name__)
+
+# EXIF orientations that swap width and height.
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def gray_thumbnail(data, factor):
+    # Grayscale float32 image at 1/factor of the full size, and the full
+    # (width, height) after EXIF rotation. JPEGs are decoded at reduced size
+    # by libjpeg, so this costs a fraction of a full decode.
+    image = Image.open(BytesIO(data))
+    width, height = image.size
+    if image.getexif().get(0x0112) in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    size = (max(1, width // factor), max(1, height // factor))
+
+    image.draft("L", image.size if size == (width, height) else size)
+    image = ImageOps.exif_transpose(image).convert("L")
+    if image.size != size:
+        image = image.resize(size, Image.BOX)
+    return np.asarray(image, dtype=np.float32), (width, height)
+
+
+def estimate_shift(previous, current):
+    # (dx, dy) translation of `current` relative to `previous`, in thumbnail
+    # pixels, by phase correlation: content at x in `previous` is at x + dx
+    # in `current`.
+    h, w = current.shape
+    window = np.outer(np.hanning(h), np.hanning(w)).astype(np.float32)
+    a = np.fft.rfft2((previous - previous.mean()) * window)
+    b = np.fft.rfft2((current - current.mean()) * window)
+    cross = b * np.conj(a)
+    cross /= np.abs(cross) + 1e-9
+    correlation = np.fft.irfft2(cross, s=(h, w))
+    dy, dx = np.unravel_index(np.argmax(correlation), correlation.shape)
+    return int(dx - w if dx > w // 2 else dx), int(dy - h if dy > h // 2 else dy)
+
+
+def changed_blocks(previous, current, shift, block, threshold):
+    # Boolean grid of `block`-pixel blocks of `current` whose mean absolute
+    # difference from the shifted `previous` exceeds `threshold` grey levels.
+    # The median difference is subtracted first, so an exposure change
+    # between shots does not mark the whole shelf. Blocks the shift moved in
+    # from outside the previous frame always count as changed.
+    h, w = current.shape
+    dx, dy = shift
+    diff = np.full((h, w), 255, dtype=np.float32)
+    cur = (slice(max(0, dy), min(h, h + dy)), slice(max(0, dx), min(w, w + dx)))
+    prev = (slice(max(0, -dy), min(h, h - dy)), slice(max(0, -dx), min(w, w - dx)))
+    overlap = current[cur] - previous[prev]
+    if overlap.size:
+        diff[cur] = np.abs(overlap - np.median(overlap))
+
+    grid_h, grid_w = -(-h // block), -(-w // block)
+    padded = np.zeros((grid_h * block, grid_w * block), dtype=np.float32)
+    padded[:h, :w] = diff
+    counts = np.zeros_like(padded)
+    counts[:h, :w] = 1
+    sums = padded.reshape(grid_h, block, grid_w, block).sum(axis=(1, 3))
+    sizes = counts.reshape(grid_h, block, grid_w, block).sum(axis=(1, 3))
+    return sums / sizes > threshold
+
+
+def _dilate(mask):
+    grown = mask.copy()
+    grown[1:] |= mask[:-1]
+    grown[:-1] |= mask[1:]
+    grown[:, 1:] |= mask[:, :-1]
+    grown[:, :-1] |= mask[:, 1:]
+    return grown
+
+
+def _union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def changed_regions(mask, min_fill=0.5):
+    # (x0, y0, x1, y1) block rectangles covering the changed blocks, each
+    # block grown by one so that products straddling a block edge are
+    # inside. A bounding rectangle that is mostly unchanged, like the L of
+    # a shifted frame's edges, is split in half along its longer side until
+    # each piece is at least `min_fill` changed. The pieces never overlap.
+    mask = _dilate(mask)
+    rects = []
+
+    def cover(y0, y1, x0, x1):
+        sub = mask[y0:y1, x0:x1]
+        rows, cols = np.flatnonzero(sub.any(axis=1)), np.flatnonzero(sub.any(axis=0))
+        if not len(rows):
+            return
+        y0, y1 = y0 + int(rows[0]), y0 + int(rows[-1]) + 1
+        x0, x1 = x0 + int(cols[0]), x0 + int(cols[-1]) + 1
+        if mask[y0:y1, x0:x1].mean() >= min_fill:
+            rects.append((x0, y0, x1, y1))
+        elif y1 - y0 >= x1 - x0:
+            cover(y0, (y0 + y1) // 2, x0, x1)
+            cover((y0 + y1) // 2, y1, x0, x1)
+        else:
+            cover(y0, y1, x0, (x0 + x1) // 2)
+            cover(y0, y1, (x0 + x1) // 2, x1)
+
+    cover(0, mask.shape[0], 0, mask.shape[1])
+
+    # Halving can cut a strip into pieces that are fine together; rejoin
+    # neighbours whose union is still filled enough, so that there are fewer
+    # detector calls.
+    merged = True
+    while merged:
+        merged = False
+        for i, j in itertools.combinations(range(len(rects)), 2):
+            union = _union(rects[i], rects[j])
+            others = [r for k, r in enumerate(rects) if k not in (i, j)]
+            x0, y0, x1, y1 = union
+            if mask[y0:y1, x0:x1].mean() >= min_fill and not any(
+                _overlaps(union, r) for r in others
+            ):
+                rects = others + [union]
+                merged = True
+                break
+    return rects
+
+
+def encode_crop(pixels, rect, quality=95):
+    # JPEG bytes of an (x0, y0, x1, y1) crop of an RGB array, for sending a
+    # changed region to the detector.
+    x0, y0, x1, y1 = rect
+    buffer = BytesIO()
+    Image.fromarray(pixels[y0:y1, x0:x1]).save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def centers_inside(boxes, regions):
+    # Whether each box's center lies in any of the (x0, y0, x1, y1) regions.
+    inside = np.zeros(len(boxes), dtype=bool)
+    if not len(boxes):
+        return inside
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    for x0, y0, x1, y1 in regions:
+        inside |= (cx >= x0) & (cx < x1) & (cy >= y0) & (cy < y1)
+    return inside
+
+
+def cluster_ids(labels):
+    return np.array(
+        [-1 if label == "noise" else int(label.rsplit("_", 1)[1]) for label in labels],
+        dtype=np.int64,
+    )
+
+
+def carry_labels(clusters, kept, previous, next_id):
+    # Cluster IDs for a shelf where only some boxes are new. Boxes carried
+    # over (`kept`) keep their `previous` IDs. Each new cluster of the
+    # regrouped shelf takes the most common previous ID among its carried-over
+    # members, or a fresh ID from `next_id` if it has none.
+    result = np.full(len(clusters), -1, dtype=np.int64)
+    result[kept] = previous
+    new = ~kept
+    for cid in np.unique(clusters[new]):
+        if cid == -1:
+            continue
+        members = clusters == cid
+        votes = Counter(int(v) for v in result[members & kept] if v != -1)
+        if votes:
+            label = votes.most_common(1)[0][0]
+        else:
+            label, next_id = next_id, next_id + 1
+        result[members & new] = label
+    return result
+
+
+class ShelfStore:
+    # Last processed frame of each shelf: a grayscale thumbnail for change
+    # detection, and its boxes, cluster IDs and (with embedding features)
+    # detector embeddings. One .npz file per shelf, named by a hash of the
+    # shelf ID, so every worker sees the same state. The least recently
+    # updated shelves beyond `max_items` are evicted.
+
+    def __init__(self, root: str, max_items: int = 1024):
+        self.root = root
+        self.max_items = max_items
+
+    def _path(self, shelf_id: str) -> str:
+        name = hashlib.sha256(shelf_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, f"{name}.npz")
+
+    def get(self, shelf_id: str):
+        # {"thumbnail", "size", "boxes", "clusters", "embeddings", "config"}
+        # or None for an unknown shelf.
+        try:
+            with np.load(self._path(shelf_id), allow_pickle=False) as data:
+                state = {name: data[name] for name in data.files}
+        except FileNotFoundError:
+            return None
+        state["size"] = tuple(int(v) for v in state["size"])
+        state["config"] = str(state["config"])
+        state.setdefault("embeddings", None)
+        return state
+
+    def put(self, shelf_id, thumbnail, size, boxes, clusters, embeddings, config):
+        arrays = {
+            "thumbnail": np.clip(np.rint(thumbnail), 0, 255).astype(np.uint8),
+            "size": np.asarray(size, dtype=np.int64),
+            "boxes": np.asarray(boxes, dtype=np.float32).reshape(-1, 4),
+            "clusters": np.asarray(clusters, dtype=np.int64),
+            "config": np.asarray(config),
+        }
+        if embeddings is not None:
+            arrays["embeddings"] = embeddings
+
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self._path(shelf_id))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith(".npz"):
+                path = os.path.join(self.root, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except FileNotFoundError:
+                    continue
+
+        entries.sort()
+        for _, path in entries[: max(0, len(entries) - self.max_items)]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,147 @@
+import argparse
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+# (label, SERVER_LOG_ASYNC, SERVER_LOG_JSON, per-item lines)
+MODES = [
+    ("before: per-item, sync", "false", "false", True),
+    ("after: summary, sync", "false", "false", False),
+    ("after: summary, async", "true", "false", False),
+    ("after: summary, async JSON", "true", "true", False),
+    ("per-item, async", "true", "false", True),
+]
+
+
+def verbose_merge(merge_cluster, logger, detections, iou_threshold):
+    # The merge as it logged before summary counters: a line per merge and
+    # per cluster, with the boxes interpolated.
+    merged_by_cluster = {}
+    for d in detections:
+        merged_by_cluster.setdefault(d.get("label", "noise"), []).append(d["bbox"])
+
+    final_detections = []
+    logger.info(
+        "Starting merge of grouped boxes with IoU threshold %.2f", iou_threshold
+    )
+    for label, boxes in merged_by_cluster.items():
+        merged_boxes, merges = merge_cluster(boxes, iou_threshold)
+        for box in boxes[:merges]:
+            logger.debug("Merging box %s with %s", merged_boxes[0], box)
+        logger.debug(
+            "Cluster '%s': merged %d boxes into %d (%d merges)",
+            label,
+            len(boxes),
+            len(merged_boxes),
+            merges,
+        )
+        final_detections.extend({"bbox": box, "label": label} for box in merged_boxes)
+    logger.info(
+        "Box merging completed. Final merged box count: %d", len(final_detections)
+    )
+    return final_detections
+
+
+class Recorder:
+    # Stands in for a logger to capture the calls one merge makes.
+
+    def __init__(self):
+        self.calls = []
+
+    def log(self, level, msg, *args):
+        self.calls.append((level, msg, args))
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+
+def measure(args, per_item):
+    # Runs in a child process, whose logger settings come from the
+    # environment. Captures the log calls of one merge, then replays them
+    # through the real logger, so that the noise of the merge itself does
+    # not swamp the comparison. Prints the merge's milliseconds, the
+    # fastest request-thread milliseconds of its logging, and the number of
+    # records dropped.
+    from bench_merge import random_detections
+    from src.blueprints import server
+    from src.util.logger import dropped_records
+
+    rng = random.Random(args.seed)
+    detections = random_detections(rng, args.boxes, clusters=args.clusters)
+    recorder = Recorder()
+    started = time.perf_counter()
+    if per_item:
+        verbose_merge(server._merge_cluster, recorder, detections, args.threshold)
+    else:
+        logger, server.logger = server.logger, recorder
+        server.merge_grouped_boxes(detections, args.threshold)
+        server.logger = logger
+    merge_ms = (time.perf_counter() - started) * 1000
+
+    samples = []
+    for _ in range(args.repeats):
+        started = time.perf_counter()
+        for level, msg, call_args in recorder.calls:
+            server.logger.log(level, msg, *call_args)
+        samples.append(time.perf_counter() - started)
+        # Lets the writer thread drain, as it would between requests.
+        time.sleep(0.02)
+    print(merge_ms, min(samples) * 1000, len(recorder.calls), dropped_records())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Logging cost of a box merge")
+    parser.add_argument("--boxes", type=int, default=1000)
+    parser.add_argument("--clusters", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.33)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", choices=["per-item", "summary"])
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args, args.child == "per-item")
+        return
+
+    print(f"{args.boxes} boxes, {args.clusters} clusters, DEBUG level")
+    print(f"{'mode':<28} {'lines':>6} {'merge ms':>9} {'logging ms':>11}")
+    for label, log_async, log_json, per_item in MODES:
+        env = dict(
+            os.environ,
+            SERVER_LOG_LEVEL="DEBUG",
+            SERVER_LOG_ASYNC=log_async,
+            SERVER_LOG_JSON=log_json,
+            SERVER_JOBS_ENABLED="false",
+        )
+        command = [sys.executable, __file__, "--child"]
+        command.append("per-item" if per_item else "summary")
+        for name in ("boxes", "clusters", "threshold", "repeats", "seed"):
+            command += [f"--{name}", str(getattr(args, name))]
+        # Log lines go to a file, as they would to a container's log driver.
+        with tempfile.TemporaryFile() as log_file:
+            output = subprocess.run(
+                command, env=env, stdout=subprocess.PIPE, stderr=log_file, text=True
+            ).stdout
+        merge_ms, logging_ms, lines, dropped = output.split()[-4:]
+        print(
+            f"{label:<28} {lines:>6} {float(merge_ms):>9.2f}"
+            f" {float(logging_ms):>11.3f}"
+            + (f"  ({dropped} dropped)" if int(dropped) else "")
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from src.blueprints.server import compute_iou, merge_grouped_boxes  # noqa: E402
+
+
+def reference_merge(detections, iou_threshold=0.7):
+    # The original pairwise implementation, kept as the oracle for the
+    # vectorized merge.
+    merged_by_cluster = {}
+    for d in detections:
+        merged_by_cluster.setdefault(d.get("label", "noise"), []).append(d["bbox"])
+
+    final_detections = []
+    for label, boxes in merged_by_cluster.items():
+        used = [False] * len(boxes)
+        for i, box_i in enumerate(boxes):
+            if used[i]:
+                continue
+            merged_box = list(box_i)
+            for j, box_j in enumerate(boxes[i + 1:], start=i + 1):
+                if used[j]:
+                    continue
+                if compute_iou(merged_box, box_j) >= iou_threshold:
+                    merged_box[0] = min(merged_box[0], box_j[0])
+                    merged_box[1] = min(merged_box[1], box_j[1])
+                    merged_box[2] = max(merged_box[2], box_j[2])
+                    merged_box[3] = max(merged_box[3], box_j[3])
+                    used[j] = True
+            used[i] = True
+            final_detections.append({"bbox": merged_box, "label": label})
+    return final_detections
+
+
+def random_detections(rng, count, clusters, width=4000, height=3000, max_side=300):
+    detections = []
+    for _ in range(count):
+        # Jittered copies of a few anchors give plenty of overlapping groups.
+        if detections and rng.random() < 0.5:
+            x1, y1, x2, y2 = rng.choice(detections)["bbox"]
+            dx, dy = rng.uniform(-30, 30), rng.uniform(-30, 30)
+            box = [x1 + dx, y1 + dy, x2 + dx * rng.random(), y2 + dy * rng.random()]
+        else:
+            x1, y1 = rng.uniform(0, width), rng.uniform(0, height)
+            w, h = rng.uniform(1, max_side), rng.uniform(1, max_side)
+            box = [x1, y1, x1 + w, y1 + h]
+        label = rng.choice(["noise"] + [f"cluster_{i}" for i in range(clusters)])
+        detections.append({"bbox": [round(v, 2) for v in box], "label": label})
+    return detections
+
+
+def check_equivalence(trials, seed):
+    rng = random.Random(seed)
+    for trial in range(trials):
+        detections = random_detections(rng, rng.randint(0, 200), rng.randint(0, 5))
+        threshold = rng.choice([0.0, 0.1, 0.33, 0.5, 0.7, 1.0])
+        expected = reference_merge(detections, threshold)
+        actual = merge_grouped_boxes(detections, threshold)
+        if actual != expected:
+            raise AssertionError(
+                f"Mismatch in trial {trial} (threshold={threshold}, "
+                f"{len(detections)} boxes)"
+            )
+    print(f"Equivalence check passed on {trials} random inputs")
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Box merging benchmark")
+    parser.add_argument(
+        "--counts", type=int, nargs="+", default=[10, 100, 1000, 10000]
+    )
+    parser.add_argument("--threshold", type=float, default=0.33)
+    parser.add_argument("--reference-max", type=int, default=1000)
+    parser.add_argument("--trials", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    check_equivalence(args.trials, args.seed)
+
+    rng = random.Random(args.seed)
+    print(f"{'boxes':>6} {'reference ms':>13} {'vectorized ms':>14} {'speedup':>8}")
+    for count in args.counts:
+        detections = random_detections(rng, count, clusters=0)
+        fast = timed(merge_grouped_boxes, detections, args.threshold)
+        if count <= args.reference_max:
+            slow = timed(reference_merge, detections, args.threshold)
+            print(
+                f"{count:>6} {slow * 1000:>13.1f} {fast * 1000:>14.1f}"
+                f" {slow / fast:>7.1f}x"
+            )
+        else:
+            print(f"{count:>6} {'-':>13} {fast * 1000:>14.1f} {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from flask import Flask, jsonify
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from src.util.metrics import init_app, render_metrics, timed  # noqa: E402
+
+
+def build_app(instrumented, stages):
+    app = Flask(f"bench-{instrumented}")
+
+    @app.route("/work", methods=["GET"])
+    def work():
+        for stage in range(stages):
+            if instrumented:
+                with timed(f"stage_{stage}"):
+                    pass
+        return jsonify({"ok": True})
+
+    if instrumented:
+        init_app(app)
+    return app
+
+
+def per_request(app, count, repeats=5):
+    client = app.test_client()
+    for _ in range(50):
+        client.get("/work")
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(count):
+            client.get("/work")
+        timings.append((time.perf_counter() - started) / count)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Instrumentation overhead")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--stages", type=int, default=6)
+    parser.add_argument("--timers", type=int, default=200000)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    started = time.perf_counter()
+    for _ in range(args.timers):
+        with timed("bench"):
+            pass
+    timer_cost = (time.perf_counter() - started) / args.timers
+    print(f"timed() block:              {timer_cost * 1e6:8.2f} us")
+
+    plain = per_request(build_app(False, args.stages), args.requests)
+    traced = per_request(build_app(True, args.stages), args.requests)
+    print(f"request without tracing:    {plain * 1e6:8.1f} us")
+    print(
+        f"request with tracing:       {traced * 1e6:8.1f} us"
+        f" (+{(traced - plain) * 1e6:.1f} us, {args.stages} stages)"
+    )
+
+    started = time.perf_counter()
+    body = render_metrics()
+    print(
+        f"/metrics render:            {(time.perf_counter() - started) * 1e3:8.2f} ms"
+        f" ({len(body.splitlines())} lines)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import io
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from flask import Flask, jsonify
+from werkzeug.serving import make_server
+
+APP_DIR = os.path.join(os.path.dirname(__file__), "..", "app")
+
+
+def stub_service(name, latency, concurrency, detections):
+    # Downstream stand-in that serves at most `concurrency` requests at a time,
+    # each taking `latency` seconds, like a model server with a fixed pool.
+    app = Flask(name)
+    slots = threading.Semaphore(concurrency)
+
+    def work():
+        with slots:
+            time.sleep(latency)
+
+    @app.route("/detect", methods=["POST"])
+    def detect():
+        work()
+        return jsonify({"detections": detections})
+
+    @app.route("/group", methods=["POST"])
+    def group():
+        work()
+        return jsonify(
+            {"detections": [{**d, "label": "cluster_0"} for d in detections]}
+        )
+
+    @app.route("/config", methods=["GET"])
+    def config():
+        return jsonify({"name": name})
+
+    return app
+
+
+def serve(app, port):
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def run_level(url, image, clients, requests_per_client):
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+
+    def client(index):
+        session = requests.Session()
+        for i in range(requests_per_client):
+            # Distinct bytes per request so the result cache never hits.
+            payload = image + f"{index}-{i}".encode()
+            started = time.perf_counter()
+            response = session.post(
+                url, files={"image": ("shelf.jpg", io.BytesIO(payload))}
+            )
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = (
+                    statuses.get(response.status_code, 0) + 1
+                )
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(client, range(clients)))
+    wall = time.perf_counter() - started
+    return wall, latencies, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server /process load test")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--requests", type=int, default=8, help="per client")
+    parser.add_argument("--detector-latency", type=float, default=0.2)
+    parser.add_argument("--grouper-latency", type=float, default=0.1)
+    parser.add_argument("--downstream-concurrency", type=int, default=4)
+    parser.add_argument("--boxes", type=int, default=50)
+    parser.add_argument("--max-in-flight", type=int, default=4)
+    parser.add_argument("--max-queue", type=int, default=32)
+    parser.add_argument("--port", type=int, default=5900)
+    args = parser.parse_args()
+
+    detector_port, grouper_port, server_port = args.port, args.port + 1, args.port + 2
+    os.environ.update(
+        SERVER_LOG_LEVEL="WARNING",
+        SERVER_CACHE_ENABLED="false",
+        SERVER_DETECTOR_URL=f"http://127.0.0.1:{detector_port}/detect",
+        SERVER_GROUPER_URL=f"http://127.0.0.1:{grouper_port}/group",
+        SERVER_DETECTOR_MAX_IN_FLIGHT=str(args.max_in_flight),
+        SERVER_GROUPER_MAX_IN_FLIGHT=str(args.max_in_flight),
+        SERVER_DETECTOR_MAX_QUEUE=str(args.max_queue),
+        SERVER_GROUPER_MAX_QUEUE=str(args.max_queue),
+    )
+    sys.path.insert(0, APP_DIR)
+    from main import app  # noqa: E402
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    detections = [
+        {"label": "object", "score": 0.9, "bbox": [i * 20.0, 0.0, i * 20.0 + 18, 40.0]}
+        for i in range(args.boxes)
+    ]
+    for port, name, latency in (
+        (detector_port, "detector", args.detector_latency),
+        (grouper_port, "grouper", args.grouper_latency),
+    ):
+        serve(
+            stub_service(name, latency, args.downstream_concurrency, detections), port
+        )
+    serve(app, server_port)
+
+    url = f"http://127.0.0.1:{server_port}/process"
+    image = b"\xff\xd8synthetic-image"
+
+    print(
+        f"{'clients':>7} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'statuses':>20}"
+    )
+    for clients in args.clients:
+        wall, latencies, statuses = run_level(url, image, clients, args.requests)
+        print(
+            f"{clients:>7} {len(latencies) / wall:>7.2f}"
+            f" {percentile(latencies, 0.5) * 1000:>8.0f}"
+            f" {percentile(latencies, 0.95) * 1000:>8.0f}"
+            f" {str(statuses):>20}"
+        )
+
+
+if __name__ == "__main__":
+    main()